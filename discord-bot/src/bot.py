@@ -2,6 +2,8 @@ import discord
 from discord.ext import commands
 from cogs import EXTENSIONS
 import os
+import asyncio
+import signal
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -13,6 +15,15 @@ intents.message_content = True
 # intents.messages = True
 bot = commands.Bot(command_prefix='!', intents=intents)
 
+async def setup_hook():
+    # Pods are stopped with SIGTERM, close the bot so the cogs unload and write out their state first
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(bot.close()))
+    except NotImplementedError:
+        pass  # No signal handlers on Windows
+
+bot.setup_hook = setup_hook
+
 # Load cogs
 @bot.event
 async def on_ready():
@@ -12,6 +12,13 @@ from google.cloud import storage, vision
 import logging
 import random
 from utils.helpers import process_and_generate_response
+from utils.context import CONTEXT_TOKEN_BUDGET, build_conversation, token_estimator
+from utils.history import history_store
+from utils.scheduler import PRIORITY_ROOM
+from utils.speech import speak
+from utils.voice_connections import voice_connections
+from utils.state import state_store
+from utils.router import model_router
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -24,12 +31,14 @@ class AIConvRoomCog(commands.Cog):
         self.project_id = os.getenv('GOOGLE_CLOUD_PROJECT_ID')
         self.location = 'us-central1'
         self.bucket_name = os.getenv('GCS_BUCKET_NAME')
-        self.model = GenerativeModel("gemini-1.5-flash-002")
-        self.conversation_histories = {}
+        # Models are picked per request by the shared router
+        self.models = model_router
+        self.history = history_store
+        self.history.attach(bot)
         self.received_first_message = False
         self.conv_session_active = False
         self.conv_voice_active = False
-        self.number_of_messages_to_track = 20
+        self.context_token_budget = CONTEXT_TOKEN_BUDGET
         self.bots = {
             "pirate": "You are a pirate. Speak in a pirate accent and use pirate slang.",
             "astrophysicist": "You are an astrophysicist. Provide scientific insights without using technical jargon.",
@@ -47,21 +56,24 @@ class AIConvRoomCog(commands.Cog):
             "random": "You are a random bot. Respond with a random message."
         }
 
-    async def fetch_conversation_history(self, channel, limit=10):
-        """Fetch the last 'limit' messages from the specified channel."""
-        self.conversation_histories[channel.guild.id][channel.name] = []
-        async for message in channel.history(limit=limit, oldest_first=False):
-            self.conversation_histories[channel.guild.id][channel.name].append(f"{message.author.name}: {message.content}")
-        self.conversation_histories[channel.guild.id][channel.name].reverse()  # Ensure the messages are in chronological order
+    async def cog_load(self):
+        # Restore the voice toggle from before the last restart
+        self.conv_voice_active = await state_store.get('ai_conv_room', 'conv_voice_active', self.conv_voice_active)
 
-    async def update_conversation_history(self, message):
-        """Update the conversation history with the new message."""
-        if len(self.conversation_histories[message.guild.id][message.channel.name]) > self.number_of_messages_to_track:
-            self.conversation_histories[message.guild.id][message.channel.name].pop(0)
+    async def cog_unload(self):
+        # Write out queued history, memory and flag changes before shutdown. The store is shared by
+        # every cog and is opened again on next use.
+        await state_store.close()
 
-    async def reset_conversation_history(self, guild_id, channel_name):
+    def get_conversation_context(self, channel):
+        """Return as much of the tracked conversation as fits in the token budget, oldest message first."""
+        conversation_context, tokens = build_conversation(self.history.entries(channel), self.context_token_budget)
+        logger.info(f"Conversation context for channel {channel.name}: ~{tokens} tokens")
+        return conversation_context
+
+    async def reset_conversation_history(self, channel):
         """Reset the conversation history for the specified channel."""
-        self.conversation_histories[guild_id][channel_name] = []
+        self.history.reset(channel)
 
     @commands.command(name='ai-conv')
     async def toggle_conv_session(self, ctx):
@@ -76,6 +88,7 @@ class AIConvRoomCog(commands.Cog):
         """Main command to interact with the Gemini Vertex AI API in a voice conv session."""
         logger.info(f"{ctx.author} called the ai-conv-voice command with prompt: {prompt}")
         self.conv_voice_active = not self.conv_voice_active
+        state_store.set('ai_conv_room', 'conv_voice_active', self.conv_voice_active)
         status = "started" if self.conv_voice_active else "stopped"
         await ctx.send(f"conv voice session {status}. Join a voice channel to begin.")
         await ctx.send(f"conv voice session {status}. Join a voice channel to begin.")
@@ -84,9 +97,8 @@ class AIConvRoomCog(commands.Cog):
     async def reset_conversation(self, ctx):
         """Resets the conversation history for the current channel."""
         logger.info(f"{ctx.author} called the ai-conv-reset command")
-        guild_id = ctx.guild.id
         channel_name = ctx.channel.name
-        await self.reset_conversation_history(guild_id, channel_name)
+        await self.reset_conversation_history(ctx.channel)
         await ctx.send(f"Conversation history for {channel_name} has been reset. New messages will be tracked from now on.")
 
     @commands.Cog.listener()
@@ -104,23 +116,17 @@ class AIConvRoomCog(commands.Cog):
         if not self.conv_session_active:
             return
 
-        guild_id = message.guild.id
         channel_name = message.channel.name
 
         if channel_name != self.channel_name:
             return
 
-        if guild_id not in self.conversation_histories:
-            self.conversation_histories[guild_id] = {}
-        if channel_name not in self.conversation_histories[guild_id]:
-            self.conversation_histories[guild_id][channel_name] = []
-
-        await self.fetch_conversation_history(message.channel, self.number_of_messages_to_track)
-        await self.update_conversation_history(message)
-
+        # Seed the history from REST once, afterwards it is kept current from gateway events
+        await self.history.ensure_seeded(message.channel)
+        self.history.append(message)
 
         try:
-            conversation_context = "\n".join(self.conversation_histories[guild_id][channel_name])
+            conversation_context = self.get_conversation_context(message.channel)
             # Extract the bot name from the message content
             sender_bot = message.content.split(':', 1)[0] if message.author == self.bot.user else message.author.name
 
@@ -130,49 +136,36 @@ class AIConvRoomCog(commands.Cog):
             available_bots = [bot for bot in self.bots if bot != sender_bot]
             selected_bot = random.choice(available_bots)
 
+            # The persona is the fixed part of the prompt, sent as cached context
             bot_prompt = self.bots[selected_bot]
-            full_prompt += f"TASK: {bot_prompt} Let that influence your response but not take full control of it. Respond to the last message of the conversation appropriately. Keep it short and engaging."
+            prefix = f"TASK: {bot_prompt} Let that influence your response but not take full control of it. Respond to the last message of the conversation appropriately. Keep it short and engaging."
 
             logger.info(f"Selected bot: {selected_bot}")
+            token_estimator.log_prompt(message.channel, full_prompt, self.models.default)
 
             await asyncio.sleep(10)  # Pause for 10 seconds before responding
 
             ctx = await self.bot.get_context(message)
-            text_response = await process_and_generate_response(ctx, self.model, self.bucket_name, full_prompt, dont_modify_prompt=True)
+            text_response = await process_and_generate_response(ctx, self.models, self.bucket_name, full_prompt, dont_modify_prompt=True, priority=PRIORITY_ROOM, prefix=prefix)
             if text_response.lower().startswith("{selected_bot}:"):
                 text_response = text_response.split(":", 1)[1].strip() # Remove the bot name from the response
             await message.channel.send(f"{selected_bot}: {text_response}")
 
+            # The voice connection stays open between replies and is closed once it has been idle for a while
             if self.conv_voice_active:
                 await self.play_voice_response(message, text_response)
-            else:
-                if message.guild.voice_client:
-                    await message.guild.voice_client.disconnect()
 
         except Exception as e:
             await message.channel.send(f"Error: {str(e)}")
 
+    async def connect_voice(self, message):
+        """Return a voice client in the voice channel of the message author, reusing the open connection."""
+        return await voice_connections.connect(message.author.voice.channel)
+
     async def play_voice_response(self, message, text_response):
-        """Play the text response in the voice channel."""
+        """Queue the text response to be played in the voice channel."""
         if message.author.voice and message.author.voice.channel:
-            voice_channel = message.author.voice.channel
-            if not message.guild.voice_client:
-                await voice_channel.connect()
-            elif message.guild.voice_client.channel != voice_channel:
-                await message.guild.voice_client.move_to(voice_channel)
-
-            tts = gTTS(text_response, tld='ca', lang='en')
-            tts = gTTS(text_response, tld='ca', lang='en')
-            audio_path = f"response-{message.id}.mp3"
-            tts.save(audio_path)
-            source = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(audio_path))
-
-            def after_playing(e):
-                if e:
-                    logger.error(f'Player error: {e}')
-                os.remove(audio_path)
-
-            message.guild.voice_client.play(source, after=after_playing)
+            speak(lambda: self.connect_voice(message), text_response)
 
 async def setup(bot):
     await bot.add_cog(AIConvRoomCog(bot))
\ No newline at end of file
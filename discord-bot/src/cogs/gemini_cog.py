@@ -12,6 +12,12 @@ from gtts import gTTS
 from google.cloud import storage, vision
 import logging
 from utils.helpers import *
+from utils.attachments import close_http_session
+from utils.streaming import STREAM_REPLIES, send_streaming_reply
+from utils.scheduler import model_scheduler
+from utils.workers import run_blocking
+from utils.resilience import resilience
+from utils.router import model_router
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -27,11 +33,16 @@ class GeminiCog(commands.Cog):
         self.project_id = os.getenv('GOOGLE_CLOUD_PROJECT_ID')
         self.location = 'us-central1'  # Change this to your Vertex AI location
         self.bucket_name = os.getenv('GCS_BUCKET_NAME')
-        self.model = GenerativeModel("gemini-1.5-flash-002")
+        # Models are picked per request by the shared router
+        self.models = model_router
         self.image_model = ImageGenerationModel.from_pretrained("imagen-3.0-generate-001")  # Initialize the ImageGenerationModel
         # Initialize the Vertex AI client
         vertexai.init(project=self.project_id, location=self.location)
 
+    async def cog_unload(self):
+        # The download session is shared by every cog, it is opened again on next use
+        await close_http_session()
+
     def check_debug_mode(self, ctx):
         if DEBUG and ctx.guild.id != DEBUG_GUILD_ID:
             logger.info(f"Debug mode is enabled. This command is only available in the debug server. ctx.guild.id: {ctx.guild.id}, DEBUG_GUILD_ID: {DEBUG_GUILD_ID}")
@@ -46,13 +57,48 @@ class GeminiCog(commands.Cog):
             return
 
         try:
-            text_response = await process_and_generate_response(ctx, self.model, self.bucket_name, prompt)
+            if STREAM_REPLIES:
+                # Post the reply as soon as the first chunks arrive and keep editing it
+                chunks = stream_and_generate_response(ctx, self.models, self.bucket_name, prompt, cacheable=True)
+                await send_streaming_reply(ctx.channel, chunks)
+                return
+            text_response = await process_and_generate_response(ctx, self.models, self.bucket_name, prompt, cacheable=True)
             # Split the response into chunks of 2000 characters
             for i in range(0, len(text_response), 2000):
                 await ctx.send(text_response[i:i+2000])
         except Exception as e:
             await ctx.send(f"Error: {str(e)}")
 
+    @commands.command(name='ai-cache-stats')
+    async def cache_stats(self, ctx):
+        """Shows the hit/miss counters of the attachment, preset response, prompt prefix and speech caches"""
+        logger.info(f"{ctx.author} called the ai-cache-stats command")
+        if not self.check_debug_mode(ctx):
+            return
+
+        lines = [f"{name}: {stats}" for name, stats in attachment_cache_stats().items()]
+        await ctx.send("\n".join(lines))
+
+    @commands.command(name='ai-queue-stats')
+    async def queue_stats(self, ctx):
+        """Shows the depth and wait times of the model call queue"""
+        logger.info(f"{ctx.author} called the ai-queue-stats command")
+        if not self.check_debug_mode(ctx):
+            return
+
+        await ctx.send(str(model_scheduler.stats()))
+
+    @commands.command(name='ai-router-stats')
+    async def router_stats(self, ctx):
+        """Shows the model routing decisions, per-model latency and the state of the circuit breakers"""
+        logger.info(f"{ctx.author} called the ai-router-stats command")
+        if not self.check_debug_mode(ctx):
+            return
+
+        lines = [f"{name}: {stats}" for name, stats in self.models.stats().items()]
+        lines += [f"{name}: {stats}" for name, stats in resilience.stats().items()]
+        await ctx.send("\n".join(lines))
+
     @commands.command(name='imgen')
     async def imgen(self, ctx, *, prompt: str = ""):
         """Generates an image based on the given prompt using ImageGenerationModel"""
@@ -61,24 +107,28 @@ class GeminiCog(commands.Cog):
             return
 
         try:
-            for attempt in range(3):  # Retry up to 3 times
-                image_response = self.image_model.generate_images(
+            async def generate():
+                return await run_blocking(
+                    self.image_model.generate_images,
                     prompt=prompt,
                     number_of_images=1,
                     language="en",
                     aspect_ratio="1:1",
                     safety_filter_level="block_some",
                 )
-                logger.info(f"Attempt {attempt + 1}: image_response: {image_response}")
-
-                if image_response.images:  # Check if any images were generated
-                    image_path = f"temp_image_{ctx.message.id}.png"
-                    image_response[0].save(location=image_path)
-                    await ctx.send(file=discord.File(image_path))
-                    os.remove(image_path)  # Clean up the downloaded file
-                    break
+
+            # Empty responses (e.g. filtered prompts) are retried like failures, up to MODEL_RETRIES times
+            image_response = await resilience.call('imagen', generate, accept=lambda response: bool(response.images),
+                                                   admit=lambda: model_scheduler.slot_for(ctx.message))
+            logger.info(f"image_response: {image_response}")
+
+            if image_response.images:  # Check if any images were generated
+                image_path = f"temp_image_{ctx.message.id}.png"
+                image_response[0].save(location=image_path)
+                await ctx.send(file=discord.File(image_path))
+                os.remove(image_path)  # Clean up the downloaded file
             else:
-                await ctx.send("Failed to generate images after 3 attempts.")
+                await ctx.send(f"Failed to generate images after {resilience.retries + 1} attempts.")
 
         except Exception as e:
             await ctx.send(f"Error: {str(e)}")
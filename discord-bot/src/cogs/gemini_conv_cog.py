@@ -12,6 +12,19 @@ from gtts import gTTS
 from google.cloud import storage, vision
 import logging
 from utils.helpers import *
+from utils.blackjack import RULES, BlackjackTables, parse_action
+from utils.debounce import ReplyDebouncer
+from utils.context import CONTEXT_TOKEN_BUDGET, build_conversation, token_estimator
+from utils.history import history_store
+from utils.memory import MemoryIndex
+from utils.summary import RollingSummary
+from utils.scheduler import PRIORITY_AMBIENT
+from utils.playback import playback
+from utils.speech import TTS_PREWARM, SpeechPipeline, prewarm, speak
+from utils.voice_connections import voice_connections
+from utils.state import state_store
+from utils.streaming import STREAM_REPLIES, send_streaming_reply
+from utils.router import model_router
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -21,6 +34,25 @@ DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
 DEBUG_GUILD_ID = os.getenv('DEBUG_GUILD_ID', 123456789012345678)
 CONVERSATION_CHANNEL_NAME = os.getenv('CONVERSATION_CHANNEL_NAME', 'ai-chatroom')
 BLACKJACK_CHANNEL_NAME = os.getenv('BLACKJACK_CHANNEL_NAME', 'blackjack-ai-bot')
+# Have the model add a line of dealer banter when a blackjack round is settled
+BLACKJACK_NARRATE = os.getenv('BLACKJACK_NARRATE', 'True').lower() == 'true'
+# Tokens of chat sent with blackjack prompts, the table state itself comes from the game engine
+BLACKJACK_CONTEXT_TOKENS = int(os.getenv('BLACKJACK_CONTEXT_TOKENS', 500))
+
+# Fixed start of each prompt, sent as cached context so only the conversation is sent every time
+CHATROOM_PREFIX = ("TASK: You are cool-ai-man in a conversation. I will provide the conversation."
+                   "Read the conversation then respond as someone would to continue the conversation. "
+                   "ADDITIONAL INFORMATION: Keep your response short unless you feel details are necessary or are asked for them. "
+                   "If someone asks to play a game, try your best to keep track of the game. Even if another conversation is happening. "
+                   "If the last part of the conversation doesn't reference anything specific then look back in the conversation to find some context. ")
+BLACKJACK_PREFIX = ("TASK: You are the dealer of an underground gambling ring named cool-ai-man running a blackjack game in this conversation. "
+                    "Respond to the last message as the dealer. Keep it short. "
+                    "ADDITIONAL INFORMATION: The table below is the exact game state. Never deal cards, change hands or settle bets yourself. "
+                    "Players play by saying join, bet <chips or an item>, deal, hit, stand, double, split, hand, rules or leave. "
+                    "Players can bet unordinary items like their shoes or a favor. "
+                    "If someone is out of chips let them bet their way back in. ")
+NARRATE_PREFIX = ("TASK: You are cool-ai-man, the dealer of an underground gambling ring. "
+                  "React to how this blackjack round ended in one or two short sentences. Don't repeat the cards or the payouts. ")
 
 channel_names = [CONVERSATION_CHANNEL_NAME, BLACKJACK_CHANNEL_NAME]
 channel_names_str = ', '.join(channel_names)
@@ -32,14 +64,24 @@ class GeminiConvCog(commands.Cog):
         self.project_id = os.getenv('GOOGLE_CLOUD_PROJECT_ID')
         self.location = 'us-central1'  # Change this to your Vertex AI location
         self.bucket_name = os.getenv('GCS_BUCKET_NAME')
-        self.model = GenerativeModel("gemini-1.5-flash-002")
+        # Models are picked per request by the shared router
+        self.models = model_router
         # Initialize the Vertex AI client
         vertexai.init(project=self.project_id, location=self.location)
-        self.conversation_histories = {}
+        self.history = history_store
+        self.history.attach(bot)
         self.chat_session_active = True
         self.chat_voice_active = False
-        self.message_counts_since_reset = {}
-        self.number_of_messages_to_track = 20
+        self.context_token_budget = CONTEXT_TOKEN_BUDGET
+        # Older history is folded into a running summary so long games keep their state
+        self.summaries = RollingSummary(self.history)
+        # Messages leaving the history are remembered and recalled by similarity
+        self.memory = MemoryIndex()
+        self.memory.attach(self.history)
+        # Cards, hands and bets are tracked locally, the model only narrates
+        self.blackjack = BlackjackTables()
+        # Bursts of messages in a channel get a single reply
+        self.debouncer = ReplyDebouncer()
 
         # Define a dictionary mapping channel names to handler functions
         self.channel_handlers = {
@@ -48,28 +90,40 @@ class GeminiConvCog(commands.Cog):
             # Add more channels and their corresponding handler functions here
         }
 
+    async def cog_load(self):
+        # Restore the toggles from before the last restart
+        self.chat_session_active = await state_store.get('gemini_conv', 'chat_session_active', self.chat_session_active)
+        self.chat_voice_active = await state_store.get('gemini_conv', 'chat_voice_active', self.chat_voice_active)
+        # Fill the speech cache with fixed replies in the background, the rules are one of them
+        asyncio.ensure_future(prewarm(TTS_PREWARM + [RULES]))
+
+    async def cog_unload(self):
+        # Write out queued history, memory and flag changes before shutdown. The store is shared by
+        # every cog and is opened again on next use.
+        await state_store.close()
+
     def check_debug_mode(self, ctx):
         if DEBUG and ctx.guild.id != DEBUG_GUILD_ID:
             logger.info(f"Debug mode is enabled. This command is only available in the debug server. ctx.guild.id: {ctx.guild.id}, DEBUG_GUILD_ID: {DEBUG_GUILD_ID}")
             return False
         return True
 
-    async def fetch_conversation_history(self, channel, limit=10):
-        """Fetch the last 'limit' messages from the specified channel."""
-        self.conversation_histories[channel.guild.id][channel.name] = []
-        async for message in channel.history(limit=limit, oldest_first=False):
-            self.conversation_histories[channel.guild.id][channel.name].append(f"{message.author.name}: {message.content}")
-        self.conversation_histories[channel.guild.id][channel.name].reverse()  # Ensure the messages are in chronological order
-
-    async def update_conversation_history(self, message):
-        """Update the conversation history with the new message."""
-        if len(self.conversation_histories[message.guild.id][message.channel.name]) > self.number_of_messages_to_track:
-            self.conversation_histories[message.guild.id][message.channel.name].pop(0)
-
-    async def reset_conversation_history(self, guild_id, channel_name):
+    def get_conversation_context(self, channel, budget=None):
+        """Return the running summary followed by as much of the recent conversation as fits in the token budget."""
+        summary = self.summaries.summary(channel)
+        budget = (budget or self.context_token_budget) - token_estimator.estimate(summary)
+        conversation_context, tokens = build_conversation(self.summaries.tail(channel), budget)
+        logger.info(f"Conversation context for channel {channel.name}: ~{tokens} tokens of messages, summary: {bool(summary)}")
+        if summary:
+            conversation_context = f"(Summary of the earlier conversation: {summary})\n{conversation_context}"
+        return conversation_context
+
+    async def reset_conversation_history(self, channel):
         """Reset the conversation history for the specified channel."""
-        self.message_counts_since_reset[guild_id][channel_name] = 0
-        self.conversation_histories[guild_id][channel_name] = []
+        self.history.reset(channel)
+        self.summaries.reset(channel)
+        self.memory.reset(channel)
+        self.blackjack.reset(channel)
 
     @commands.command(name='ai-chat')
     async def toggle_chat_session(self, ctx):
@@ -79,6 +133,7 @@ class GeminiConvCog(commands.Cog):
             return
 
         self.chat_session_active = not self.chat_session_active
+        state_store.set('gemini_conv', 'chat_session_active', self.chat_session_active)
         status = "started" if self.chat_session_active else "stopped"
         await ctx.send(f"Chat session {status}.")
 
@@ -88,8 +143,7 @@ class GeminiConvCog(commands.Cog):
         logger.info(f"{ctx.author} called the ai-stop command")
         if not self.check_debug_mode(ctx):
             return
-        if ctx.voice_client.is_playing():
-            ctx.voice_client.stop()
+        playback.clear(ctx.guild)
 
     @commands.command(name='ai-chat-status')
     async def chat_session_status(self, ctx):
@@ -109,6 +163,7 @@ class GeminiConvCog(commands.Cog):
             return
 
         self.chat_voice_active = not self.chat_voice_active
+        state_store.set('gemini_conv', 'chat_voice_active', self.chat_voice_active)
         status = "started" if self.chat_voice_active else "stopped"
         await ctx.send(f"Chat voice session {status}. Join a voice channel to begin.")
 
@@ -119,9 +174,8 @@ class GeminiConvCog(commands.Cog):
         if not self.check_debug_mode(ctx):
             return
 
-        guild_id = ctx.guild.id
         channel_name = ctx.channel.name
-        await self.reset_conversation_history(guild_id, channel_name)
+        await self.reset_conversation_history(ctx.channel)
         await ctx.send(f"Conversation history for {channel_name} has been reset. New messages will be tracked from now on.")
 
     @commands.Cog.listener()
@@ -132,34 +186,30 @@ class GeminiConvCog(commands.Cog):
         if message.author == self.bot.user:
             return
 
-        guild_id = message.guild.id
         channel_name = message.channel.name
 
         if channel_name not in channel_names:
             return
 
-        # Ensure all necessary entries are initialized for the guild and channel
-        if guild_id not in self.conversation_histories:
-            self.conversation_histories[guild_id] = {}
-        if channel_name not in self.conversation_histories[guild_id]:
-            self.conversation_histories[guild_id][channel_name] = []
-            self.message_counts_since_reset[guild_id] = {}
-            self.message_counts_since_reset[guild_id][channel_name] = self.number_of_messages_to_track
-
-        # Fetch the conversation history for the channel
-        self.message_counts_since_reset[guild_id][channel_name] += 1
-        limit = min(self.message_counts_since_reset[guild_id][channel_name],
-                     self.number_of_messages_to_track)
-        logger.info(f"Fetching conversation history for channel: {channel_name}, limit: {limit}")
-        await self.fetch_conversation_history(message.channel, limit)
-
-        # Update the message to the conversation history
-        await self.update_conversation_history(message)
+        # Seed the history from REST once, afterwards it is kept current from gateway events
+        await self.history.ensure_seeded(message.channel)
+        await self.summaries.ensure_loaded(message.channel)
+        if channel_name == CONVERSATION_CHANNEL_NAME:
+            await self.memory.ensure_loaded(message.channel)
+        self.history.append(message)
+        self.summaries.maybe_fold(message.channel)
+
+        # Game commands are applied right away, every one of them counts
+        if channel_name == BLACKJACK_CHANNEL_NAME and self.chat_session_active:
+            action = parse_action(message.content)
+            if action:
+                await self.play_blackjack(message, *action)
+                return
 
         # Check if the message's channel is in the dictionary
         handler = self.channel_handlers.get(channel_name)
         if handler:
-            await handler(message)
+            self.debouncer.submit(message, handler)
 
     async def handle_conversation_channel(self, message):
         """Handle messages in the conversation channel."""
@@ -176,37 +226,27 @@ class GeminiConvCog(commands.Cog):
             logger.info(f"guild_id: {guild_id}, channel_name: {channel_name}")
 
             # Combine the conversation history with the new message
-            conversation_context = "\n".join(self.conversation_histories[guild_id][channel_name])
-            full_prompt = ("TASK: You are cool-ai-man in a conversation. I will provide the conversation."
-                            "Read the conversation then respond as someone would to continue the conversation. "
-                            "ADDITIONAL INFORMATION: Keep your response short unless you feel details are necessary or are asked for them. "
-                            "If someone asks to play a game, try your best to keep track of the game. Even if another conversation is happening. "
-                            "If the last part of the conversation doesn't reference anything specific then look back in the conversation to find some context. \n"
-                            f"CONVERSATION: {conversation_context}")
+            conversation_context = self.get_conversation_context(message.channel)
+            memories = await self.memory.recall(message.channel, message.content)
+            if memories:
+                memories = "EARLIER MESSAGES THAT MAY BE RELEVANT: " + "\n".join(memories) + "\n"
+            else:
+                memories = ""
+            full_prompt = (f"{memories}"
+                           f"CONVERSATION: {conversation_context}")
 
             logger.info(f"Full prompt: {full_prompt}")
+            token_estimator.log_prompt(message.channel, full_prompt, self.models.default)
 
             # Send the combined prompt to the Gemini model
             ctx = await self.bot.get_context(message)
-            text_response = await process_and_generate_response(ctx, self.model, self.bucket_name, full_prompt, dont_modify_prompt=True)
-            
-            while text_response.startswith("cool-ai-man:"):
-                text_response = text_response.replace("cool-ai-man:","")
-            await message.channel.send(text_response)
-
-            # If voice chat is active, play the response in the voice channel
-            if self.chat_voice_active:
-                await self.play_voice_response(message, text_response)
-            else:
-                # If voice chat is not active, leave the voice channel if connected
-                if message.guild.voice_client:
-                    await message.guild.voice_client.disconnect()
+            await self.send_response(ctx, message.channel, full_prompt, CHATROOM_PREFIX)
 
         except Exception as e:
             await message.channel.send(f"Error: {str(e)}")
 
     async def handle_blackjack_channel(self, message):
-        """Handle messages in the blackjack channel."""
+        """Handle chat in the blackjack channel that isn't a game command."""
         if not self.chat_session_active:
             return
 
@@ -214,59 +254,103 @@ class GeminiConvCog(commands.Cog):
             return
 
         try:
-            guild_id = message.guild.id
-            channel_name = message.channel.name
-
-            # Combine the conversation history with the new message
-            conversation_context = "\n".join(self.conversation_histories[guild_id][channel_name])
-            full_prompt = ("TASK: You are the dealer of an underground gambling ring named cool-ai-man running a blackjack game in this conversation. I will provide the conversation."
-                            "Read the conversation then respond as the dealer to continue the game. "
-                            "ADDITIONAL INFORMATION: Keep track of the game state and respond accordingly. "
-                            "You can let players bet unordinary items like their shoes or a favor. "
-                            "If someone gets banned from the table let them bet their way back in. "
-                            "If someone asks for the rules, explain them briefly. "
-                            "If someone asks for their current hand or the dealer's hand, provide the information. "
-                            "If someone asks to hit, deal a card to them and update their hand. "
-                            "If someone asks to stand, move to the next player or the dealer's turn. "
-                            "If someone asks to double down, double their bet and deal one final card to them. "
-                            "If someone asks to split, split their hand into two separate hands and deal one card to each hand. "
-                            "If the last part of the conversation doesn't reference anything specific then look back in the conversation to find some context. \n"
-                            f"CONVERSATION: {conversation_context}")
+            # The engine holds the game state, so only a short stretch of chat is needed
+            table = self.blackjack.table(message.channel)
+            conversation_context = self.get_conversation_context(message.channel, BLACKJACK_CONTEXT_TOKENS)
+            full_prompt = (f"TABLE: {table.snapshot()}\n"
+                           f"CONVERSATION: {conversation_context}")
 
             logger.info(f"Full prompt: {full_prompt}")
+            token_estimator.log_prompt(message.channel, full_prompt, self.models.default)
 
             # Send the combined prompt to the Gemini model
             ctx = await self.bot.get_context(message)
-            text_response = await process_and_generate_response(ctx, self.model, self.bucket_name, full_prompt, dont_modify_prompt=True)
-            while text_response.startswith("cool-ai-man:"):
-                text_response = text_response.replace("cool-ai-man:","")
+            await self.send_response(ctx, message.channel, full_prompt, BLACKJACK_PREFIX)
+
+        except Exception as e:
+            await message.channel.send(f"Error: {str(e)}")
+
+    async def play_blackjack(self, message, action, argument):
+        """Apply a game command locally and post the result, with model banter only when a round is settled."""
+        try:
+            table = self.blackjack.table(message.channel)
+            settled = table.settled
+            lines = table.act(message.author.name, action, argument)
+            settled = table.settled != settled
+            if not lines:
+                return
+            text_response = "\n".join(lines)
             await message.channel.send(text_response)
-            # If voice chat is active, play the response in the voice channel
-            if self.chat_voice_active:
-                await self.play_voice_response(message, text_response)
-            else:
-                # If voice chat is not active, leave the voice channel if connected
-                if message.guild.voice_client:
-                    await message.guild.voice_client.disconnect()
+
+            if settled and BLACKJACK_NARRATE:
+                full_prompt = f"ROUND: {' '.join(lines)}"
+                token_estimator.log_prompt(message.channel, full_prompt, self.models.default)
+                ctx = await self.bot.get_context(message)
+                await self.send_response(ctx, message.channel, full_prompt, NARRATE_PREFIX, debounced=False)
+                text_response = None  # Already spoken
+            await self.after_reply(message, text_response)
 
         except Exception as e:
             await message.channel.send(f"Error: {str(e)}")
 
+    async def after_reply(self, message, text_response=None):
+        """Speak a reply that send_response didn't speak if voice chat is active.
+
+        The voice connection is kept open between replies and closed once it has been idle for a while.
+        """
+        if self.chat_voice_active and text_response:
+            await self.play_voice_response(message, text_response)
+
+    async def send_response(self, ctx, channel, full_prompt, prefix=None, debounced=True):
+        """Generate a response to the prefix and prompt, send it to the channel and return its text.
+
+        If voice chat is active the response is queued to be spoken as it streams in. Replies sent
+        from a debounced turn tell the debouncer once they start posting; other replies, such as
+        game narration, leave the channel's turn alone.
+        """
+        speech = self.start_speech(ctx.message)
+        try:
+            if STREAM_REPLIES:
+                chunks = stream_and_generate_response(ctx, self.models, self.bucket_name, full_prompt, dont_modify_prompt=True, priority=PRIORITY_AMBIENT, prefix=prefix)
+                if debounced:
+                    chunks = self.posting(channel, chunks)
+                if speech is not None:
+                    chunks = speech.tee(chunks)
+                text_response = await send_streaming_reply(channel, chunks, strip_prefix="cool-ai-man:")
+            else:
+                text_response = await process_and_generate_response(ctx, self.models, self.bucket_name, full_prompt, dont_modify_prompt=True, priority=PRIORITY_AMBIENT, prefix=prefix)
+                while text_response.startswith("cool-ai-man:"):
+                    text_response = text_response.replace("cool-ai-man:","")
+                if debounced:
+                    self.debouncer.mark_posting(channel)
+                await channel.send(text_response)
+                if speech is not None:
+                    speech.feed(text_response)
+        finally:
+            if speech is not None:
+                speech.finish()
+        return text_response
+
+    async def posting(self, channel, chunks):
+        """Pass chunks through, marking the reply as posting once the first one arrives."""
+        async for chunk in chunks:
+            self.debouncer.mark_posting(channel)
+            yield chunk
+
+    def start_speech(self, message):
+        """Return a pipeline that speaks a reply to the message, or None if it shouldn't be spoken."""
+        if not self.chat_voice_active or not (message.author.voice and message.author.voice.channel):
+            return None
+        return SpeechPipeline(lambda: self.connect_voice(message), strip_prefix="cool-ai-man:")
+
+    async def connect_voice(self, message):
+        """Return a voice client in the voice channel of the message author, reusing the open connection."""
+        return await voice_connections.connect(message.author.voice.channel)
+
     async def play_voice_response(self, message, text_response):
-        """Play the text response in the voice channel."""
+        """Queue the text response to be played in the voice channel."""
         if message.author.voice and message.author.voice.channel:
-            voice_channel = message.author.voice.channel
-            if not message.guild.voice_client:
-                await voice_channel.connect()
-            elif message.guild.voice_client.channel != voice_channel:
-                await message.guild.voice_client.move_to(voice_channel)
-
-            tts = gTTS(text_response, tld='ca', lang='en')
-            tts.save('gemini.mp3')
-            source = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio('gemini.mp3'))
-            message.guild.voice_client.play(source, after=lambda e: logger.error(f'Player error: {e}') if e else None)
-            while message.guild.voice_client.is_playing():
-                await asyncio.sleep(1)
+            speak(lambda: self.connect_voice(message), text_response)
 
 async def setup(bot):
     await bot.add_cog(GeminiConvCog(bot))
\ No newline at end of file
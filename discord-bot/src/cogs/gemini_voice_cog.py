@@ -12,6 +12,11 @@ from gtts import gTTS
 from google.cloud import storage, vision
 import logging
 from utils.helpers import *
+from utils.router import model_router
+from utils.playback import playback
+from utils.speech import SpeechPipeline
+from utils.voice_connections import voice_connections
+from utils.streaming import STREAM_REPLIES, send_streaming_reply
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -27,7 +32,8 @@ class GeminiVoiceCog(commands.Cog):
         self.project_id = os.getenv('GOOGLE_CLOUD_PROJECT_ID')
         self.location = 'us-central1'  # Change this to your Vertex AI location
         self.bucket_name = os.getenv('GCS_BUCKET_NAME')
-        self.model = GenerativeModel("gemini-1.5-flash-002")
+        # Models are picked per request by the shared router
+        self.models = model_router
         # Initialize the Vertex AI client
         vertexai.init(project=self.project_id, location=self.location)
 
@@ -39,19 +45,16 @@ class GeminiVoiceCog(commands.Cog):
 
     @commands.command(name='ai-join')
     async def join(self, ctx, *, channel: discord.VoiceChannel = None):
-        """Joins a voice channel"""
+        """Joins a voice channel, or moves the open connection there"""
         logger.info(f"{ctx.author} called the join command")
         if not self.check_debug_mode(ctx):
             return
         if not ctx.author.voice:
-            return await ctx.send("You are not connected to a voice channel.")
-        
+            await ctx.send("You are not connected to a voice channel.")
+            return None
+
         channel = channel or ctx.author.voice.channel
-        
-        if ctx.voice_client:
-            await ctx.voice_client.move_to(channel)
-        else:
-            await channel.connect()
+        return await voice_connections.connect(channel)
 
     @commands.command(name='ai-leave')
     async def leave(self, ctx, *, prompt: str = ""):
@@ -59,8 +62,15 @@ class GeminiVoiceCog(commands.Cog):
         logger.info(f"{ctx.author} called the leave command")
         if not self.check_debug_mode(ctx):
             return
-        if ctx.voice_client is not None:
-            await ctx.voice_client.disconnect()
+        await voice_connections.disconnect(ctx.guild)
+
+    @commands.command(name='ai-voice-stats')
+    async def voice_stats(self, ctx):
+        """Shows voice connection reuse and the playback queues"""
+        logger.info(f"{ctx.author} called the ai-voice-stats command")
+        if not self.check_debug_mode(ctx):
+            return
+        await ctx.send(f"connections: {voice_connections.stats()}\nplayback: {playback.stats()}")
 
     @commands.command(name='ai-stop')
     async def gemini_stop(self, ctx):
@@ -68,8 +78,15 @@ class GeminiVoiceCog(commands.Cog):
         logger.info(f"{ctx.author} called the ai-stop command")
         if not self.check_debug_mode(ctx):
             return
-        if ctx.voice_client.is_playing():
-            ctx.voice_client.stop()
+        playback.clear(ctx.guild)
+
+    @commands.command(name='ai-skip')
+    async def gemini_skip(self, ctx):
+        """Skips what the bot is saying and moves on to the next queued reply"""
+        logger.info(f"{ctx.author} called the ai-skip command")
+        if not self.check_debug_mode(ctx):
+            return
+        playback.skip(ctx.guild)
 
     @commands.command(name='ai-voice')
     async def gemini_voice(self, ctx, *, prompt: str = ""):
@@ -78,16 +95,14 @@ class GeminiVoiceCog(commands.Cog):
         if not self.check_debug_mode(ctx):
             return
         try:
-            await self.join(ctx)
-            text_response = await process_and_generate_response(ctx, self.model, self.bucket_name, prompt)
-            tts = gTTS(text_response, tld='ca', lang='en')
-            tts.save('gemini.mp3')
-            source = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio('gemini.mp3'))
-            await ctx.send(text_response)
-            ctx.voice_client.play(source, after=lambda e: logger.error(f'Player error: {e}') if e else None)
-            while ctx.voice_client.is_playing():
-                await asyncio.sleep(1)
-            await self.leave(ctx)
+            # Joining overlaps generation, and each sentence is spoken as soon as it is complete
+            speech = SpeechPipeline(lambda: self.join(ctx))
+            chunks = speech.tee(stream_and_generate_response(ctx, self.models, self.bucket_name, prompt, cacheable=True))
+            if STREAM_REPLIES:
+                await send_streaming_reply(ctx.channel, chunks)
+            else:
+                text_response = ''.join([chunk async for chunk in chunks])
+                await ctx.send(text_response)
         except Exception as e:
             logger.error(f"Error: {str(e)}")
             await ctx.send("You may need to join a voice channel first, or there is an issue with Gemini.")
@@ -0,0 +1,236 @@
+# Description: This file contains the attachment pipeline that turns Discord attachments into Gemini parts, streaming large files instead of holding them in memory.
+import hashlib
+import logging
+import os
+import tempfile
+import aiohttp
+from google.cloud import storage
+from vertexai.generative_models import Part
+from utils.images import IMAGE_PREPROCESS, preprocess_image
+from utils.videos import VIDEO_PREPROCESS, preprocess_video, video_policy
+from utils.workers import run_blocking, run_in_process
+
+logger = logging.getLogger(__name__)
+
+# Attachments up to this size are sent inline instead of being uploaded to GCS
+ATTACHMENT_INLINE_MAX_BYTES = int(os.getenv('ATTACHMENT_INLINE_MAX_BYTES', 7 * 1024 * 1024))
+# Resumable upload chunk size, must be a multiple of 256 KiB. Bounds memory used per upload.
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+_http_session = None
+_storage_client = None
+
+
+class DownloadError(Exception):
+    """Raised when an attachment can't be downloaded from Discord."""
+
+
+def get_http_session():
+    """Return the aiohttp session shared by the whole process."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_read=60))
+    return _http_session
+
+
+async def close_http_session():
+    """Close the shared aiohttp session, the next download opens a new one."""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+def get_storage_client():
+    """Return the Google Cloud Storage client shared by the whole process."""
+    global _storage_client
+    if _storage_client is None:
+        _storage_client = storage.Client()
+    return _storage_client
+
+
+async def download_bytes(url):
+    """Download a (small) attachment into memory."""
+    async with get_http_session().get(url) as response:
+        if response.status != 200:
+            raise DownloadError(f"Failed to download {url}: HTTP {response.status}")
+        return await response.read()
+
+
+async def download_to_file(url):
+    """Stream a download into a temporary file one chunk at a time, hashing it on the way.
+
+    Returns the SHA-256 hex digest and the path of the file, which the caller deletes.
+    """
+    digest = hashlib.sha256()
+    fd, path = tempfile.mkstemp(prefix='attachment-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            async with get_http_session().get(url) as response:
+                if response.status != 200:
+                    raise DownloadError(f"Failed to download {url}: HTTP {response.status}")
+                async for data in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    digest.update(data)
+                    await run_blocking(f.write, data)
+    except BaseException:
+        await run_blocking(remove_file, path)
+        raise
+    return digest.hexdigest(), path
+
+
+def preprocesses(attachment):
+    return attachment.content_type.startswith('video/') and VIDEO_PREPROCESS
+
+
+async def fetch_digest(attachment):
+    """Download the attachment once and return its SHA-256 hex digest and its content.
+
+    Images and attachments small enough to inline are held in memory as bytes. Larger ones, and
+    videos that ffmpeg preprocesses, are streamed into a temporary file whose path is returned
+    instead; it is hashed on the way, then preprocessed or uploaded from disk without being
+    downloaded again. Release the content with discard_content once the parts are built.
+    """
+    if attachment.content_type.startswith('image/') or (attachment.size <= ATTACHMENT_INLINE_MAX_BYTES and not preprocesses(attachment)):
+        data = await download_bytes(attachment.url)
+        return hashlib.sha256(data).hexdigest(), data
+    return await download_to_file(attachment.url)
+
+
+async def discard_content(data):
+    """Delete the temporary file of content returned by fetch_digest, if it has one."""
+    if isinstance(data, str):
+        await run_blocking(remove_file, data)
+
+
+def attachment_variant(attachment, preset=None):
+    """Return what, besides its content, decides the parts of an attachment."""
+    if preprocesses(attachment):
+        # Presets preprocess long videos differently
+        return video_policy(preset)
+    return None
+
+
+def blob_name_for(message, attachment):
+    return f"attachments/{message.id}-{attachment.id}-{attachment.filename}"
+
+
+async def upload_bytes(data, bucket_name, blob_name, content_type):
+    blob = get_storage_client().bucket(bucket_name).blob(blob_name)
+    await run_blocking(blob.upload_from_string, data, content_type=content_type)
+    return blob
+
+
+async def upload_file(path, bucket_name, blob_name, content_type):
+    """Stream a local file into a resumable GCS upload, one chunk at a time."""
+    blob = get_storage_client().bucket(bucket_name).blob(blob_name, chunk_size=UPLOAD_CHUNK_SIZE)
+    await run_blocking(blob.upload_from_filename, path, content_type=content_type)
+    return blob
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        logger.warning(f"Failed to delete {path}: {e}")
+
+
+def output_size(content):
+    """Size of a preprocessed output, held in memory as bytes or on disk as the path of a temporary file."""
+    return os.path.getsize(content) if isinstance(content, str) else len(content)
+
+
+async def encoded_to_parts(message, attachment, bucket_name, encoded):
+    """Build parts for preprocessed (content, mime type) outputs, uploading the ones too large to inline.
+
+    content is bytes, or the path of a temporary file that is streamed to GCS without being read
+    into memory. Returns the parts and the uploaded blobs.
+    """
+    parts, blobs = [], []
+    for index, (content, content_type) in enumerate(encoded):
+        blob_name = f"{blob_name_for(message, attachment)}-{index}"
+        if output_size(content) > ATTACHMENT_INLINE_MAX_BYTES:
+            if isinstance(content, str):
+                blob = await upload_file(content, bucket_name, blob_name, content_type)
+            else:
+                blob = await upload_bytes(content, bucket_name, blob_name, content_type)
+            parts.append(Part.from_uri(gcs_uri(blob), content_type))
+            blobs.append(blob)
+        else:
+            if isinstance(content, str):
+                content = await run_blocking(read_file, content)
+            parts.append(Part.from_data(content, content_type))
+    return parts, blobs
+
+
+async def image_to_parts(message, attachment, bucket_name, data):
+    """Shrink a downloaded image in a worker process and build its parts.
+
+    Images are always held in memory since Pillow needs the whole file; Discord caps their size.
+    """
+    images = [(data, attachment.content_type)]
+    if IMAGE_PREPROCESS:
+        images = await run_in_process(preprocess_image, data, attachment.content_type)
+        processed_size = sum(len(image) for image, _ in images)
+        logger.info(f"Preprocessed {attachment.filename}: {len(data)} -> {processed_size} bytes ({len(data) - processed_size} saved)")
+
+    return await encoded_to_parts(message, attachment, bucket_name, images)
+
+
+async def video_to_parts(message, attachment, bucket_name, path, preset=None):
+    """Transcode or sample a downloaded video in a worker process according to the preset's policy.
+
+    Returns None when the original video should be sent.
+    """
+    try:
+        encoded = await run_in_process(preprocess_video, path, preset)
+    except Exception as e:
+        logger.warning(f"Video preprocessing failed for {attachment.filename}, sending the original: {e}")
+        return None
+    if encoded is None:
+        return None
+
+    try:
+        processed_size = sum(output_size(content) for content, _ in encoded)
+        logger.info(f"Preprocessed {attachment.filename}: {attachment.size} -> {processed_size} bytes ({attachment.size - processed_size} saved)")
+        return await encoded_to_parts(message, attachment, bucket_name, encoded)
+    finally:
+        for content, _ in encoded:
+            if isinstance(content, str):
+                await run_blocking(remove_file, content)
+
+
+async def attachment_to_part(message, attachment, bucket_name, data, preset=None):
+    """Build the Gemini parts for the attachment.
+
+    data is the content returned by fetch_digest: bytes, or the path of its temporary file. Returns
+    the list of parts and the uploaded blobs (empty when everything was small enough to inline).
+    """
+    if attachment.content_type.startswith('image/'):
+        return await image_to_parts(message, attachment, bucket_name, data)
+
+    if isinstance(data, str) and preprocesses(attachment):
+        prepared = await video_to_parts(message, attachment, bucket_name, data, preset)
+        if prepared is not None:
+            return prepared
+
+    # The original file, inlined or uploaded as is
+    return await encoded_to_parts(message, attachment, bucket_name, [(data, attachment.content_type)])
+
+
+def gcs_uri(blob):
+    return f"gs://{blob.bucket.name}/{blob.name}"
+
+
+async def delete_blob(blob):
+    if blob is None:
+        return
+    try:
+        await run_blocking(blob.delete)
+    except Exception as e:
+        logger.warning(f"Failed to delete {gcs_uri(blob)}: {e}")
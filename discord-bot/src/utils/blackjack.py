@@ -0,0 +1,414 @@
+# Description: This file contains the blackjack game engine used by the blackjack channel, so the model only narrates the game.
+import logging
+import os
+import random
+import re
+
+logger = logging.getLogger(__name__)
+
+BLACKJACK_DECKS = int(os.getenv('BLACKJACK_DECKS', 6))
+BLACKJACK_STARTING_CHIPS = int(os.getenv('BLACKJACK_STARTING_CHIPS', 100))
+# Hands a player can hold after splitting
+MAX_HANDS = 4
+
+RANKS = ['A', '2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K']
+SUITS = ['♠', '♥', '♦', '♣']
+
+RULES = ("Blackjack rules: get closer to 21 than the dealer without going over. Face cards are 10, aces are 1 or 11. "
+         "Blackjack pays 3:2, the dealer stands on all 17s. "
+         "Commands: `join`, `bet <chips>` or `bet my <anything you own>`, `deal`, `hit`, `stand`, `double`, `split`, `hand`, `leave`.")
+
+# Game commands, with their aliases
+ACTIONS = {
+    'join': 'join', 'sit': 'join',
+    'leave': 'leave',
+    'bet': 'bet', 'wager': 'bet',
+    'deal': 'deal',
+    'hit': 'hit',
+    'stand': 'stand', 'stay': 'stand',
+    'double': 'double',
+    'split': 'split',
+    'hand': 'hand', 'status': 'hand', 'table': 'hand',
+    'rules': 'rules',
+}
+# Words that may follow a command without a ! prefix, e.g. "hit me"
+ACTION_SUFFIXES = {'hit': {'me'}}
+# Arguments of an unprefixed bet: a number of chips or something the player owns
+BET_CHIPS = re.compile(r"^(\d+)(?:\s+chips?)?$", re.IGNORECASE)
+BET_ITEM = re.compile(r"^my\s+\S", re.IGNORECASE)
+
+
+def parse_action(content):
+    """Return (action, argument) if the message is a game command, otherwise None.
+
+    Without a ! prefix the whole message has to be the command, so chat that merely starts with a
+    command word ("deal with it", "leave me alone") is left alone. An unprefixed bet needs a number
+    of chips or something the player owns ("bet 20", "bet my watch"); `!bet` takes anything.
+    """
+    text = content.strip()
+    prefixed = text.startswith('!')
+    words = text.lstrip('!').rstrip('.!?').split(None, 1)
+    if not words:
+        return None
+    action = ACTIONS.get(words[0].lower())
+    if action is None:
+        return None
+    argument = words[1].strip() if len(words) > 1 else ""
+    if action == 'bet':
+        chips = BET_CHIPS.match(argument)
+        if chips:
+            return action, chips.group(1)
+        if argument and (prefixed or BET_ITEM.match(argument)):
+            return action, argument
+        return None
+    if argument.lower() in ACTION_SUFFIXES.get(action, ()):
+        argument = ""
+    if argument and not prefixed:
+        return None
+    return action, argument
+
+
+def card_name(card):
+    return RANKS[card % 13] + SUITS[card // 13 % 4]
+
+
+def card_value(card):
+    rank = card % 13
+    return 11 if rank == 0 else min(rank + 1, 10)
+
+
+def hand_total(cards):
+    """Return the best total of the cards and whether it is soft (an ace counted as 11)."""
+    total = sum(card_value(card) for card in cards)
+    aces = sum(1 for card in cards if card % 13 == 0)
+    while total > 21 and aces:
+        total -= 10
+        aces -= 1
+    return total, aces > 0
+
+
+class Shoe:
+    """A multi-deck shoe that is reshuffled once three quarters of it has been dealt."""
+
+    def __init__(self, decks=BLACKJACK_DECKS, rng=None):
+        self.decks = decks
+        self.rng = rng or random.Random()
+        self.cards = []
+        self.shuffle()
+
+    def shuffle(self):
+        self.cards = list(range(52)) * self.decks
+        self.rng.shuffle(self.cards)
+
+    def draw(self):
+        if len(self.cards) < 13 * self.decks:
+            self.shuffle()
+        return self.cards.pop()
+
+
+class Stake:
+    """What a hand is played for: chips, or anything else a player puts on the table."""
+    __slots__ = ('chips', 'item')
+
+    def __init__(self, chips=0, item=None):
+        self.chips = chips
+        self.item = item
+
+    @classmethod
+    def parse(cls, text):
+        try:
+            return cls(chips=int(text))
+        except ValueError:
+            pass
+        if text.lower().startswith('my '):
+            # Told back in the third person: "bets their watch"
+            text = 'their ' + text[3:]
+        return cls(item=text)
+
+    def __str__(self):
+        return f"{self.chips} chips" if self.item is None else self.item
+
+
+class Hand:
+    __slots__ = ('cards', 'stake', 'doubled', 'done', 'from_split')
+
+    def __init__(self, stake, cards=None, from_split=False):
+        self.cards = cards or []
+        self.stake = stake
+        self.doubled = False
+        self.done = False
+        self.from_split = from_split  # 21 on two cards after a split isn't a blackjack
+
+    @property
+    def total(self):
+        return hand_total(self.cards)[0]
+
+    @property
+    def is_blackjack(self):
+        return len(self.cards) == 2 and self.total == 21 and not self.from_split
+
+    def describe(self):
+        total, soft = hand_total(self.cards)
+        label = "blackjack" if self.is_blackjack else f"{'soft ' if soft and total < 21 else ''}{total}"
+        doubled = ", doubled" if self.doubled else ""
+        return f"{' '.join(card_name(card) for card in self.cards)} ({label}) for {self.stake}{doubled}"
+
+
+class Player:
+    __slots__ = ('name', 'chips', 'stake', 'hands', 'active')
+
+    def __init__(self, name, chips=BLACKJACK_STARTING_CHIPS):
+        self.name = name
+        self.chips = chips
+        self.stake = None  # Bet for the next round
+        self.hands = []
+        self.active = 0  # Index of the hand being played
+
+
+class BlackjackTable:
+    """Game state of one channel.
+
+    Every method returns the lines to post in the channel. A round goes from betting to playing,
+    where players act in turn on each of their hands, and is settled once the dealer has played.
+    """
+
+    def __init__(self, rng=None):
+        self.shoe = Shoe(rng=rng)
+        self.players = {}  # name -> Player, in seating order
+        self.dealer = []
+        self.phase = 'betting'
+        self.turn = 0  # Index into the players of the round
+        self.round = []  # Players dealt into the current round
+        self.settled = 0  # Rounds settled so far, including those settled right at the deal
+
+    def act(self, name, action, argument=""):
+        """Apply a command from a player and return the resulting lines."""
+        if action == 'rules':
+            return [RULES]
+        if action == 'hand':
+            return [self.snapshot()]
+        if action == 'join':
+            return self.join(name)
+        if action == 'leave':
+            return self.leave(name)
+        if name not in self.players:
+            return [f"{name}, you're not at the table. Say `join` to sit down."]
+        if action == 'bet':
+            return self.bet(name, argument)
+        if action == 'deal':
+            return self.deal()
+        return self.play(name, action)
+
+    def join(self, name):
+        if name in self.players:
+            return [f"{name}, you're already at the table."]
+        self.players[name] = Player(name)
+        return [f"{name} sits down with {BLACKJACK_STARTING_CHIPS} chips."]
+
+    def leave(self, name):
+        player = self.players.pop(name, None)
+        if player is None:
+            return [f"{name}, you're not at the table."]
+        lines = [f"{name} leaves the table with {player.chips} chips."]
+        if self.phase == 'playing' and player in self.round:
+            index = self.round.index(player)
+            self.round.remove(player)
+            if index < self.turn:
+                self.turn -= 1
+            lines += self._advance()
+        return lines
+
+    def bet(self, name, argument):
+        if self.phase != 'betting':
+            return [f"{name}, wait for this round to finish before betting."]
+        player = self.players[name]
+        stake = Stake.parse(argument)
+        if stake.item is None:
+            if stake.chips <= 0:
+                return [f"{name}, bets have to be positive."]
+            if stake.chips > player.chips:
+                return [f"{name}, you only have {player.chips} chips. Bet fewer, or bet something else you own."]
+        player.stake = stake
+        return [f"{name} bets {stake}."]
+
+    def deal(self):
+        if self.phase != 'betting':
+            return ["A round is already in play."]
+        self.round = [player for player in self.players.values() if player.stake is not None]
+        if not self.round:
+            return ["Nobody has bet yet. Say `bet <amount>` first."]
+        for player in self.round:
+            if player.stake.item is None:
+                player.chips -= player.stake.chips
+            player.hands = [Hand(player.stake, [self.shoe.draw(), self.shoe.draw()])]
+            player.active = 0
+            player.stake = None
+        self.dealer = [self.shoe.draw(), self.shoe.draw()]
+        self.phase = 'playing'
+        self.turn = 0
+        lines = [f"Dealer shows {card_name(self.dealer[0])}."]
+        lines += [f"{player.name}: {player.hands[0].describe()}" for player in self.round]
+        if hand_total(self.dealer)[0] == 21:
+            lines.append("Dealer has blackjack.")
+            return lines + self._settle()
+        for player in self.round:
+            if player.hands[0].is_blackjack:
+                player.hands[0].done = True
+        return lines + self._advance()
+
+    def play(self, name, action):
+        if self.phase != 'playing':
+            return [f"{name}, there is no round in play. Bet and say `deal` to start one."]
+        player = self.round[self.turn]
+        if player.name != name:
+            return [f"{name}, it's {player.name}'s turn."]
+        hand = player.hands[player.active]
+        if action == 'hit':
+            hand.cards.append(self.shoe.draw())
+            hand.done = hand.total >= 21
+            lines = [f"{name} hits: {hand.describe()}" + (" Bust!" if hand.total > 21 else "")]
+        elif action == 'stand':
+            hand.done = True
+            lines = [f"{name} stands on {hand.total}."]
+        elif action == 'double':
+            if len(hand.cards) != 2:
+                return [f"{name}, you can only double on your first two cards."]
+            if not self._take_extra_stake(player, hand):
+                return [f"{name}, you don't have the chips to double."]
+            hand.doubled = True
+            hand.cards.append(self.shoe.draw())
+            hand.done = True
+            lines = [f"{name} doubles down: {hand.describe()}" + (" Bust!" if hand.total > 21 else "")]
+        elif action == 'split':
+            if len(hand.cards) != 2 or card_value(hand.cards[0]) != card_value(hand.cards[1]):
+                return [f"{name}, you can only split a pair."]
+            if len(player.hands) >= MAX_HANDS:
+                return [f"{name}, that's as many hands as the house allows."]
+            if not self._take_extra_stake(player, hand):
+                return [f"{name}, you don't have the chips to split."]
+            split = Hand(hand.stake, [hand.cards.pop()], from_split=True)
+            hand.from_split = True
+            hand.cards.append(self.shoe.draw())
+            split.cards.append(self.shoe.draw())
+            player.hands.insert(player.active + 1, split)
+            if hand.cards[0] % 13 == 0:
+                hand.done = split.done = True  # Split aces get one card each
+            lines = [f"{name} splits: {hand.describe()} | {split.describe()}"]
+        else:
+            return []
+        return lines + self._advance()
+
+    @staticmethod
+    def _take_extra_stake(player, hand):
+        # Items are simply put on the line again, chips have to be covered
+        if hand.stake.item is not None:
+            return True
+        if player.chips < hand.stake.chips:
+            return False
+        player.chips -= hand.stake.chips
+        return True
+
+    def _advance(self):
+        """Move to the next hand still to be played, or let the dealer play."""
+        while self.turn < len(self.round):
+            player = self.round[self.turn]
+            while player.active < len(player.hands):
+                hand = player.hands[player.active]
+                if not hand.done:
+                    which = f" (hand {player.active + 1})" if len(player.hands) > 1 else ""
+                    return [f"{player.name}{which}, you're on {hand.total}. Hit, stand, double or split?"]
+                player.active += 1
+            self.turn += 1
+        return self._dealer_plays()
+
+    def _dealer_plays(self):
+        hands = [hand for player in self.round for hand in player.hands]
+        if any(hand.total <= 21 and not hand.is_blackjack for hand in hands):
+            while hand_total(self.dealer)[0] < 17:
+                self.dealer.append(self.shoe.draw())
+        return self._settle()
+
+    def _settle(self):
+        dealer_total = hand_total(self.dealer)[0]
+        dealer_blackjack = len(self.dealer) == 2 and dealer_total == 21
+        cards = ' '.join(card_name(card) for card in self.dealer)
+        lines = [f"Dealer has {cards} ({'bust' if dealer_total > 21 else dealer_total})."]
+        for player in self.round:
+            for hand in player.hands:
+                multiple = 2 if hand.doubled else 1
+                total = hand.total
+                if total > 21:
+                    outcome = -1
+                elif hand.is_blackjack and not dealer_blackjack:
+                    outcome = 1.5
+                elif dealer_blackjack and not hand.is_blackjack:
+                    outcome = -1
+                elif dealer_total > 21 or total > dealer_total:
+                    outcome = 1
+                elif total == dealer_total:
+                    outcome = 0
+                else:
+                    outcome = -1
+                lines.append(f"{player.name}: {self._payout(player, hand.stake, outcome, multiple)}")
+        for player in self.round:
+            if player.chips <= 0:
+                lines.append(f"{player.name} is out of chips and can only bet their way back in with something else.")
+            player.hands = []
+        self.round = []
+        self.dealer = []
+        self.phase = 'betting'
+        self.settled += 1
+        return lines
+
+    @staticmethod
+    def _payout(player, stake, outcome, multiple):
+        if stake.item is not None:
+            staked = stake.item if multiple == 1 else f"{stake.item} (twice over)"
+            if outcome > 0:
+                return f"wins, the house owes them the equivalent of {staked}."
+            if outcome == 0:
+                return f"pushes and keeps {stake.item}."
+            return f"loses {staked} to the house."
+        staked = stake.chips * multiple
+        if outcome == 0:
+            player.chips += staked
+            return f"pushes, {player.chips} chips."
+        if outcome > 0:
+            winnings = int(staked * outcome)
+            player.chips += staked + winnings
+            return f"wins {winnings}, {player.chips} chips."
+        return f"loses {staked}, {player.chips} chips."
+
+    def snapshot(self):
+        """A short description of the table, compact enough to send with every prompt."""
+        if not self.players:
+            return "The table is empty."
+        parts = []
+        if self.phase == 'playing':
+            parts.append(f"Dealer shows {card_name(self.dealer[0])}")
+            for player in self.round:
+                hands = " | ".join(hand.describe() for hand in player.hands)
+                parts.append(f"{player.name} ({player.chips} chips): {hands}")
+            parts.append(f"{self.round[self.turn].name} to act")
+        else:
+            for player in self.players.values():
+                bet = f", bet {player.stake}" if player.stake is not None else ""
+                parts.append(f"{player.name}: {player.chips} chips{bet}")
+            parts.append("taking bets")
+        return "; ".join(parts) + "."
+
+
+class BlackjackTables:
+    """One table per (guild, channel)."""
+
+    def __init__(self):
+        self._tables = {}
+
+    def table(self, channel):
+        key = (channel.guild.id, channel.id)
+        if key not in self._tables:
+            self._tables[key] = BlackjackTable()
+        return self._tables[key]
+
+    def reset(self, channel):
+        self._tables.pop((channel.guild.id, channel.id), None)
@@ -0,0 +1,100 @@
+# Description: This file contains the LRUCache class, a small size-capped cache with optional expiry and hit/miss counters.
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Least recently used cache with an entry cap, an optional byte cap and an optional time to live.
+
+    With maxbytes set, the total sizeof(value) of the entries is kept under it as well.
+    on_evict(key, value) is called whenever an entry is dropped because of a cap or its TTL.
+    """
+
+    def __init__(self, maxsize=256, ttl=None, on_evict=None, maxbytes=None, sizeof=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # key -> (value, expires_at)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        item = self._data.get(key)
+        return item is not None and not self._expired(item)
+
+    def _expired(self, item, now=None):
+        return item[1] is not None and item[1] <= (now or time.monotonic())
+
+    def _remove(self, key):
+        value, _ = self._data.pop(key)
+        if self.maxbytes is not None:
+            self.bytes -= self.sizeof(value)
+        return value
+
+    def _evict(self, key):
+        value = self._remove(key)
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        if self._expired(item):
+            self._evict(key)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (value, expires_at)
+        if self.maxbytes is not None:
+            self.bytes += self.sizeof(value)
+        while len(self._data) > self.maxsize or (self.maxbytes is not None and self.bytes > self.maxbytes and len(self._data) > 1):
+            self._evict(next(iter(self._data)))
+
+    def pop(self, key, default=None):
+        if key not in self._data:
+            return default
+        return self._remove(key)
+
+    def expire(self):
+        """Drop every expired entry. Returns how many were dropped."""
+        now = time.monotonic()
+        expired = [key for key, item in self._data.items() if self._expired(item, now)]
+        for key in expired:
+            self._evict(key)
+        return len(expired)
+
+    def clear(self):
+        for key in list(self._data):
+            self._evict(key)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        stats = {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+        if self.maxbytes is not None:
+            stats.update(bytes=self.bytes, maxbytes=self.maxbytes)
+        return stats
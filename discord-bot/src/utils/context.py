@@ -0,0 +1,100 @@
+# Description: This file contains the token budgeted context builder used to assemble the CONVERSATION block of chat prompts.
+import asyncio
+import logging
+import math
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# Tokens of conversation history sent with each prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 2000))
+# Every Nth prompt is counted with the model's count_tokens to calibrate the local estimate, 0 disables it
+CONTEXT_CALIBRATE_EVERY = int(os.getenv('CONTEXT_CALIBRATE_EVERY', 50))
+# Entries that would get fewer tokens than this after truncation are dropped instead
+MIN_TRUNCATED_TOKENS = 16
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+class TokenEstimator:
+    """Fast local token estimate, optionally calibrated against the model's tokenizer.
+
+    raw() is what gets cached per history entry; the calibration factor is applied on top, so
+    recalibrating never invalidates the cache.
+    """
+
+    def __init__(self):
+        self.factor = 1.0
+        self._prompts = 0
+
+    @staticmethod
+    def raw(text):
+        # Words and punctuation, with long words costing extra word pieces
+        return sum(1 + len(token) // 8 for token in TOKEN_PATTERN.findall(text))
+
+    def scale(self, raw_tokens):
+        return math.ceil(raw_tokens * self.factor)
+
+    def estimate(self, text):
+        return self.scale(self.raw(text))
+
+    async def calibrate(self, model, text):
+        try:
+            response = await model.count_tokens_async(text)
+        except Exception as e:
+            logger.warning(f"Token calibration failed: {e}")
+            return
+        raw_tokens = self.raw(text)
+        if raw_tokens:
+            # Move slowly so a single odd prompt doesn't swing the estimate
+            self.factor = 0.8 * self.factor + 0.2 * (response.total_tokens / raw_tokens)
+            logger.info(f"Token estimate calibrated: factor {self.factor:.3f}")
+
+    def log_prompt(self, channel, prompt, model=None):
+        """Log the estimated prompt size and occasionally calibrate the estimate in the background."""
+        logger.info(f"Prompt tokens for channel {channel.name}: ~{self.estimate(prompt)}")
+        self._prompts += 1
+        if model is not None and CONTEXT_CALIBRATE_EVERY and self._prompts % CONTEXT_CALIBRATE_EVERY == 0:
+            asyncio.ensure_future(self.calibrate(model, prompt))
+
+
+token_estimator = TokenEstimator()
+
+
+def entry_tokens(entry):
+    """Token count of a history entry, computed once and cached on the entry."""
+    if entry.tokens is None:
+        entry.tokens = token_estimator.raw(entry.line)
+    return token_estimator.scale(entry.tokens)
+
+
+def truncate_to_tokens(line, tokens):
+    """Cut a line down to roughly the given number of tokens."""
+    used = 0
+    for match in TOKEN_PATTERN.finditer(line):
+        used += token_estimator.scale(1 + len(match.group()) // 8)
+        if used > tokens:
+            return line[:match.start()].rstrip() + "..."
+    return line
+
+
+def build_conversation(entries, budget=CONTEXT_TOKEN_BUDGET):
+    """Join the newest entries that fit in the token budget, oldest first.
+
+    The oldest entry that doesn't fit is truncated if a useful part of it still fits.
+    Returns the conversation text and its estimated token count.
+    """
+    lines, used = [], 0
+    for entry in reversed(entries):
+        tokens = entry_tokens(entry)
+        if used + tokens > budget:
+            remaining = budget - used
+            if remaining >= MIN_TRUNCATED_TOKENS:
+                lines.append(truncate_to_tokens(entry.line, remaining))
+                used = budget
+            break
+        lines.append(entry.line)
+        used += tokens
+    lines.reverse()
+    return "\n".join(lines), used
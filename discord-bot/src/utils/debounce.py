@@ -0,0 +1,76 @@
+# Description: This file contains the ReplyDebouncer class, which coalesces bursts of channel messages into a single bot reply.
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds of quiet in a channel before the bot replies
+CHAT_DEBOUNCE_SECONDS = float(os.getenv('CHAT_DEBOUNCE_SECONDS', 1.5))
+# Longest a reply is held back while messages keep arriving
+CHAT_DEBOUNCE_MAX_WAIT = float(os.getenv('CHAT_DEBOUNCE_MAX_WAIT', 6.0))
+
+
+class ChannelTurn:
+    """The pending or in-flight reply of one channel."""
+    __slots__ = ('task', 'first_seen', 'latest', 'posting', 'followup')
+
+    def __init__(self):
+        self.task = None
+        self.first_seen = None
+        self.latest = None
+        self.posting = False
+        self.followup = False
+
+
+class ReplyDebouncer:
+    """Runs at most one reply per channel for each burst of messages.
+
+    A message resets the quiet window, bounded by max_wait since the first message of the burst.
+    A message arriving while the reply is still being generated cancels and restarts it, unless
+    max_wait has passed or the reply has started posting: the reply is then left to finish and the
+    message is folded into a follow-up turn, so steady chatter can't hold replies back forever.
+    """
+
+    def __init__(self, quiet=CHAT_DEBOUNCE_SECONDS, max_wait=CHAT_DEBOUNCE_MAX_WAIT):
+        self.quiet = quiet
+        self.max_wait = max_wait
+        self._turns = {}  # channel id -> ChannelTurn
+
+    def submit(self, message, handler):
+        """Schedule handler(message) for the latest message of the burst."""
+        turn = self._turns.setdefault(message.channel.id, ChannelTurn())
+        turn.latest = message
+        running = turn.task is not None and not turn.task.done()
+        if running and (turn.posting or time.monotonic() - turn.first_seen >= self.max_wait):
+            turn.followup = True
+            return
+        if running:
+            logger.info(f"Coalescing message {message.id} into the pending reply for channel: {message.channel.name}")
+            turn.task.cancel()
+        else:
+            turn.first_seen = time.monotonic()
+        turn.task = asyncio.create_task(self._run(turn, handler))
+
+    def mark_posting(self, channel):
+        """Called when a debounced reply starts being sent; it can no longer be cancelled."""
+        turn = self._turns.get(channel.id)
+        if turn is not None and turn.task is not None and not turn.task.done():
+            turn.posting = True
+
+    async def _run(self, turn, handler):
+        deadline = turn.first_seen + self.max_wait
+        await asyncio.sleep(max(0.0, min(self.quiet, deadline - time.monotonic())))
+        turn.followup = False
+        try:
+            await handler(turn.latest)
+        except Exception as e:
+            # Still answer the messages that arrived meanwhile, a failed reply shouldn't drop them
+            logger.error(f"Reply to message {turn.latest.id} in channel {turn.latest.channel.name} failed: {e}")
+        finally:
+            turn.posting = False
+        if turn.followup:
+            # Messages arrived once this reply could no longer be restarted, answer them in one more turn
+            turn.first_seen = time.monotonic()
+            turn.task = asyncio.create_task(self._run(turn, handler))
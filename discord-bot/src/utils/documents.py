@@ -0,0 +1,137 @@
+# Description: This file contains the document pipeline that extracts, chunks and caches document text so only relevant excerpts are sent to Gemini.
+import hashlib
+import logging
+import math
+import os
+import re
+from collections import Counter
+from io import BytesIO
+from vertexai.generative_models import Part
+from utils.attachments import download_bytes
+from utils.cache import LRUCache
+from utils.workers import run_in_process
+
+logger = logging.getLogger(__name__)
+
+DOCUMENT_CHUNK_CHARS = int(os.getenv('DOCUMENT_CHUNK_CHARS', 1500))
+# Characters of document excerpts sent with a question
+DOCUMENT_CONTEXT_CHARS = int(os.getenv('DOCUMENT_CONTEXT_CHARS', 12000))
+DOCUMENT_CACHE_SIZE = int(os.getenv('DOCUMENT_CACHE_SIZE', 64))
+DOCUMENT_CACHE_TTL = int(os.getenv('DOCUMENT_CACHE_TTL', 6 * 3600))
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Content hash -> list of text chunks
+document_chunks = LRUCache(DOCUMENT_CACHE_SIZE, ttl=DOCUMENT_CACHE_TTL)
+# Discord attachment id -> content hash, so follow-up questions don't download the document again
+document_digests = LRUCache(DOCUMENT_CACHE_SIZE * 4, ttl=DOCUMENT_CACHE_TTL)
+
+
+def extract_pdf_text(data):
+    """Extract the text of a PDF. Runs in a worker process."""
+    from pypdf import PdfReader
+
+    reader = PdfReader(BytesIO(data))
+    return "\n\n".join(page.extract_text() or '' for page in reader.pages)
+
+
+def chunk_text(text, size=DOCUMENT_CHUNK_CHARS):
+    """Split text into chunks of about 'size' characters, breaking on paragraphs where possible."""
+    chunks, current = [], ''
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        while len(paragraph) > size:
+            cut = paragraph.rfind(' ', 0, size)
+            cut = cut if cut > size // 2 else size
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(paragraph[:cut].strip())
+            paragraph = paragraph[cut:].strip()
+        if current and len(current) + len(paragraph) + 2 > size:
+            chunks.append(current)
+            current = ''
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def select_chunks(chunks, query, budget=DOCUMENT_CONTEXT_CHARS):
+    """Pick the chunks most relevant to the query within the character budget, in document order.
+
+    Chunks are scored by the TF-IDF overlap of their words with the query. Without a query, or when
+    nothing matches, the beginning of the document is used.
+    """
+    query_terms = set(WORD_PATTERN.findall((query or '').lower()))
+    chunk_terms = [Counter(WORD_PATTERN.findall(chunk.lower())) for chunk in chunks]
+    document_frequency = Counter(term for terms in chunk_terms for term in set(terms) & query_terms)
+
+    def score(index):
+        terms = chunk_terms[index]
+        return sum((1 + math.log(terms[term])) * math.log(1 + len(chunks) / document_frequency[term])
+                   for term in query_terms if terms[term])
+
+    scores = [score(index) for index in range(len(chunks))]
+    if any(scores):
+        order = sorted((index for index in range(len(chunks)) if scores[index] > 0), key=lambda index: -scores[index])
+    else:
+        order = range(len(chunks))
+
+    selected, used = [], 0
+    for index in order:
+        if used + len(chunks[index]) > budget:
+            if selected:
+                continue
+            # Always send something, even when a single chunk is over budget
+        selected.append(index)
+        used += len(chunks[index])
+    return [chunks[index] for index in sorted(selected)]
+
+
+async def load_document_chunks(attachment):
+    """Download and chunk a document once, caching the chunks by content hash.
+
+    Returns the content hash and the chunks; the chunks are empty when no text could be extracted.
+    """
+    digest = document_digests.get(attachment.id)
+    if digest is not None:
+        chunks = document_chunks.get(digest)
+        if chunks is not None:
+            return digest, chunks
+
+    data = await download_bytes(attachment.url)
+    digest = hashlib.sha256(data).hexdigest()
+    document_digests.set(attachment.id, digest)
+    chunks = document_chunks.get(digest)
+    if chunks is not None:
+        return digest, chunks
+
+    if attachment.content_type.startswith('text/plain'):
+        text = data.decode('utf-8', errors='replace')
+    else:
+        try:
+            text = await run_in_process(extract_pdf_text, data)
+        except Exception as e:
+            logger.warning(f"Failed to extract text from {attachment.filename}: {e}")
+            text = ''
+    chunks = chunk_text(text)
+    logger.info(f"Extracted {len(text)} characters in {len(chunks)} chunks from {attachment.filename}")
+    document_chunks.set(digest, chunks)
+    return digest, chunks
+
+
+async def document_to_parts(attachment, query):
+    """Build the parts for a document: its excerpts most relevant to the query.
+
+    Returns the parts and the content hash, or None when the document has no extractable text.
+    """
+    digest, chunks = await load_document_chunks(attachment)
+    if not chunks:
+        return None
+    excerpts = select_chunks(chunks, query)
+    logger.info(f"Sending {len(excerpts)} of {len(chunks)} chunks of {attachment.filename}")
+    text = "\n...\n".join(excerpts)
+    return [Part.from_text(f"DOCUMENT {attachment.filename} (excerpts):\n{text}")], digest
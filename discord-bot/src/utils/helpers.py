@@ -1,15 +1,25 @@
-from google.cloud import storage, vision
+from google.cloud import vision
 import os
+import asyncio
 import logging
-import aiohttp
-import vertexai
 from vertexai.generative_models import Part
+from utils.attachments import DownloadError, attachment_to_part, attachment_variant, delete_blob, discard_content, fetch_digest
+from utils.cache import LRUCache
+from utils.documents import document_to_parts
+from utils.response_cache import ResponseCache
+from utils.context import token_estimator
+from utils.prompt_cache import CACHE_EXPIRED_ERRORS, context_cache, is_cache_expired
+from utils.tts_cache import tts_cache
+from utils.resilience import resilience
+from utils.router import MODALITY_TOKENS, model_name, model_router
+from utils.scheduler import PRIORITY_BACKGROUND, PRIORITY_COMMAND, model_scheduler
 
 INSTRUCTIONS = {
     'freeform': "You are a helpful assistant. Please provide detailed and accurate responses. Keep your responses short like you are texting someone.",
     'image': "You are a helpful assistant. Please provide detailed and accurate responses. Keep your responses short like you are texting someone. The image is attached, please explain it to me.",
     'video': "You are a helpful assistant. Please provide detailed and accurate responses. Keep your responses short like you are texting someone. The video is attached, please explain it to me.",
     'document': "You are a helpful assistant. Please provide detailed and accurate responses. Keep your responses short like you are texting someone. The document is attached, please explain it to me.",
+    'attachments': "You are a helpful assistant. Please provide detailed and accurate responses. Keep your responses short like you are texting someone. The files are attached, please explain them to me.",
     'coach': (
         "Keep your responses short like you are texting someone. You are a videogame professional coach. You are watching a video of a player playing a game. "
         "Provide a detailed analysis of the player's gameplay. Include the player's strengths and weaknesses, and suggest ways to improve their gameplay. "
@@ -25,6 +35,65 @@ INSTRUCTIONS = {
 
 logger = logging.getLogger(__name__)
 
+async def generate_content(model, contents, message=None, priority=PRIORITY_COMMAND):
+    """Generates content with the async Vertex AI API once the scheduler admits the request.
+
+    Deadlines, retries and the circuit breaker apply, slow requests are hedged unless they run in the background.
+    """
+    async def call():
+        async with model_router.timed(model):
+            return await model.generate_content_async(contents)
+
+    admit = lambda: model_scheduler.slot_for(message, priority)
+    response = await resilience.call(model_name(model), call, hedge=priority != PRIORITY_BACKGROUND, admit=admit)
+    return response.text
+
+async def _stream_content(model, contents):
+    # Timed here, between chunks, so the time the consumer takes with each chunk isn't counted
+    timer = model_router.stream_timer(model)
+    try:
+        responses = await model.generate_content_async(contents, stream=True)
+        async for chunk in responses:
+            timer.chunk()
+            yield chunk.text
+            timer.resume()
+    except Exception:
+        timer.done(ok=False)
+        raise
+    timer.done()
+
+async def generate_content_stream(model, contents, message=None, priority=PRIORITY_COMMAND):
+    """Yields generated text as it streams from the async Vertex AI API once the scheduler admits the request.
+
+    Deadlines, retries and the circuit breaker apply, slow requests are hedged unless they run in the background.
+    """
+    open_stream = lambda: _stream_content(model, contents)
+    admit = lambda: model_scheduler.slot_for(message, priority)
+    async for chunk in resilience.stream(model_name(model), open_stream, hedge=priority != PRIORITY_BACKGROUND, admit=admit):
+        yield chunk
+
+async def generate_content_stream_with_prefix(route, prefix, contents, message=None, priority=PRIORITY_COMMAND):
+    """Yields generated text for a prompt made of a fixed prefix and a dynamic tail.
+
+    Only the tail is sent when the prefix is cached for the routed model. Otherwise, or when the
+    cached prefix turns out to have expired, the plain prompt is sent instead.
+    """
+    cached_model = await context_cache.model_for(route.name, prefix)
+    if cached_model is not None:
+        passed_on = False
+        try:
+            async for chunk in generate_content_stream(cached_model, contents, message, priority):
+                passed_on = True
+                yield chunk
+            return
+        except CACHE_EXPIRED_ERRORS as e:
+            if passed_on or not is_cache_expired(e):
+                raise
+            logger.warning(f"Cached prefix for {route.name} is unusable, sending the plain prompt: {e}")
+            context_cache.invalidate(route.name, prefix)
+    async for chunk in generate_content_stream(route.model, f"{prefix}\n{contents}", message, priority):
+        yield chunk
+
 def detect_safe_search_uri(uri):
     """Detects unsafe features in the file located in Google Cloud Storage or on the Web."""
     client = vision.ImageAnnotatorClient()
@@ -57,125 +126,194 @@ def detect_safe_search_uri(uri):
             "https://cloud.google.com/apis/design/errors".format(response.error.message)
         )
 
-async def gemini_image(ctx, model, bucket_name, prompt: str = None, dont_modify_prompt: bool = False):
-    """Interacts with the Gemini Vertex AI API for images"""
-    logger.info(f"{ctx.author} called the gemini_image function with prompt: {prompt}")
-    if ctx.message is None:
-        # Fetch the last message in the channel
-        async for msg in ctx.channel.history(limit=2):
-            if msg.id != ctx.message.id:
-                ctx.message = msg
-                break
-
-    if ctx.message is None:
-        return "No message found to extract image links from."
-
-    # Check for image attachments using MIME type
-    image_links = [(attachment.url, attachment.content_type) for attachment in ctx.message.attachments if attachment.content_type and attachment.content_type.startswith('image/')]
-
-    if not image_links:
-        return "No image links found in attachments."
-
-    image_link = image_links[0]
+ATTACHMENT_CACHE_SIZE = int(os.getenv('ATTACHMENT_CACHE_SIZE', 256))
+ATTACHMENT_CACHE_TTL = int(os.getenv('ATTACHMENT_CACHE_TTL', 3600))
+ATTACHMENT_CACHE_CLEAN_INTERVAL = 300
+# Maximum number of attachments of one message fetched and uploaded at the same time
+ATTACHMENT_CONCURRENCY = int(os.getenv('ATTACHMENT_CONCURRENCY', 4))
+
+def _delete_evicted_upload(digest, upload):
+    """Deletes the blobs of an uploaded attachment once it leaves the cache"""
+    _, blobs = upload
+    for blob in blobs:
+        asyncio.ensure_future(delete_blob(blob))
+
+# (content hash, preprocessing variant) -> (parts, blobs). Uploads outlive the request so reposts of the same file can reuse them.
+attachment_uploads = LRUCache(ATTACHMENT_CACHE_SIZE, ttl=ATTACHMENT_CACHE_TTL, on_evict=_delete_evicted_upload)
+# (content hash, instructions) -> generated response
+attachment_responses = LRUCache(ATTACHMENT_CACHE_SIZE, ttl=ATTACHMENT_CACHE_TTL)
+_attachment_cache_cleaner = None
+# Responses to preset prompts without attachments, such as the greeting or a meme
+prompt_responses = ResponseCache()
+
+async def _clean_attachment_cache():
+    """Background lifecycle cleaner that expires cached uploads (deleting their blobs) and responses, including preset responses"""
+    while True:
+        await asyncio.sleep(ATTACHMENT_CACHE_CLEAN_INTERVAL)
+        expired = attachment_uploads.expire() + attachment_responses.expire() + prompt_responses.expire()
+        if expired:
+            logger.info(f"Expired {expired} attachment cache entries")
+
+def _start_attachment_cache_cleaner():
+    global _attachment_cache_cleaner
+    if _attachment_cache_cleaner is None or _attachment_cache_cleaner.done():
+        _attachment_cache_cleaner = asyncio.get_running_loop().create_task(_clean_attachment_cache())
+
+def attachment_cache_stats():
+    """Returns the hit/miss counters of the attachment, preset response, prompt prefix and speech caches"""
+    return {'uploads': attachment_uploads.stats(), 'responses': attachment_responses.stats(), 'presets': prompt_responses.stats(),
+            'prefixes': context_cache.stats(), 'speech': tts_cache.stats()}
+
+async def prepare_attachment(message, attachment, bucket_name, digest, data, preset=None):
+    """Builds the Gemini parts for an attachment, reusing an earlier upload of the same content.
+
+    digest and data come from fetch_digest. On a hit nothing is preprocessed or uploaded again.
+    Returns the list of parts.
+    """
+    _start_attachment_cache_cleaner()
+    key = (digest, attachment_variant(attachment, preset))
+    cached = attachment_uploads.get(key)
+    if cached is not None:
+        return cached[0]
+
+    parts, blobs = await attachment_to_part(message, attachment, bucket_name, data, preset)
+    if not blobs:
+        return parts
+    if key in attachment_uploads:
+        # The same content was uploaded by another request in the meantime, keep that copy and drop ours
+        for blob in blobs:
+            asyncio.ensure_future(delete_blob(blob))
+        return attachment_uploads.get(key)[0]
+    attachment_uploads.set(key, (parts, blobs))
+    return parts
+
+def attachment_kind(attachment):
+    """Returns 'image', 'video' or 'document' for supported attachments, None otherwise"""
+    content_type = attachment.content_type
+    if not content_type:
+        return None
+    if content_type.startswith('image/'):
+        return 'image'
+    if content_type.startswith('video/'):
+        return 'video'
+    if content_type.startswith('application/pdf') or content_type.startswith('text/plain'):
+        return 'document'
+    return None
+
+def referenced_documents(message):
+    """Returns the documents attached to the message being replied to"""
+    reference = message.reference
+    referenced = reference.resolved if reference else None
+    return [attachment for attachment in getattr(referenced, 'attachments', []) if attachment_kind(attachment) == 'document']
+
+def get_custom_instructions(prompt, dont_modify_prompt, default_key):
+    """Returns the instructions sent alongside attachments"""
+    if dont_modify_prompt:
+        return prompt
+    if prompt:
+        return INSTRUCTIONS.get(prompt, f"{INSTRUCTIONS['freeform']} {prompt}")
+    return INSTRUCTIONS[default_key]
+
+async def fingerprint_attachments(attachments, query=None):
+    """Hashes the attachments concurrently, at most ATTACHMENT_CONCURRENCY at a time.
+
+    Returns a list of (digest, data, parts) in the order of the attachments. data is the content
+    returned by fetch_digest, release it with discard_fingerprints. parts are only built here for
+    documents.
+    """
+    semaphore = asyncio.Semaphore(ATTACHMENT_CONCURRENCY)
+
+    async def fingerprint(attachment):
+        async with semaphore:
+            if attachment_kind(attachment) == 'document':
+                # Documents are sent as the excerpts of their cached text most relevant to the query
+                prepared = await document_to_parts(attachment, query)
+                if prepared is not None:
+                    parts, digest = prepared
+                    return digest, None, parts
+                # No extractable text (e.g. a scanned PDF), send the file itself
+            digest, data = await fetch_digest(attachment)
+            return digest, data, None
+
+    results = await asyncio.gather(*(fingerprint(attachment) for attachment in attachments), return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        await discard_fingerprints([result for result in results if not isinstance(result, BaseException)])
+        raise errors[0]
+    return results
+
+async def discard_fingerprints(fingerprints):
+    """Deletes the temporary files of downloaded attachments"""
+    for _, data, _ in fingerprints:
+        await discard_content(data)
+
+async def prepare_attachments(message, attachments, fingerprints, bucket_name, preset=None):
+    """Preprocesses and uploads the fingerprinted attachments concurrently, at most ATTACHMENT_CONCURRENCY at a time.
+
+    Returns the list of parts of each attachment, in order.
+    """
+    semaphore = asyncio.Semaphore(ATTACHMENT_CONCURRENCY)
+
+    async def prepare(attachment, fingerprint):
+        digest, data, parts = fingerprint
+        if parts is not None:
+            return parts
+        async with semaphore:
+            return await prepare_attachment(message, attachment, bucket_name, digest, data, preset)
+
+    return await asyncio.gather(*(prepare(attachment, fingerprint) for attachment, fingerprint in zip(attachments, fingerprints)))
+
+async def stream_attachments_response(models, message, attachments, bucket_name, prompt: str = None, dont_modify_prompt: bool = False, priority=PRIORITY_COMMAND):
+    """Sends every attachment in one multimodal request and yields the response as it streams.
+
+    The model is picked by the router from the heaviest kind of attachment. Responses are cached
+    per (attachment contents, instructions, model) and looked up before anything is preprocessed
+    or uploaded.
+    """
+    kinds = [attachment_kind(attachment) for attachment in attachments]
+    default_key = kinds[0] if len(set(kinds)) == 1 else 'attachments'
+    modality = next(kind for kind in ('video', 'document', 'image') if kind in kinds)
+    custom_instructions = get_custom_instructions(prompt, dont_modify_prompt, default_key)
+    # Named presets such as 'coach' decide how videos are preprocessed
+    preset = prompt if prompt in INSTRUCTIONS and not dont_modify_prompt else None
 
     try:
-        # Download the image file
-        async with aiohttp.ClientSession() as session:
-            async with session.get(image_link[0]) as response:
-                if response.status == 200:
-                    image_path = f"temp_image_{ctx.message.id}.{image_link[1].split('/')[-1]}"
-                    with open(image_path, 'wb') as f:
-                        f.write(await response.read())
-                else:
-                    return "Failed to download the image."
-
-        # Upload the image file to Google Cloud Storage
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(os.path.basename(image_path))
-        blob.upload_from_filename(image_path)
-        gcs_uri = f"gs://{bucket_name}/{blob.name}"
-
-        # Use the GCS URI with Vertex AI
-        image_file = Part.from_uri(gcs_uri, image_link[1])
-        if dont_modify_prompt:
-            custom_instructions = prompt
-        else:
-            if prompt:
-                custom_instructions = INSTRUCTIONS.get(prompt, f"{INSTRUCTIONS['freeform']} { prompt}")
-            else:
-                custom_instructions = INSTRUCTIONS['image']
-        response = model.generate_content([image_file, custom_instructions]).text
-
-        # Clean up the downloaded file and delete from GCS
-        os.remove(image_path)
-        blob.delete()
-
-        return response
+        fingerprints = await fingerprint_attachments(attachments, query=prompt)
+    except DownloadError:
+        yield "Failed to download the attachments."
+        return
     except Exception as e:
-        return f"Error: {str(e)}"
-
-async def gemini_video(ctx, model, bucket_name, prompt: str = None, dont_modify_prompt: bool = False):
-    """Interacts with the Gemini Vertex AI API for videos"""
-    logger.info(f"{ctx.author} called the gemini_video function with prompt: {prompt}")
-    if ctx.message is None:
-        # Fetch the last message in the channel
-        async for msg in ctx.channel.history(limit=2):
-            if msg.id != ctx.message.id:
-                ctx.message = msg
-                break
-
-    if ctx.message is None:
-        return "No message found to extract video links from."
-
-    # Check for video attachments using MIME type
-    video_links = [(attachment.url, attachment.content_type) for attachment in ctx.message.attachments if attachment.content_type and attachment.content_type.startswith('video/')]
-
-    if not video_links:
-        return "No video links found in attachments."
-
-    video_link = video_links[0]
+        yield f"Error: {str(e)}"
+        return
+
+    tokens = token_estimator.estimate(custom_instructions) + MODALITY_TOKENS[modality] * (len(kinds) - 1)
+    route = models.route(priority, modality, tokens, preset)
+    key = (tuple(digest for digest, _, _ in fingerprints), custom_instructions, route.name)
+    response = attachment_responses.get(key)
+    if response is not None:
+        await discard_fingerprints(fingerprints)
+        logger.info(f"Attachment response cache hit for {len(fingerprints)} attachment(s)")
+        yield response
+        return
 
     try:
-        # Download the video file
-        async with aiohttp.ClientSession() as session:
-            async with session.get(video_link[0]) as response:
-                if response.status == 200:
-                    video_path = f"temp_video.{video_link[1].split('/')[-1]}"
-                    with open(video_path, 'wb') as f:
-                        f.write(await response.read())
-                else:
-                    return "Failed to download the video."
-
-        # Upload the video file to Google Cloud Storage
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(os.path.basename(video_path))
-        blob.upload_from_filename(video_path)
-        gcs_uri = f"gs://{bucket_name}/{blob.name}"
-
-        # Use the GCS URI with Vertex AI
-        video_file = Part.from_uri(gcs_uri, video_link[1])
-        if dont_modify_prompt:
-            custom_instructions = prompt
-        else:
-            if prompt:
-                custom_instructions = INSTRUCTIONS.get(prompt, f"{INSTRUCTIONS['freeform']} { prompt}")
-            else:
-                custom_instructions = INSTRUCTIONS['video']
-        response = model.generate_content([video_file, custom_instructions]).text
-
-        # Clean up the downloaded file and delete from GCS
-        os.remove(video_path)
-        blob.delete()
-
-        return response
+        prepared = await prepare_attachments(message, attachments, fingerprints, bucket_name, preset)
     except Exception as e:
-        return f"Error: {str(e)}"
+        yield f"Error: {str(e)}"
+        return
+    finally:
+        await discard_fingerprints(fingerprints)
 
-async def gemini_document(ctx, model, prompt: str = None, dont_modify_prompt: bool = False):
-    """Interacts with the Gemini Vertex AI API for documents"""
-    logger.info(f"{ctx.author} called the gemini_document function with prompt: {prompt}")
+    text_response = []
+    contents = [part for parts in prepared for part in parts] + [custom_instructions]
+    async for chunk in generate_content_stream(route.model, contents, message, priority):
+        text_response.append(chunk)
+        yield chunk
+    attachment_responses.set(key, ''.join(text_response))
+
+async def gemini_attachments(ctx, models, bucket_name, kind, prompt: str = None, dont_modify_prompt: bool = False):
+    """Interacts with the Gemini Vertex AI API for every attachment of the given kind"""
+    logger.info(f"{ctx.author} called the gemini_{kind} function with prompt: {prompt}")
     if ctx.message is None:
         # Fetch the last message in the channel
         async for msg in ctx.channel.history(limit=2):
@@ -184,53 +322,86 @@ async def gemini_document(ctx, model, prompt: str = None, dont_modify_prompt: bo
                 break
 
     if ctx.message is None:
-        return "No message found to extract document links from."
-
-    # Check for document attachments using MIME type
-    document_links = [(attachment.url, attachment.content_type) for attachment in ctx.message.attachments if attachment.content_type and (attachment.content_type.startswith('application/pdf') or attachment.content_type.startswith('text/plain'))]
+        return f"No message found to extract {kind} links from."
 
-    if not document_links:
-        return "No document links found in attachments."
+    # Check for attachments using MIME type
+    attachments = [attachment for attachment in ctx.message.attachments if attachment_kind(attachment) == kind]
 
-    document_link = document_links[0]
+    if not attachments:
+        return f"No {kind} links found in attachments."
 
     try:
-        document_file = Part.from_uri(document_link[0], document_link[1])
-        if dont_modify_prompt:
-            custom_instructions = prompt
-        else:
-            if prompt:
-                custom_instructions = INSTRUCTIONS.get(prompt, f"{INSTRUCTIONS['freeform']} {prompt}")
-            else:
-                custom_instructions = INSTRUCTIONS['document']
-        response = model.generate_content([document_file, custom_instructions]).text
-        return response
+        text_response = []
+        async for chunk in stream_attachments_response(models, ctx.message, attachments, bucket_name, prompt, dont_modify_prompt):
+            text_response.append(chunk)
+        return ''.join(text_response)
     except Exception as e:
         return f"Error: {str(e)}"
 
-async def process_and_generate_response(ctx, model, bucket_name, prompt: str = None, dont_modify_prompt: bool = False):
-    """Processes attachments and generates a response using the Gemini Vertex AI API"""
-    # Check for image, video, or document links
-    image_links = [(attachment.url, attachment.content_type) for attachment in ctx.message.attachments if attachment.content_type and attachment.content_type.startswith('image/')]
-    video_links = [(attachment.url, attachment.content_type) for attachment in ctx.message.attachments if attachment.content_type and attachment.content_type.startswith('video/')]
-    document_links = [(attachment.url, attachment.content_type) for attachment in ctx.message.attachments if attachment.content_type and (attachment.content_type.startswith('application/pdf') or attachment.content_type.startswith('text/plain'))]
-
-    if image_links:
-        return await gemini_image(ctx, model, bucket_name, prompt=prompt, dont_modify_prompt=dont_modify_prompt)
-    if video_links:
-        return await gemini_video(ctx, model, bucket_name, prompt=prompt, dont_modify_prompt=dont_modify_prompt)
-    if document_links:
-        return await gemini_document(ctx, model, prompt=prompt, dont_modify_prompt=dont_modify_prompt)
+async def gemini_image(ctx, models, bucket_name, prompt: str = None, dont_modify_prompt: bool = False):
+    """Interacts with the Gemini Vertex AI API for images"""
+    return await gemini_attachments(ctx, models, bucket_name, 'image', prompt=prompt, dont_modify_prompt=dont_modify_prompt)
+
+async def gemini_video(ctx, models, bucket_name, prompt: str = None, dont_modify_prompt: bool = False):
+    """Interacts with the Gemini Vertex AI API for videos"""
+    return await gemini_attachments(ctx, models, bucket_name, 'video', prompt=prompt, dont_modify_prompt=dont_modify_prompt)
+
+async def gemini_document(ctx, models, prompt: str = None, dont_modify_prompt: bool = False):
+    """Interacts with the Gemini Vertex AI API for documents"""
+    return await gemini_attachments(ctx, models, None, 'document', prompt=prompt, dont_modify_prompt=dont_modify_prompt)
+
+async def stream_and_generate_response(ctx, models, bucket_name, prompt: str = None, dont_modify_prompt: bool = False, priority=PRIORITY_COMMAND, cacheable: bool = False, prefix: str = None):
+    """Processes attachments and yields the response text as the Gemini Vertex AI API produces it
+
+    With cacheable set, responses to enabled presets without attachments are served from the response cache.
+    A prefix is the fixed start of the prompt, it is sent as cached context when possible.
+    """
+    # Every supported attachment on the message goes into a single multimodal request
+    attachments = [attachment for attachment in ctx.message.attachments if attachment_kind(attachment)]
+    if not attachments:
+        # Follow-up questions that reply to a document reuse its cached text
+        attachments = referenced_documents(ctx.message)
+    if attachments:
+        if prefix is not None:
+            # Attachment requests are built per message, so the prefix goes into the prompt
+            prompt = f"{prefix}\n{prompt}"
+        async for chunk in stream_attachments_response(models, ctx.message, attachments, bucket_name, prompt, dont_modify_prompt, priority):
+            yield chunk
+        return
 
     # If no attachments, proceed with text prompt
+    preset = prompt_responses.preset_for(prompt) if cacheable else None
     prompt = prompt or INSTRUCTIONS['greeting']
-    chat_session = model.start_chat()
     if dont_modify_prompt:
         custom_instructions = prompt
     else:
         custom_instructions = f"{INSTRUCTIONS['freeform']} {prompt}"
+    if prefix is not None:
+        route = models.route(priority, 'text', token_estimator.estimate(prefix) + token_estimator.estimate(custom_instructions))
+        async for chunk in generate_content_stream_with_prefix(route, prefix, custom_instructions, ctx.message, priority):
+            yield chunk
+        return
+    route = models.route(priority, 'text', token_estimator.estimate(custom_instructions))
+
+    cache_key = None
+    if preset is not None:
+        cache_key = prompt_responses.key('' if dont_modify_prompt else INSTRUCTIONS['freeform'], prompt, route.name)
+        cached = prompt_responses.get(cache_key)
+        if cached is not None:
+            logger.info(f"Serving cached response for preset prompt: {prompt}")
+            yield cached
+            return
+    text_response = []
+    async for chunk in generate_content_stream(route.model, custom_instructions, ctx.message, priority):
+        text_response.append(chunk)
+        yield chunk
+    if cache_key is not None:
+        _start_attachment_cache_cleaner()
+        prompt_responses.add(cache_key, ''.join(text_response))
+
+async def process_and_generate_response(ctx, models, bucket_name, prompt: str = None, dont_modify_prompt: bool = False, priority=PRIORITY_COMMAND, cacheable: bool = False, prefix: str = None):
+    """Processes attachments and generates a response using the Gemini Vertex AI API"""
     text_response = []
-    responses = chat_session.send_message(custom_instructions, stream=True)
-    for chunk in responses:
-        text_response.append(chunk.text)
+    async for chunk in stream_and_generate_response(ctx, models, bucket_name, prompt=prompt, dont_modify_prompt=dont_modify_prompt, priority=priority, cacheable=cacheable, prefix=prefix):
+        text_response.append(chunk)
     return ''.join(text_response)
\ No newline at end of file
@@ -0,0 +1,176 @@
+# Description: This file contains the ChannelHistoryStore class, a shared in-memory history of recent messages per channel.
+import asyncio
+import logging
+import os
+from collections import deque
+import discord
+from utils.state import state_store
+
+logger = logging.getLogger(__name__)
+
+HISTORY_MAX_MESSAGES = int(os.getenv('HISTORY_MAX_MESSAGES', 100))
+
+
+class HistoryEntry:
+    """A single message kept in a channel history."""
+    __slots__ = ('message_id', 'author', 'content', 'tokens')
+
+    def __init__(self, message_id, author, content):
+        self.message_id = message_id
+        self.author = author
+        self.content = content
+        self.tokens = None  # Cached token estimate, see utils.context
+
+    @property
+    def line(self):
+        return f"{self.author}: {self.content}"
+
+
+class ChannelHistoryStore:
+    """Bounded ring buffer of recent messages per (guild, channel).
+
+    A channel is seeded the first time it is used and is kept current from gateway events
+    afterwards, so building a prompt never needs a network call. Seeding loads the channel from
+    the state store and only fetches the messages sent since from REST; a channel that was never
+    stored is seeded from REST alone. Every change is written back to the state store.
+    """
+
+    def __init__(self, max_messages=HISTORY_MAX_MESSAGES, store=state_store):
+        self.max_messages = max_messages
+        self.store = store
+        self._buffers = {}  # (guild_id, channel_id) -> deque of HistoryEntry
+        self._index = {}  # (guild_id, channel_id) -> {message_id: HistoryEntry}
+        self._seed_locks = {}
+        self._bots = set()
+        self._evict_listeners = []
+        self._change_listeners = []
+
+    def attach(self, bot):
+        """Register the gateway listeners that keep the store current. Safe to call from several cogs."""
+        if id(bot) in self._bots:
+            return
+        self._bots.add(id(bot))
+        bot.add_listener(self._on_message, 'on_message')
+        bot.add_listener(self._on_raw_message_edit, 'on_raw_message_edit')
+        bot.add_listener(self._on_raw_message_delete, 'on_raw_message_delete')
+
+    def add_evict_listener(self, callback):
+        """Call callback(key, entry) for every entry pushed out of a full channel history."""
+        self._evict_listeners.append(callback)
+
+    def add_change_listener(self, callback):
+        """Call callback(key, message_id, content) for every edited message, with content None once deleted.
+
+        Listeners hear about every edit and delete in the guild, whether the message is still tracked or not.
+        """
+        self._change_listeners.append(callback)
+
+    @staticmethod
+    def key_for(channel):
+        return (channel.guild.id, channel.id)
+
+    def is_tracked(self, channel):
+        return self.key_for(channel) in self._buffers
+
+    async def ensure_seeded(self, channel):
+        """Seed the channel from the state store and REST history the first time it is seen."""
+        key = self.key_for(channel)
+        if key in self._buffers:
+            return
+        lock = self._seed_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if key in self._buffers:
+                return
+            rows = await self.store.load_messages(key, self.max_messages)
+            buffer, index = deque(), {}
+            for message_id, author, content in rows:
+                entry = HistoryEntry(message_id, author, content)
+                buffer.append(entry)
+                index[message_id] = entry
+            after = discord.Object(rows[-1][0]) if rows else None
+            logger.info(f"Seeding conversation history for channel: {channel.name}, stored: {len(rows)}, limit: {self.max_messages}")
+            messages = [message async for message in channel.history(limit=self.max_messages, after=after, oldest_first=False)]
+            self._buffers[key] = buffer
+            self._index[key] = index
+            for message in sorted(messages, key=lambda message: message.id):  # Ensure the messages are in chronological order
+                self._append(key, message)
+        self._seed_locks.pop(key, None)
+
+    def append(self, message):
+        """Add a message to its channel history. Messages already present are ignored."""
+        key = self.key_for(message.channel)
+        if key in self._buffers:
+            self._append(key, message)
+
+    def _append(self, key, message):
+        index = self._index[key]
+        if message.id in index:
+            return
+        buffer = self._buffers[key]
+        if len(buffer) >= self.max_messages:
+            evicted = buffer.popleft()
+            index.pop(evicted.message_id, None)
+            self.store.delete_message(key, evicted.message_id)
+            for callback in self._evict_listeners:
+                callback(key, evicted)
+        entry = HistoryEntry(message.id, message.author.name, message.content)
+        buffer.append(entry)
+        index[message.id] = entry
+        self.store.append_message(key, entry)
+
+    def edit(self, key, message_id, content):
+        entry = self._index.get(key, {}).get(message_id)
+        if entry is not None:
+            entry.content = content
+            entry.tokens = None
+            self.store.edit_message(key, message_id, content)
+        self._notify_change(key, message_id, content)
+
+    def delete(self, key, message_id):
+        entry = self._index.get(key, {}).pop(message_id, None)
+        if entry is not None:
+            self._buffers[key].remove(entry)
+            self.store.delete_message(key, message_id)
+        self._notify_change(key, message_id, None)
+
+    def _notify_change(self, key, message_id, content):
+        for callback in self._change_listeners:
+            callback(key, message_id, content)
+
+    def reset(self, channel):
+        """Forget the channel history. Only messages sent from now on are tracked."""
+        key = self.key_for(channel)
+        self._buffers[key] = deque()
+        self._index[key] = {}
+        self.store.clear_messages(key)
+
+    def entries(self, channel, limit=None):
+        """Return the tracked entries for a channel, oldest first."""
+        buffer = self._buffers.get(self.key_for(channel), ())
+        entries = list(buffer)
+        if limit is not None:
+            entries = entries[-limit:] if limit > 0 else []
+        return entries
+
+    def lines(self, channel, limit=None):
+        """Return the tracked messages for a channel formatted as 'author: content'."""
+        return [entry.line for entry in self.entries(channel, limit)]
+
+    async def _on_message(self, message):
+        if message.guild is None:
+            return
+        self.append(message)
+
+    async def _on_raw_message_edit(self, payload):
+        if payload.guild_id is None or 'content' not in payload.data:
+            return
+        self.edit((payload.guild_id, payload.channel_id), payload.message_id, payload.data['content'])
+
+    async def _on_raw_message_delete(self, payload):
+        if payload.guild_id is None:
+            return
+        self.delete((payload.guild_id, payload.channel_id), payload.message_id)
+
+
+# Shared by every cog so a channel is only ever seeded once
+history_store = ChannelHistoryStore()
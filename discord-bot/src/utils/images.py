@@ -0,0 +1,61 @@
+# Description: This file contains the image preprocessing stage that shrinks images before they are sent to Gemini.
+# The functions here run in worker processes, so they must stay picklable and free of event loop state.
+import os
+from io import BytesIO
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+IMAGE_PREPROCESS = os.getenv('IMAGE_PREPROCESS', 'True').lower() == 'true'
+IMAGE_MAX_EDGE = int(os.getenv('IMAGE_MAX_EDGE', 1536))
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'WEBP').upper()  # WEBP or JPEG
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 80))
+GIF_SAMPLE_FRAMES = int(os.getenv('GIF_SAMPLE_FRAMES', 4))
+
+MIME_TYPES = {'WEBP': 'image/webp', 'JPEG': 'image/jpeg'}
+
+
+def sample_indices(frame_count, samples):
+    """Evenly spaced frame indices, always including the first frame."""
+    if frame_count <= samples:
+        return list(range(frame_count))
+    step = frame_count / samples
+    return [int(i * step) for i in range(samples)]
+
+
+def encode_frame(frame):
+    """Downscale a frame to IMAGE_MAX_EDGE and re-encode it without metadata."""
+    frame.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+    if IMAGE_FORMAT == 'JPEG':
+        frame = frame.convert('RGB')
+    elif frame.mode not in ('RGB', 'RGBA'):
+        frame = frame.convert('RGBA')
+    output = BytesIO()
+    # Saving a fresh frame without exif/icc arguments drops the original metadata
+    frame.save(output, format=IMAGE_FORMAT, quality=IMAGE_QUALITY)
+    return output.getvalue(), MIME_TYPES[IMAGE_FORMAT]
+
+
+def preprocess_image(data, content_type):
+    """Shrink an image for Gemini.
+
+    Returns a list of (bytes, mime type); animated images are turned into a few sampled frames.
+    Images Pillow can't read, or that would not get smaller, are returned unchanged.
+    """
+    try:
+        with Image.open(BytesIO(data)) as image:
+            frame_count = getattr(image, 'n_frames', 1)
+            if frame_count > 1:
+                frames = []
+                for index in sample_indices(frame_count, GIF_SAMPLE_FRAMES):
+                    image.seek(index)
+                    frames.append(encode_frame(image.convert('RGBA')))
+                return frames
+
+            resized = max(image.size) > IMAGE_MAX_EDGE
+            # Apply the EXIF orientation before the metadata is dropped
+            encoded = encode_frame(ImageOps.exif_transpose(image).copy())
+    except (UnidentifiedImageError, OSError, ValueError):
+        return [(data, content_type)]
+
+    if not resized and len(encoded[0]) >= len(data):
+        return [(data, content_type)]
+    return [encoded]
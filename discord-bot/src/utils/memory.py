@@ -0,0 +1,294 @@
+# Description: This file contains the MemoryIndex class, a per-channel long-term memory of old messages searched by embedding similarity.
+import asyncio
+import logging
+import os
+import re
+import zlib
+import numpy as np
+from utils.context import truncate_to_tokens
+from utils.history import HistoryEntry
+from utils.scheduler import PRIORITY_AMBIENT, PRIORITY_BACKGROUND, model_scheduler
+from utils.state import state_store
+from utils.workers import run_blocking
+
+logger = logging.getLogger(__name__)
+
+# 'vertex' for the Vertex AI embedding model, 'hashing' for the local embedder that needs no network
+MEMORY_EMBEDDER = os.getenv('MEMORY_EMBEDDER', 'vertex')
+MEMORY_EMBEDDING_MODEL = os.getenv('MEMORY_EMBEDDING_MODEL', 'text-embedding-004')
+# Directory of the memory-mapped vector files, empty keeps the vectors in RAM only
+MEMORY_DIR = os.getenv('MEMORY_DIR', 'data/memory')
+# Messages remembered per channel, the oldest are forgotten first
+MEMORY_MAX_ENTRIES = int(os.getenv('MEMORY_MAX_ENTRIES', 5000))
+# Old messages pulled into each prompt, and how similar they must be to the new message
+MEMORY_TOP_K = int(os.getenv('MEMORY_TOP_K', 4))
+MEMORY_MIN_SCORE = float(os.getenv('MEMORY_MIN_SCORE', 0.55))
+# Tokens each recalled message is cut down to
+MEMORY_LINE_TOKENS = 80
+# Messages embedded per request
+MEMORY_EMBED_BATCH = 32
+
+WORD_PATTERN = re.compile(r"\w+")
+MEMORY_FILE = re.compile(r"(\d+)-(\d+)\.npy")
+
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-9)
+
+
+class VertexEmbedder:
+    """Embeds text with a Vertex AI text embedding model."""
+    dimensions = 768
+
+    def __init__(self, model_name=MEMORY_EMBEDDING_MODEL):
+        self.model_name = model_name
+        self._model = None
+
+    async def embed(self, texts, query=False):
+        from vertexai.language_models import TextEmbeddingInput, TextEmbeddingModel
+        if self._model is None:
+            self._model = TextEmbeddingModel.from_pretrained(self.model_name)
+        task = 'RETRIEVAL_QUERY' if query else 'RETRIEVAL_DOCUMENT'
+        embeddings = await self._model.get_embeddings_async([TextEmbeddingInput(text, task) for text in texts],
+                                                            output_dimensionality=self.dimensions)
+        return normalize_rows([embedding.values for embedding in embeddings])
+
+
+class HashingEmbedder:
+    """Deterministic bag-of-words embedder that runs locally, for offline use and tests."""
+    dimensions = 256
+
+    async def embed(self, texts, query=False):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in WORD_PATTERN.findall(text.lower()):
+                digest = zlib.crc32(word.encode())
+                vectors[row, digest % self.dimensions] += 1.0 if digest & 0x80000000 else -1.0
+        return normalize_rows(vectors)
+
+
+EMBEDDERS = {'vertex': VertexEmbedder, 'hashing': HashingEmbedder}
+
+
+class ChannelMemory:
+    """Fixed-size matrix of unit vectors with the message each row came from.
+
+    Free rows, never used or forgotten, are filled first; once there are none the row of the
+    oldest message is reused.
+    """
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+        capacity = len(vectors)
+        self.message_ids = np.zeros(capacity, dtype=np.int64)  # 0 marks a free row
+        self.lines = [None] * capacity
+        self.count = 0
+        self.used = 0  # Rows below this may hold a message, search stops there
+
+    def restore(self, rows):
+        for slot, message_id, line in rows:
+            if slot < len(self.lines):
+                self.message_ids[slot] = message_id
+                self.lines[slot] = line
+        self.count = sum(line is not None for line in self.lines)
+        self.used = max((slot + 1 for slot, line in enumerate(self.lines) if line is not None), default=0)
+
+    def add(self, vector, message_id, line):
+        slot = int(np.argmin(self.message_ids))  # A free row if any, otherwise the oldest message
+        if self.lines[slot] is None:
+            self.count += 1
+        self.vectors[slot] = vector
+        self.message_ids[slot] = message_id
+        self.lines[slot] = line
+        self.used = max(self.used, slot + 1)
+        return slot
+
+    def slot_of(self, message_id):
+        slots = np.flatnonzero(self.message_ids[:self.used] == message_id)
+        return int(slots[0]) if len(slots) else None
+
+    def remove(self, slot):
+        """Forget a row, its vector is zeroed so nothing of the message is left behind."""
+        self.vectors[slot] = 0.0
+        self.message_ids[slot] = 0
+        self.lines[slot] = None
+        self.count -= 1
+
+    def search(self, query, k, min_score):
+        """Return the rows of the k most similar vectors above min_score, oldest message first."""
+        if not self.count:
+            return []
+        scores = self.vectors[:self.used] @ query
+        scores[self.message_ids[:self.used] == 0] = -np.inf
+        k = min(k, self.count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[scores[top] >= min_score]
+        return sorted(top.tolist(), key=lambda slot: self.message_ids[slot])
+
+
+class MemoryIndex:
+    """Long-term memory of the messages that fall out of the channel histories.
+
+    Evicted messages are embedded in batches in the background and written to a memory-mapped
+    matrix per channel, with their text kept in the state store. Each turn embeds the new message
+    and pulls the few most similar old messages into the prompt, so recall reaches far back
+    without the prompt growing. Deleted messages are forgotten and edited ones embedded again,
+    so nothing that was taken back can be recalled.
+    """
+
+    def __init__(self, embedder=None, capacity=MEMORY_MAX_ENTRIES, directory=MEMORY_DIR, store=state_store):
+        self.embedder = embedder or EMBEDDERS[MEMORY_EMBEDDER]()
+        self.capacity = capacity
+        self.directory = directory
+        self.store = store
+        self._channels = {}  # (guild_id, channel_id) -> ChannelMemory
+        self._load_locks = {}
+        self._pending = []  # (key, HistoryEntry) waiting to be embedded
+        self._embedding = {}  # (key, message id) -> HistoryEntry of the batch being embedded
+        self._stale = set()  # Messages of that batch deleted or edited meanwhile
+        self._stored = set()  # Channels not loaded yet that have memories on disk
+        self._worker = None
+
+    def attach(self, history):
+        self._stored = self._stored_channels()
+        history.add_evict_listener(self._on_evict)
+        history.add_change_listener(self._on_change)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key[0]}-{key[1]}.npy")
+
+    def _stored_channels(self):
+        """Return the channels with a vector file, only their memories are restored and can be stale."""
+        if not self.directory or not os.path.isdir(self.directory):
+            return set()
+        stored = set()
+        for name in os.listdir(self.directory):
+            match = MEMORY_FILE.fullmatch(name)
+            if match:
+                stored.add((int(match.group(1)), int(match.group(2))))
+        return stored
+
+    def _open_vectors(self, key):
+        """Return the vector matrix of a channel and whether it holds earlier vectors."""
+        shape = (self.capacity, self.embedder.dimensions)
+        if not self.directory:
+            return np.zeros(shape, dtype=np.float32), False
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        if os.path.exists(path):
+            vectors = np.load(path, mmap_mode='r+')
+            if vectors.shape == shape and vectors.dtype == np.float32:
+                return vectors, True
+            # The embedder or capacity changed, the old vectors can't be compared with new ones
+            logger.warning(f"Discarding memory file {path} with shape {vectors.shape}, expected {shape}")
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape), False
+
+    async def ensure_loaded(self, channel):
+        """Load the channel memory the first time the channel is seen. Only loaded channels are remembered."""
+        key = (channel.guild.id, channel.id)
+        if key in self._channels:
+            return
+        lock = self._load_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if key in self._channels:
+                return
+            vectors, restored = await run_blocking(self._open_vectors, key)
+            memory = ChannelMemory(vectors)
+            if restored:
+                memory.restore(await self.store.load_memories(key))
+            else:
+                self.store.clear_memories(key)
+            self._channels[key] = memory
+            self._stored.discard(key)
+            logger.info(f"Loaded {memory.count} memories for channel {channel.name}")
+        self._load_locks.pop(key, None)
+
+    def _on_evict(self, key, entry):
+        if key not in self._channels or not entry.content.strip():
+            return
+        self._pending.append((key, entry))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._embed_pending())
+
+    def _on_change(self, key, message_id, content):
+        """Forget a deleted or edited message, an edited one is embedded again with its new content."""
+        author = None
+        for pending in self._pending:
+            if pending[0] == key and pending[1].message_id == message_id:
+                self._pending.remove(pending)
+                author = pending[1].author
+                break
+        in_flight = self._embedding.get((key, message_id))
+        if in_flight is not None:
+            self._stale.add((key, message_id))
+            author = in_flight.author
+        memory = self._channels.get(key)
+        if memory is None:
+            if key in self._stored:
+                # Not loaded yet, a row whose line is gone from the store isn't restored
+                self.store.delete_memory(key, message_id)
+        else:
+            slot = memory.slot_of(message_id)
+            if slot is not None:
+                author = memory.lines[slot].split(': ', 1)[0]
+                if content is not None and memory.lines[slot] == f"{author}: {content}":
+                    return  # Only embeds or attachments changed
+                self._forget(key, memory, slot)
+        if content is not None and content.strip() and author is not None:
+            self._on_evict(key, HistoryEntry(message_id, author, content))
+
+    def _forget(self, key, memory, slot):
+        self.store.delete_memory(key, int(memory.message_ids[slot]))
+        memory.remove(slot)
+        if isinstance(memory.vectors, np.memmap):
+            memory.vectors.flush()
+
+    async def _embed_pending(self):
+        while self._pending:
+            batch, self._pending = self._pending[:MEMORY_EMBED_BATCH], self._pending[MEMORY_EMBED_BATCH:]
+            self._embedding = {(key, entry.message_id): entry for key, entry in batch}
+            try:
+                async with model_scheduler.slot(PRIORITY_BACKGROUND, batch[0][0][0]):
+                    vectors = await self.embedder.embed([entry.line for _, entry in batch])
+            except Exception as e:
+                logger.error(f"Failed to embed {len(batch)} messages for long-term memory: {e}")
+                continue
+            finally:
+                stale, self._stale, self._embedding = self._stale, set(), {}
+            touched = set()
+            for (key, entry), vector in zip(batch, vectors):
+                memory = self._channels.get(key)
+                if memory is None or (key, entry.message_id) in stale:
+                    continue  # Reset, deleted or edited while embedding
+                slot = memory.add(vector, entry.message_id, entry.line)
+                self.store.put_memory(key, slot, entry.message_id, entry.line)
+                touched.add(key)
+            for key in touched:
+                if isinstance(self._channels[key].vectors, np.memmap):
+                    self._channels[key].vectors.flush()
+
+    async def recall(self, channel, query, k=MEMORY_TOP_K, min_score=MEMORY_MIN_SCORE):
+        """Return the remembered lines most similar to the query, oldest first."""
+        memory = self._channels.get((channel.guild.id, channel.id))
+        if memory is None or not memory.count or not query.strip():
+            return []
+        try:
+            async with model_scheduler.slot(PRIORITY_AMBIENT, channel.guild.id):
+                vectors = await self.embedder.embed([query], query=True)
+        except Exception as e:
+            logger.error(f"Failed to embed the memory query for channel {channel.name}: {e}")
+            return []
+        slots = memory.search(vectors[0], k, min_score)
+        logger.info(f"Recalled {len(slots)} of {memory.count} memories for channel {channel.name}")
+        return [truncate_to_tokens(memory.lines[slot], MEMORY_LINE_TOKENS) for slot in slots]
+
+    def reset(self, channel):
+        key = (channel.guild.id, channel.id)
+        if self._channels.pop(key, None) is None:
+            return
+        self._pending = [(pending_key, entry) for pending_key, entry in self._pending if pending_key != key]
+        if self.directory and os.path.exists(self._path(key)):
+            os.remove(self._path(key))
+        self.store.clear_memories(key)
@@ -0,0 +1,139 @@
+# Description: This file contains the PlaybackQueue class, which plays audio in each guild one source after another without polling.
+import asyncio
+import logging
+from collections import deque
+import discord
+
+logger = logging.getLogger(__name__)
+
+
+class QueueItem:
+    __slots__ = ('voice_client', 'source', 'after')
+
+    def __init__(self, voice_client, source, after):
+        self.voice_client = voice_client
+        self.source = source
+        self.after = after
+
+
+class GuildPlayback:
+    """Audio waiting to be played in one guild, and what is playing now."""
+    __slots__ = ('guild_id', 'items', 'current')
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.items = deque()
+        self.current = None
+
+
+class PlaybackQueue:
+    """Per-guild playback queues.
+
+    Enqueued sources are played in order. The next one is started from the after callback of
+    the voice client, so nothing waits or polls while audio plays. after(error) of an item is
+    called on the event loop once it has finished playing, was skipped or was cleared.
+    """
+
+    def __init__(self):
+        self._guilds = {}  # guild id -> GuildPlayback
+        self._idle_listeners = []
+        self.played = 0
+        self.skipped = 0
+        self.cleared = 0
+
+    def add_idle_listener(self, callback):
+        """Call callback(guild_id) whenever a guild's queue runs out of audio."""
+        self._idle_listeners.append(callback)
+
+    def _guild(self, guild_id):
+        if guild_id not in self._guilds:
+            self._guilds[guild_id] = GuildPlayback(guild_id)
+        return self._guilds[guild_id]
+
+    def enqueue(self, voice_client, source, after=None):
+        """Queue a source in the guild of the voice client and return how many items are ahead of it."""
+        guild = self._guild(voice_client.guild.id)
+        guild.items.append(QueueItem(voice_client, source, after))
+        ahead = len(guild.items) - 1 + (guild.current is not None)
+        if guild.current is None:
+            self._play_next(guild)
+        return ahead
+
+    def _play_next(self, guild):
+        loop = asyncio.get_running_loop()
+        while guild.items:
+            item = guild.items.popleft()
+            if not item.voice_client.is_connected():
+                self._drop(item)
+                continue
+            guild.current = item
+            try:
+                item.voice_client.play(item.source, after=lambda error: loop.call_soon_threadsafe(self._finished, guild, item, error))
+            except discord.ClientException as e:
+                logger.error(f"Failed to start playback: {e}")
+                guild.current = None
+                self._drop(item)
+                continue
+            return
+        for callback in self._idle_listeners:
+            callback(guild.guild_id)
+
+    def _finished(self, guild, item, error):
+        if error:
+            logger.error(f'Player error: {error}')
+        self.played += 1
+        if guild.current is item:
+            guild.current = None
+        self._call_after(item, error)
+        if guild.current is None:
+            self._play_next(guild)
+
+    def _drop(self, item):
+        item.source.cleanup()
+        self._call_after(item, None)
+
+    @staticmethod
+    def _call_after(item, error):
+        if item.after is not None:
+            try:
+                item.after(error)
+            except Exception as e:
+                logger.error(f"Playback callback failed: {e}")
+
+    def skip(self, guild):
+        """Stop what is playing in the guild, the next item starts. Returns whether anything was playing."""
+        current = self._guild(guild.id).current
+        if current is None:
+            return False
+        self.skipped += 1
+        current.voice_client.stop()
+        return True
+
+    def clear(self, guild):
+        """Drop everything queued in the guild and stop what is playing. Returns how many items were dropped."""
+        playback = self._guild(guild.id)
+        items, playback.items = list(playback.items), deque()
+        for item in items:
+            self._drop(item)
+        dropped = len(items) + (playback.current is not None)
+        if playback.current is not None:
+            playback.current.voice_client.stop()
+        self.cleared += dropped
+        return dropped
+
+    def is_idle(self, guild):
+        playback = self._guilds.get(guild.id)
+        return playback is None or (playback.current is None and not playback.items)
+
+    def stats(self):
+        return {
+            'playing': sum(playback.current is not None for playback in self._guilds.values()),
+            'queued': sum(len(playback.items) for playback in self._guilds.values()),
+            'played': self.played,
+            'skipped': self.skipped,
+            'cleared': self.cleared,
+        }
+
+
+# Shared by every cog so each guild has a single queue
+playback = PlaybackQueue()
@@ -0,0 +1,214 @@
+# Description: This file contains the ContextCache class, which registers the fixed prefixes of chat prompts once per model so requests only send their dynamic tail.
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import re
+import time
+from google.api_core import exceptions as google_exceptions
+from utils.context import token_estimator
+from utils.workers import run_blocking
+
+logger = logging.getLogger(__name__)
+
+# 'auto' caches prefixes on Vertex AI when they are long enough and registers shorter ones in process,
+# 'vertex' or 'local' use only that backend, 'off' sends every prompt in full
+CONTEXT_CACHE = os.getenv('CONTEXT_CACHE', 'auto')
+# Seconds a cached prefix lives, it is extended while it is still being used
+CONTEXT_CACHE_TTL = int(os.getenv('CONTEXT_CACHE_TTL', 3600))
+# Vertex AI rejects cached content below this many tokens
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv('CONTEXT_CACHE_MIN_TOKENS', 32768))
+# Extend a cached prefix when less than this many seconds of it are left
+CONTEXT_CACHE_REFRESH_MARGIN = 300
+# Seconds before a prefix that failed to cache is tried again
+CONTEXT_CACHE_RETRY = 600
+
+# Errors that may mean the cached content of a request expired or was deleted on the server
+CACHE_EXPIRED_ERRORS = (
+    google_exceptions.NotFound,
+    google_exceptions.FailedPrecondition,
+    google_exceptions.InvalidArgument,
+)
+# Only NotFound says so by itself, the other errors have to name the cached content
+CACHE_EXPIRED_MESSAGE = re.compile(r"cached ?content.*(expired|not found|deleted)|cache.*expired", re.IGNORECASE)
+
+
+def is_cache_expired(error):
+    """Return whether a request failed because its cached content is gone, rather than for being malformed."""
+    if isinstance(error, google_exceptions.NotFound):
+        return True
+    return isinstance(error, CACHE_EXPIRED_ERRORS) and CACHE_EXPIRED_MESSAGE.search(str(error)) is not None
+
+
+class VertexCacheBackend:
+    """Stores prefixes as Vertex AI cached content, billed at the cached token rate."""
+    name = 'vertex'
+    min_tokens = CONTEXT_CACHE_MIN_TOKENS
+    saves_tokens = True
+
+    def _create(self, model_name, prefix, ttl):
+        from vertexai.preview import caching
+        from vertexai.preview.generative_models import GenerativeModel
+        cached = caching.CachedContent.create(model_name=model_name, system_instruction=prefix,
+                                              ttl=datetime.timedelta(seconds=ttl),
+                                              display_name=f"prefix-{hashlib.sha1(prefix.encode()).hexdigest()[:12]}")
+        return GenerativeModel.from_cached_content(cached), cached
+
+    async def create(self, model_name, prefix, ttl):
+        """Return a model that prepends the prefix to every request, and the handle of the cache."""
+        return await run_blocking(self._create, model_name, prefix, ttl)
+
+    async def extend(self, handle, ttl):
+        await run_blocking(handle.update, ttl=datetime.timedelta(seconds=ttl))
+
+    async def delete(self, handle):
+        await run_blocking(handle.delete)
+
+
+class LocalCacheBackend:
+    """Registers prefixes in process as the system instruction of a model.
+
+    Prompts are still billed in full, so its lookups are counted as pass-through rather than
+    cache hits. They are built and sent the same way as with cached content.
+    """
+    name = 'local'
+    min_tokens = 0
+    saves_tokens = False
+
+    def __init__(self):
+        self.created = 0
+        self.extended = 0
+
+    async def create(self, model_name, prefix, ttl):
+        from vertexai.generative_models import GenerativeModel
+        self.created += 1
+        return GenerativeModel(model_name, system_instruction=prefix), None
+
+    async def extend(self, handle, ttl):
+        self.extended += 1
+
+    async def delete(self, handle):
+        pass
+
+
+class CachedPrefix:
+    __slots__ = ('backend', 'model', 'handle', 'expires_at', 'task', 'uses')
+
+    def __init__(self):
+        self.backend = None
+        self.model = None
+        self.handle = None
+        self.expires_at = 0.0
+        self.task = None
+        self.uses = 0
+
+
+class ContextCache:
+    """Cached prompt prefixes, keyed by model and prefix.
+
+    A prefix is registered in the background the first time it is used; until it is ready, or
+    once it has expired, model_for returns None and the caller sends the plain prompt. Prefixes
+    that are still in use are extended before they expire. Only lookups served by a backend that
+    saves tokens count as hits, those of the local backend are counted as pass-through.
+    """
+
+    def __init__(self, mode=CONTEXT_CACHE, ttl=CONTEXT_CACHE_TTL, backends=None):
+        self.mode = mode
+        self.ttl = ttl
+        self.backends = backends or {'vertex': VertexCacheBackend(), 'local': LocalCacheBackend()}
+        self._prefixes = {}  # (model name, prefix digest) -> CachedPrefix
+        self.hits = 0
+        self.misses = 0
+        self.passthrough = 0
+        self.expired = 0
+
+    @staticmethod
+    def key(model_name, prefix):
+        return (model_name, hashlib.sha1(prefix.encode()).hexdigest())
+
+    def _backend_for(self, prefix):
+        if self.mode == 'off':
+            return None
+        if self.mode == 'auto':
+            vertex = self.backends['vertex']
+            if token_estimator.estimate(prefix) >= vertex.min_tokens:
+                return vertex
+            return self.backends['local']
+        return self.backends.get(self.mode)
+
+    async def model_for(self, model_name, prefix):
+        """Return a model that has the prefix cached, or None to send the plain prompt."""
+        backend = self._backend_for(prefix)
+        if backend is None:
+            return None
+        key = self.key(model_name, prefix)
+        entry = self._prefixes.setdefault(key, CachedPrefix())
+        now = time.monotonic()
+        if entry.task is None and now >= entry.expires_at:
+            if entry.model is not None:
+                logger.info(f"Cached prefix for {model_name} expired after {entry.uses} uses")
+                self.expired += 1
+                entry.model = None
+            entry.task = asyncio.ensure_future(self._create(entry, backend, model_name, prefix))
+        if entry.model is None:
+            if backend.saves_tokens:
+                self.misses += 1
+            else:
+                self.passthrough += 1
+            return None
+        if entry.task is None and entry.expires_at - now < CONTEXT_CACHE_REFRESH_MARGIN:
+            entry.task = asyncio.ensure_future(self._extend(entry))
+        entry.uses += 1
+        if entry.backend.saves_tokens:
+            self.hits += 1
+        else:
+            self.passthrough += 1
+        return entry.model
+
+    async def _create(self, entry, backend, model_name, prefix):
+        try:
+            entry.model, entry.handle = await backend.create(model_name, prefix, self.ttl)
+            entry.backend = backend
+            entry.expires_at = time.monotonic() + self.ttl
+            entry.uses = 0
+            action = "Cached" if backend.saves_tokens else "Registered, without caching,"
+            logger.info(f"{action} a {token_estimator.estimate(prefix)} token prefix for {model_name} ({backend.name})")
+        except Exception as e:
+            logger.error(f"Failed to cache a prompt prefix for {model_name}: {e}")
+            entry.expires_at = time.monotonic() + CONTEXT_CACHE_RETRY
+        finally:
+            entry.task = None
+
+    async def _extend(self, entry):
+        try:
+            await entry.backend.extend(entry.handle, self.ttl)
+            entry.expires_at = time.monotonic() + self.ttl
+        except Exception as e:
+            # Left to expire, the next request after that registers it again
+            logger.error(f"Failed to extend a cached prompt prefix: {e}")
+        finally:
+            entry.task = None
+
+    def invalidate(self, model_name, prefix):
+        """Forget a prefix whose cached content is gone, it is registered again on next use."""
+        entry = self._prefixes.pop(self.key(model_name, prefix), None)
+        if entry is not None and entry.model is not None:
+            self.expired += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'mode': self.mode,
+            'prefixes': sum(entry.model is not None and entry.backend.saves_tokens for entry in self._prefixes.values()),
+            'passthrough_prefixes': sum(entry.model is not None and not entry.backend.saves_tokens for entry in self._prefixes.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'passthrough': self.passthrough,
+            'expired': self.expired,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+# Shared by every cog so each prefix is registered once per model
+context_cache = ContextCache()
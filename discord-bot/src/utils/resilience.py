@@ -0,0 +1,253 @@
+# Description: This file contains the Resilience class, which adds deadlines, hedging, retries and a circuit breaker to model calls.
+import asyncio
+import logging
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from google.api_core import exceptions as google_exceptions
+from utils.router import LatencyStats, MIN_LATENCY_SAMPLES
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the first chunk of a response, and for the whole response
+MODEL_FIRST_CHUNK_TIMEOUT = float(os.getenv('MODEL_FIRST_CHUNK_TIMEOUT', 20))
+MODEL_TIMEOUT = float(os.getenv('MODEL_TIMEOUT', 90))
+# Send a second, hedged request when the first is slower than the model's usual p95
+MODEL_HEDGE = os.getenv('MODEL_HEDGE', 'True').lower() == 'true'
+# Hedge delay used until a model has enough latency samples
+MODEL_HEDGE_DELAY = float(os.getenv('MODEL_HEDGE_DELAY', 5))
+MIN_HEDGE_DELAY = 0.5
+# Retries of retryable errors, with full jitter backoff
+MODEL_RETRIES = int(os.getenv('MODEL_RETRIES', 2))
+MODEL_RETRY_BASE = float(os.getenv('MODEL_RETRY_BASE', 0.5))
+MAX_RETRY_DELAY = 8.0
+# Consecutive failures that open the circuit, and seconds before it lets a request try again
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_SECONDS = float(os.getenv('CIRCUIT_RESET_SECONDS', 30))
+
+CIRCUIT_OPEN_MESSAGE = "The AI is having trouble right now. Give it a minute and try again."
+
+RETRYABLE_ERRORS = (
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.GatewayTimeout,
+    asyncio.TimeoutError,
+    ConnectionError,
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a backend that keeps failing."""
+
+    def __init__(self, message=CIRCUIT_OPEN_MESSAGE):
+        super().__init__(message)
+
+
+class CircuitBreaker:
+    """Opens after threshold consecutive failures. Once reset_after has passed it lets requests
+    through again; the next failure opens it straight away, a success closes it."""
+
+    def __init__(self, threshold=CIRCUIT_FAILURE_THRESHOLD, reset_after=CIRCUIT_RESET_SECONDS):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self):
+        if self.state == 'open':
+            if time.monotonic() - self.opened_at < self.reset_after:
+                return False
+            self.state = 'half-open'
+        return True
+
+    def success(self):
+        self.state = 'closed'
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.state == 'half-open' or self.failures >= self.threshold:
+            if self.state != 'open':
+                logger.warning(f"Circuit opened after {self.failures} failures")
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+
+
+@asynccontextmanager
+async def _admitted():
+    yield
+
+
+async def _open_stream(open_stream):
+    """Start a stream and wait for its first chunk."""
+    stream = open_stream()
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        first = ''
+    return stream, first
+
+
+def _drop_result(task):
+    # Retrieve the outcome of a request that lost the race so its error isn't reported as unhandled
+    if not task.cancelled():
+        task.exception()
+
+
+def _close_unused_stream(task):
+    # A hedged stream that produced its first chunk after losing the race
+    if not task.cancelled() and task.exception() is None:
+        stream, _ = task.result()
+        asyncio.ensure_future(stream.aclose())
+
+
+class Resilience:
+    """Deadlines, hedged requests, jittered retries and a circuit breaker per backend.
+
+    A request that hasn't answered within the backend's p95 latency gets a hedged duplicate; the
+    first to answer wins and the other is cancelled. Retryable errors are retried with full jitter
+    backoff, unless part of a streamed response was already passed on. While a backend's circuit
+    is open, calls fail fast with CircuitOpenError.
+
+    admit, when given, returns the async context manager that admits an attempt, e.g. a scheduler
+    slot. Deadlines, the hedge delay and latency only start counting once it is entered, so time
+    spent queueing is neither hedged nor taken for a slow backend. A hedge runs in the slot of the
+    request it duplicates.
+    """
+
+    def __init__(self, hedge=MODEL_HEDGE, retries=MODEL_RETRIES, first_chunk_timeout=MODEL_FIRST_CHUNK_TIMEOUT, timeout=MODEL_TIMEOUT):
+        self.hedge = hedge
+        self.retries = retries
+        self.first_chunk_timeout = first_chunk_timeout
+        self.timeout = timeout
+        self._breakers = {}
+        self._latency = {}  # backend -> LatencyStats of the first answer
+        self.hedges = 0
+        self.retried = 0
+
+    def breaker(self, name):
+        return self._breakers.setdefault(name, CircuitBreaker())
+
+    def hedge_delay(self, name):
+        stats = self._latency.get(name)
+        if stats is None or len(stats.samples) < MIN_LATENCY_SAMPLES:
+            return MODEL_HEDGE_DELAY
+        return max(MIN_HEDGE_DELAY, stats.percentile(0.95))
+
+    async def _race(self, name, start, hedge, timeout, discard=_drop_result):
+        """Run start(), plus a hedged second start() if the first is slow, and return the first result.
+
+        discard is called with the task of a hedged request that lost the race.
+        """
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + timeout
+        hedge_at = started + self.hedge_delay(name) if hedge and self.hedge else None
+        tasks = [asyncio.ensure_future(start())]
+        error = None
+        try:
+            while tasks:
+                wake_at = deadline if hedge_at is None else min(deadline, hedge_at)
+                done, _ = await asyncio.wait(tasks, timeout=max(0.0, wake_at - loop.time()), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.remove(task)
+                    if task.exception() is None:
+                        self._latency.setdefault(name, LatencyStats()).add(loop.time() - started)
+                        return task.result()
+                    error = task.exception()
+                if loop.time() >= deadline:
+                    raise asyncio.TimeoutError(f"{name} didn't answer within {timeout:.0f}s")
+                if hedge_at is not None and loop.time() >= hedge_at and tasks:
+                    logger.info(f"Hedging a slow {name} request after {loop.time() - started:.1f}s")
+                    self.hedges += 1
+                    hedge_at = None
+                    tasks.append(asyncio.ensure_future(start()))
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+                task.add_done_callback(discard)
+
+    async def _backoff(self, name, attempt, error):
+        delay = random.uniform(0, min(MAX_RETRY_DELAY, MODEL_RETRY_BASE * 2 ** attempt))
+        self.retried += 1
+        logger.warning(f"{name} failed with {type(error).__name__}: {error}. Retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+    async def stream(self, name, open_stream, hedge=True, admit=_admitted):
+        """Yield the chunks of open_stream(), an async generator factory, with deadlines, hedging and retries."""
+        breaker = self.breaker(name)
+        loop = asyncio.get_running_loop()
+
+        def start():
+            return _open_stream(open_stream)
+
+        for attempt in range(self.retries + 1):
+            if not breaker.allow():
+                raise CircuitOpenError()
+            passed_on = False
+            try:
+                async with admit():
+                    deadline = loop.time() + self.timeout
+                    stream, first = await self._race(name, start, hedge, self.first_chunk_timeout, discard=_close_unused_stream)
+                    try:
+                        passed_on = True
+                        yield first
+                        while True:
+                            try:
+                                chunk = await asyncio.wait_for(stream.__anext__(), max(0.0, deadline - loop.time()))
+                            except StopAsyncIteration:
+                                break
+                            yield chunk
+                    finally:
+                        await stream.aclose()
+            except RETRYABLE_ERRORS as e:
+                breaker.failure()
+                # Text already posted can't be taken back, so only retry before the first chunk
+                if passed_on or attempt == self.retries or not breaker.allow():
+                    raise
+                await self._backoff(name, attempt, e)
+                continue
+            breaker.success()
+            return
+
+    async def call(self, name, make_call, accept=None, hedge=False, timeout=None, admit=_admitted):
+        """Await make_call(), a coroutine factory, with a deadline, optional hedging and retries.
+
+        Results rejected by accept (e.g. an empty image response) are retried without counting
+        as a backend failure; the last one is returned as is.
+        """
+        breaker = self.breaker(name)
+        for attempt in range(self.retries + 1):
+            if not breaker.allow():
+                raise CircuitOpenError()
+            try:
+                async with admit():
+                    result = await self._race(name, make_call, hedge, timeout or self.timeout)
+            except RETRYABLE_ERRORS as e:
+                breaker.failure()
+                if attempt == self.retries or not breaker.allow():
+                    raise
+                await self._backoff(name, attempt, e)
+                continue
+            breaker.success()
+            if accept is None or accept(result) or attempt == self.retries:
+                return result
+            logger.info(f"Attempt {attempt + 1}: {name} returned an unusable result, retrying")
+
+    def stats(self):
+        return {
+            'hedges': self.hedges,
+            'retries': self.retried,
+            'circuits': {name: breaker.state for name, breaker in self._breakers.items()},
+            'first_answer': {name: stats.as_dict() for name, stats in self._latency.items()},
+        }
+
+
+# Shared by every cog so breakers and latency history are global
+resilience = Resilience()
@@ -0,0 +1,72 @@
+# Description: This file contains the ResponseCache class, which reuses model responses to preset prompts that have no attachments.
+import logging
+import os
+import random
+import re
+from utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Presets whose responses are cached, e.g. "greeting,meme,playsong". Empty disables the cache.
+RESPONSE_CACHE_PRESETS = [preset.strip() for preset in os.getenv('RESPONSE_CACHE_PRESETS', 'greeting,meme,playsong').split(',') if preset.strip()]
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 512))
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 3600))
+# Responses collected per prompt before cached ones are served, at random, to keep answers varied
+RESPONSE_CACHE_VARIANTS = int(os.getenv('RESPONSE_CACHE_VARIANTS', 3))
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt):
+    """Lower case with collapsed whitespace and no trailing punctuation, so trivial variations share an entry."""
+    return WHITESPACE.sub(' ', prompt or '').strip().lower().rstrip('.!?')
+
+
+class ResponseCache:
+    """LRU cache with expiry of the responses to preset prompts.
+
+    Entries are keyed on the normalized (instruction, prompt, model). Each entry keeps up to
+    variants responses; until it has that many, every request still goes to the model and adds
+    its response, afterwards a random one of them is served.
+    """
+
+    def __init__(self, presets=RESPONSE_CACHE_PRESETS, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, variants=RESPONSE_CACHE_VARIANTS):
+        self.presets = set(presets)
+        self.variants = max(1, variants)
+        self._cache = LRUCache(maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def preset_for(self, prompt):
+        """Return the enabled preset the prompt uses, or None if its responses aren't cached."""
+        normalized = normalize_prompt(prompt)
+        preset = normalized.split(' ', 1)[0] if normalized else 'greeting'
+        return preset if preset in self.presets else None
+
+    @staticmethod
+    def key(instruction, prompt, model_name):
+        return (normalize_prompt(instruction), normalize_prompt(prompt), model_name)
+
+    def get(self, key):
+        variants = self._cache.get(key)
+        if variants is None or len(variants) < self.variants:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return random.choice(variants)
+
+    def add(self, key, response):
+        if not response.strip():
+            return
+        variants = self._cache.pop(key) or []
+        # Newest variants are kept
+        self._cache.set(key, (variants + [response])[-self.variants:])
+
+    def expire(self):
+        return self._cache.expire()
+
+    def stats(self):
+        # Lookups that are still collecting variants count as misses
+        lookups = self.hits + self.misses
+        return dict(self._cache.stats(), hits=self.hits, misses=self.misses,
+                    hit_rate=round(self.hits / lookups, 3) if lookups else 0.0)
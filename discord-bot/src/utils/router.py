@@ -0,0 +1,222 @@
+# Description: This file contains the ModelRouter class, a shared model registry that picks a Gemini model per request.
+import logging
+import os
+import time
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from vertexai.generative_models import GenerativeModel
+from utils.scheduler import PRIORITY_AMBIENT, PRIORITY_BACKGROUND, PRIORITY_COMMAND, PRIORITY_NAMES, PRIORITY_ROOM
+
+logger = logging.getLogger(__name__)
+
+# Model of each tier
+MODEL_LIGHT = os.getenv('MODEL_LIGHT', 'gemini-1.5-flash-002')
+MODEL_STANDARD = os.getenv('MODEL_STANDARD', 'gemini-1.5-flash-002')
+MODEL_HEAVY = os.getenv('MODEL_HEAVY', 'gemini-1.5-pro-002')
+# Chat prompts up to this many tokens go to the light model
+ROUTER_LIGHT_MAX_TOKENS = int(os.getenv('ROUTER_LIGHT_MAX_TOKENS', 3000))
+# Requests from this many tokens up go to the heavy model
+ROUTER_HEAVY_MIN_TOKENS = int(os.getenv('ROUTER_HEAVY_MIN_TOKENS', 30000))
+# Presets that always get the heavy model when they come with media
+ROUTER_HEAVY_PRESETS = [preset.strip() for preset in os.getenv('ROUTER_HEAVY_PRESETS', 'coach').split(',') if preset.strip()]
+
+
+def parse_slo(value):
+    """Parse 'priority:seconds,priority:seconds' into a dict keyed by priority."""
+    priorities = {name: priority for priority, name in PRIORITY_NAMES.items()}
+    slo = {}
+    for item in filter(None, (value or '').split(',')):
+        name, seconds = item.split(':')
+        slo[priorities[name.strip()]] = float(seconds)
+    return slo
+
+
+# Latency target of each kind of request, a tier whose p95 misses it is skipped for a lighter one
+ROUTER_SLO = {PRIORITY_COMMAND: 20.0, PRIORITY_AMBIENT: 6.0, PRIORITY_ROOM: 10.0, PRIORITY_BACKGROUND: 60.0}
+ROUTER_SLO.update(parse_slo(os.getenv('ROUTER_SLO')))
+
+TIERS = ['light', 'standard', 'heavy']
+# Rough token cost of an attachment, its real size is only known to the model
+MODALITY_TOKENS = {'text': 0, 'image': 258, 'document': 3000, 'video': 8000}
+# Latency samples needed before a model's p95 is trusted
+MIN_LATENCY_SAMPLES = 20
+
+
+def model_name(model):
+    """Short name of a model, e.g. gemini-1.5-flash-002 for publishers/google/models/gemini-1.5-flash-002."""
+    name = getattr(model, '_model_name', None) or type(model).__name__
+    return name.rsplit('/', 1)[-1]
+
+
+class Route:
+    __slots__ = ('tier', 'name', 'model', 'reason')
+
+    def __init__(self, tier, name, model, reason):
+        self.tier = tier
+        self.name = name
+        self.model = model
+        self.reason = reason
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def rounded(seconds):
+    return round(seconds, 2) if seconds is not None else None
+
+
+class LatencyStats:
+    """Recent call latencies of one model, and the time to the first chunk of streamed calls."""
+    __slots__ = ('samples', 'first_chunks', 'calls', 'errors')
+
+    def __init__(self, window=200):
+        self.samples = deque(maxlen=window)
+        self.first_chunks = deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+
+    def add(self, seconds, ok=True, first_chunk=None):
+        self.calls += 1
+        if ok:
+            self.samples.append(seconds)
+            if first_chunk is not None:
+                self.first_chunks.append(first_chunk)
+        else:
+            self.errors += 1
+
+    def percentile(self, fraction):
+        return percentile(self.samples, fraction)
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'p50': rounded(self.percentile(0.5)),
+            'p95': rounded(self.percentile(0.95)),
+            'first_chunk_p95': rounded(percentile(self.first_chunks, 0.95)),
+        }
+
+
+class StreamTimer:
+    """Times a streamed call from the side of the producer.
+
+    Only time spent waiting on the model counts: between a chunk() and the following resume() the
+    consumer is busy posting to Discord or speaking, which would otherwise skew the latency the
+    router and the latency targets rely on. The time to the first chunk is recorded as well.
+    """
+
+    def __init__(self, router, name):
+        self.router = router
+        self.name = name
+        self.waited = 0.0
+        self.first_chunk = None
+        self._since = time.monotonic()
+
+    def chunk(self):
+        """A chunk arrived, stop counting until the consumer asks for the next one."""
+        self.waited += time.monotonic() - self._since
+        if self.first_chunk is None:
+            self.first_chunk = self.waited
+        self._since = None
+
+    def resume(self):
+        self._since = time.monotonic()
+
+    def done(self, ok=True):
+        if self._since is not None:
+            self.waited += time.monotonic() - self._since
+            self._since = None
+        self.router.record(self.name, self.waited, ok, first_chunk=self.first_chunk)
+
+
+class ModelRouter:
+    """Registry of GenerativeModel instances and the policy that picks one per request.
+
+    The tier comes from the request: heavy for heavy presets with media and very large requests,
+    light for short chat, standard otherwise. If the p95 latency of the tier's model misses the
+    latency target of the request, the next lighter tier is used instead.
+    """
+
+    def __init__(self, tiers=None, slo=None):
+        self.tiers = tiers or {'light': MODEL_LIGHT, 'standard': MODEL_STANDARD, 'heavy': MODEL_HEAVY}
+        self.slo = slo or ROUTER_SLO
+        self._models = {}
+        self._latency = {}  # model name -> LatencyStats
+        self._decisions = Counter()  # 'kind/modality -> tier (reason)' -> count
+        self._skipped = Counter()  # model name -> requests routed away for being slow
+
+    def model(self, name):
+        """Return the shared GenerativeModel for a model name, created on first use."""
+        if name not in self._models:
+            self._models[name] = GenerativeModel(name)
+        return self._models[name]
+
+    @property
+    def default(self):
+        return self.model(self.tiers['standard'])
+
+    def _tier_for(self, priority, modality, tokens, preset):
+        if preset in ROUTER_HEAVY_PRESETS and modality != 'text':
+            return 'heavy', f"preset {preset}"
+        if tokens >= ROUTER_HEAVY_MIN_TOKENS:
+            return 'heavy', "large request"
+        if priority != PRIORITY_COMMAND and modality == 'text' and tokens <= ROUTER_LIGHT_MAX_TOKENS:
+            return 'light', "short chat"
+        return 'standard', "default"
+
+    def _meets_slo(self, name, priority):
+        stats = self._latency.get(name)
+        if stats is None or len(stats.samples) < MIN_LATENCY_SAMPLES:
+            return True
+        if stats.percentile(0.95) <= self.slo.get(priority, float('inf')):
+            return True
+        # Let an occasional request through anyway so a recovered model gets fresh samples
+        self._skipped[name] += 1
+        return self._skipped[name] % MIN_LATENCY_SAMPLES == 0
+
+    def route(self, priority=PRIORITY_COMMAND, modality='text', tokens=0, preset=None):
+        """Pick the model for a request and record the decision."""
+        tier, reason = self._tier_for(priority, modality, tokens + MODALITY_TOKENS.get(modality, 0), preset)
+        # Step down to lighter tiers while the chosen one is too slow for the request
+        for candidate in reversed(TIERS[:TIERS.index(tier) + 1]):
+            if self._meets_slo(self.tiers[candidate], priority):
+                break
+        if candidate != tier:
+            reason = f"{reason}, {tier} over latency target"
+        name = self.tiers[candidate]
+        self._decisions[f"{PRIORITY_NAMES.get(priority, priority)}/{modality} -> {candidate} ({reason})"] += 1
+        logger.info(f"Routed {PRIORITY_NAMES.get(priority, priority)} {modality} request (~{tokens} tokens) to {name}: {reason}")
+        return Route(candidate, name, self.model(name), reason)
+
+    def record(self, name, seconds, ok=True, first_chunk=None):
+        self._latency.setdefault(name, LatencyStats()).add(seconds, ok, first_chunk)
+
+    @asynccontextmanager
+    async def timed(self, model):
+        """Record the latency of the calls made in the block, or an error if it raises."""
+        started = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.record(model_name(model), time.monotonic() - started, ok=False)
+            raise
+        self.record(model_name(model), time.monotonic() - started)
+
+    def stream_timer(self, model):
+        """Return a StreamTimer for a streamed call, which records its latency once done."""
+        return StreamTimer(self, model_name(model))
+
+    def stats(self):
+        return {
+            'tiers': dict(self.tiers),
+            'latency': {name: stats.as_dict() for name, stats in self._latency.items()},
+            'decisions': dict(self._decisions.most_common(10)),
+        }
+
+
+# Shared by every cog so latency history and model instances are global
+model_router = ModelRouter()
@@ -0,0 +1,152 @@
+# Description: This file contains the ModelScheduler class, which admits model calls by priority with fair sharing across guilds and users.
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from utils.workers import MODEL_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, lower runs first
+PRIORITY_COMMAND = 0  # Explicit commands such as !ai and !ai-voice
+PRIORITY_AMBIENT = 1  # Replies in the chatroom and blackjack channels
+PRIORITY_ROOM = 2  # The bots talking to each other in the AI conversation room
+PRIORITY_BACKGROUND = 3  # Housekeeping nobody is waiting on, such as folding chat history into a summary
+PRIORITY_NAMES = {PRIORITY_COMMAND: 'command', PRIORITY_AMBIENT: 'ambient', PRIORITY_ROOM: 'room', PRIORITY_BACKGROUND: 'background'}
+
+
+def parse_weights(value):
+    """Parse 'id:weight,id:weight' into a dict."""
+    weights = {}
+    for item in filter(None, (value or '').split(',')):
+        key, weight = item.split(':')
+        weights[int(key)] = float(weight)
+    return weights
+
+
+# Optional relative shares, e.g. GUILD_WEIGHTS="1234:2,5678:0.5"
+GUILD_WEIGHTS = parse_weights(os.getenv('GUILD_WEIGHTS'))
+
+
+class WaitStats:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, wait):
+        self.count += 1
+        self.total += wait
+        self.max = max(self.max, wait)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'avg_wait': round(self.total / self.count, 3) if self.count else 0.0,
+            'max_wait': round(self.max, 3),
+        }
+
+
+class ModelScheduler:
+    """Bounded concurrency for model calls with priority classes and weighted fair queuing.
+
+    Waiting requests are ordered by priority class first. Within a class, each request gets a
+    virtual finish tag (self-clocked fair queuing) from both its guild's and its user's flow, so a
+    busy guild or a spamming user only delays its own requests, not everyone else's.
+    """
+
+    def __init__(self, concurrency=MODEL_CONCURRENCY, guild_weights=None):
+        self.concurrency = concurrency
+        self.guild_weights = guild_weights or {}
+        self.active = 0
+        self._queue = []  # heap of (priority, finish tag, sequence, future)
+        self._sequence = itertools.count()
+        self._virtual_time = 0.0
+        self._flow_finish = {}  # guild id or (guild id, user id) -> last finish tag
+        self._waits = {priority: WaitStats() for priority in PRIORITY_NAMES}
+
+    def _finish_tag(self, guild_id, user_id, cost):
+        guild_start = max(self._virtual_time, self._flow_finish.get(guild_id, 0.0))
+        guild_finish = guild_start + cost / self.guild_weights.get(guild_id, 1.0)
+        user_flow = (guild_id, user_id)
+        user_finish = max(self._virtual_time, self._flow_finish.get(user_flow, 0.0)) + cost
+        self._flow_finish[guild_id] = guild_finish
+        self._flow_finish[user_flow] = user_finish
+        return max(guild_finish, user_finish)
+
+    def _forget_idle_flows(self):
+        # Flows whose tags are behind the virtual clock carry no state worth keeping
+        if len(self._flow_finish) > 4096:
+            self._flow_finish = {flow: tag for flow, tag in self._flow_finish.items() if tag > self._virtual_time}
+
+    async def acquire(self, priority=PRIORITY_COMMAND, guild_id=None, user_id=None, cost=1.0):
+        finish = self._finish_tag(guild_id, user_id, cost)
+        started = time.monotonic()
+        if self.active < self.concurrency and not self._has_waiters():
+            self._queue.clear()  # Only requests cancelled while waiting can be left over
+            self.active += 1
+            self._virtual_time = max(self._virtual_time, finish)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._queue, (priority, finish, next(self._sequence), future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self.release()  # The slot was handed over just as we were cancelled
+                raise
+        self._waits[priority].add(time.monotonic() - started)
+
+    def _has_waiters(self):
+        return any(not future.done() for _, _, _, future in self._queue)
+
+    def release(self):
+        while self._queue:
+            _, finish, _, future = heapq.heappop(self._queue)
+            if future.done():
+                continue  # Cancelled while waiting
+            # Hand the slot straight to the next request
+            self._virtual_time = max(self._virtual_time, finish)
+            future.set_result(None)
+            return
+        self.active -= 1
+        self._forget_idle_flows()
+
+    @asynccontextmanager
+    async def slot(self, priority=PRIORITY_COMMAND, guild_id=None, user_id=None):
+        await self.acquire(priority, guild_id, user_id)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def slot_for(self, message=None, priority=PRIORITY_COMMAND):
+        """Slot for a request made on behalf of a Discord message."""
+        if message is None:
+            return self.slot(priority)
+        guild_id = message.guild.id if message.guild else None
+        return self.slot(priority, guild_id, message.author.id)
+
+    def queue_depth(self):
+        depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, _, future in self._queue:
+            if not future.done():
+                depth[PRIORITY_NAMES[priority]] += 1
+        return depth
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'concurrency': self.concurrency,
+            'queued': self.queue_depth(),
+            'waits': {PRIORITY_NAMES[priority]: waits.as_dict() for priority, waits in self._waits.items()},
+        }
+
+
+# Shared by every cog so the concurrency bound is global
+model_scheduler = ModelScheduler(guild_weights=GUILD_WEIGHTS)
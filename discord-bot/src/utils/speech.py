@@ -0,0 +1,260 @@
+# Description: This file contains the SpeechPipeline class, which speaks streamed text sentence by sentence while the rest of it is still being generated.
+import asyncio
+import io
+import logging
+import os
+import re
+from collections import deque
+import discord
+from discord.player import OPUS_SILENCE
+from gtts import gTTS
+from utils.playback import playback
+from utils.tts_cache import tts_cache
+
+logger = logging.getLogger(__name__)
+
+# Language and accent of the gTTS voice
+TTS_LANG = os.getenv('TTS_LANG', 'en')
+TTS_TLD = os.getenv('TTS_TLD', 'ca')
+# Sentences shorter than this are spoken together with the next one, each segment costs a TTS request
+TTS_MIN_SEGMENT_CHARS = int(os.getenv('TTS_MIN_SEGMENT_CHARS', 40))
+# Segments synthesized at the same time per reply
+TTS_CONCURRENCY = int(os.getenv('TTS_CONCURRENCY', 2))
+# Playback volume. At 1.0 ffmpeg encodes Opus itself, any other volume needs a PCM decode and per-frame scaling in Python.
+TTS_VOLUME = float(os.getenv('TTS_VOLUME', 1.0))
+# Bitrate, in kbps, of Opus encoded speech
+TTS_OPUS_BITRATE = 64
+# Replies synthesized into the speech cache at startup, separated by |. Only whole replies hit the cache,
+# since short lines are spoken together with their neighbours.
+TTS_PREWARM = [phrase for phrase in os.getenv('TTS_PREWARM', "A round is already in play.|"
+                                                             "Nobody has bet yet. Say `bet <amount>` first.").split('|') if phrase.strip()]
+
+SENTENCE_END = re.compile(r"(?<=[.!?])[\"')\]]*\s+|\n+")
+MARKDOWN_LINK = re.compile(r"\[([^\]]+)\]\([^)]*\)")
+MARKDOWN = re.compile(r"```\w*|[*_~`|]+|^#+\s+|^>+\s?", re.MULTILINE)
+PCM_SILENCE = b'\x00' * discord.opus.Encoder.FRAME_SIZE
+
+
+def synthesize(text, lang=TTS_LANG, tld=TTS_TLD):
+    """Return the MP3 bytes of the spoken text. Blocks on the gTTS request, run it in a worker."""
+    buffer = io.BytesIO()
+    gTTS(text, lang=lang, tld=tld).write_to_fp(buffer)
+    return buffer.getvalue()
+
+
+def speakable(text):
+    """Strip the markdown of a Discord message, which would otherwise be read out."""
+    return MARKDOWN.sub('', MARKDOWN_LINK.sub(r"\1", text)).strip()
+
+
+def split_segments(text):
+    """Split text into segments of whole sentences, each at least TTS_MIN_SEGMENT_CHARS long, and the incomplete rest."""
+    segments = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        if match.end() - start >= TTS_MIN_SEGMENT_CHARS:
+            segments.append(text[start:match.end()])
+            start = match.end()
+    return segments, text[start:]
+
+
+def speech_segments(text):
+    """Return the texts a complete reply is synthesized as, which are also its speech cache keys."""
+    segments, rest = split_segments(text)
+    return [segment for segment in map(speakable, segments + [rest]) if segment]
+
+
+def audio_source(audio, opus=True):
+    """Return a source that plays MP3 bytes from memory through an ffmpeg pipe.
+
+    Opus sources are encoded by ffmpeg and sent as is, PCM sources are decoded by ffmpeg and
+    encoded frame by frame in Python.
+    """
+    if opus:
+        return discord.FFmpegOpusAudio(io.BytesIO(audio), pipe=True, bitrate=TTS_OPUS_BITRATE)
+    return discord.FFmpegPCMAudio(io.BytesIO(audio), pipe=True)
+
+
+class SpeechSource(discord.AudioSource):
+    """One continuous audio source made of segments that are added while it plays.
+
+    While the next segment isn't ready yet silence is played, so a reply is one stream however
+    long its sentences take to synthesize. The source ends once it is finished and every segment
+    has been played. read() runs on the player thread, add() and finish() on the event loop.
+    Segments must all be Opus or all be PCM, matching opus.
+    """
+
+    def __init__(self, opus=True):
+        self.opus = opus
+        self._silence = OPUS_SILENCE if opus else PCM_SILENCE
+        self._segments = deque()
+        self._current = None
+        self._finished = False
+
+    def add(self, source):
+        self._segments.append(source)
+
+    def finish(self):
+        self._finished = True
+
+    def read(self):
+        while True:
+            if self._current is None:
+                # Read the flag first so a segment added just before finish() isn't dropped
+                finished = self._finished
+                if not self._segments:
+                    return b'' if finished else self._silence
+                self._current = self._segments.popleft()
+            data = self._current.read()
+            if data:
+                return data
+            self._current.cleanup()
+            self._current = None
+
+    def is_opus(self):
+        return self.opus
+
+    def cleanup(self):
+        if self._current is not None:
+            self._current.cleanup()
+            self._current = None
+        while self._segments:
+            self._segments.popleft().cleanup()
+
+
+class SpeechPipeline:
+    """Speaks text as it streams in.
+
+    Each complete sentence is synthesized in a worker thread as soon as it arrives and is added to
+    a SpeechSource in order, so the first sentence is playing while later ones are still being
+    generated and synthesized. The source goes into the guild's playback queue once its first
+    sentence is ready. connect is a coroutine function returning the voice client; it is started
+    right away so the voice handshake overlaps generation. Synthesis waits for it, so nothing is
+    synthesized when there turns out to be no voice connection.
+    """
+
+    def __init__(self, connect, lang=TTS_LANG, tld=TTS_TLD, strip_prefix=None, volume=TTS_VOLUME):
+        self.lang = lang
+        self.tld = tld
+        self.strip_prefix = strip_prefix
+        self.volume = volume
+        self.source = SpeechSource(opus=volume == 1.0)
+        self._buffer = ''
+        self._started = False
+        self._finished = False
+        self._segments = asyncio.Queue()  # Synthesis tasks in speaking order, None once finished
+        self._limit = asyncio.Semaphore(TTS_CONCURRENCY)
+        self._done = asyncio.Event()
+        self._voice = asyncio.get_running_loop().create_future()  # The connected voice client, or None without one
+        self._player = asyncio.ensure_future(self._play(connect))
+
+    def feed(self, chunk):
+        """Add generated text, queueing every sentence it completes."""
+        self._buffer += chunk
+        if not self._started and self.strip_prefix:
+            text = self._buffer.lstrip()
+            if len(text) <= len(self.strip_prefix):
+                return  # Wait until we know whether the text starts with the prefix
+            while text.startswith(self.strip_prefix):
+                text = text[len(self.strip_prefix):].lstrip()
+            self._buffer = text
+        self._started = True
+        segments, self._buffer = split_segments(self._buffer)
+        for segment in segments:
+            self._queue(segment)
+
+    def finish(self):
+        """Queue the rest of the text, no more is coming."""
+        if self._finished:
+            return
+        self._finished = True
+        self._started = True
+        self._queue(self._buffer)
+        self._buffer = ''
+        self._segments.put_nowait(None)
+
+    def _queue(self, text):
+        text = speakable(text)
+        if text and not self._done.is_set():
+            self._segments.put_nowait(asyncio.ensure_future(self._synthesize(text)))
+
+    async def _synthesize(self, text):
+        """Return the speech of the text, or None when there is no voice connection to play it on."""
+        if await asyncio.shield(self._voice) is None:
+            return None
+        async with self._limit:
+            return await tts_cache.fetch(text, self.lang, self.tld, synthesize)
+
+    async def _play(self, connect):
+        voice_client = None
+        playing = False
+        try:
+            voice_client = await connect()
+            if voice_client is not None and not voice_client.is_connected():
+                voice_client = None
+            self._voice.set_result(voice_client)
+            if voice_client is None:
+                logger.info("No voice connection, the reply won't be spoken")
+                return
+            while True:
+                task = await self._segments.get()
+                if task is None:
+                    break
+                try:
+                    audio = await task
+                except Exception as e:
+                    logger.error(f"Failed to synthesize a sentence: {e}")
+                    continue
+                if not voice_client.is_connected():
+                    continue
+                if self._done.is_set():
+                    break  # Skipped or cleared from the playback queue
+                self.source.add(audio_source(audio, self.source.opus))
+                if not playing:
+                    source = self.source if self.source.opus else discord.PCMVolumeTransformer(self.source, self.volume)
+                    playback.enqueue(voice_client, source, after=self._after)
+                    playing = True
+        except Exception as e:
+            logger.error(f"Voice playback failed: {e}")
+        finally:
+            if not self._voice.done():
+                self._voice.set_result(None)
+            self.source.finish()
+            if not playing:
+                self.source.cleanup()
+                self._done.set()
+
+    def _after(self, error):
+        self._done.set()
+
+    async def tee(self, chunks):
+        """Pass an async iterable of text chunks through, speaking them as they go by."""
+        try:
+            async for chunk in chunks:
+                self.feed(chunk)
+                yield chunk
+        finally:
+            self.finish()
+
+    async def wait(self):
+        """Wait until everything queued has been spoken."""
+        await self._done.wait()
+
+
+def speak(connect, text, lang=TTS_LANG, tld=TTS_TLD):
+    """Queue a complete text to be spoken sentence by sentence and return its pipeline without waiting."""
+    pipeline = SpeechPipeline(connect, lang, tld)
+    pipeline.feed(text)
+    pipeline.finish()
+    return pipeline
+
+
+async def prewarm(phrases=TTS_PREWARM, lang=TTS_LANG, tld=TTS_TLD):
+    """Synthesize fixed replies into the speech cache, as the same segments speaking them produces."""
+    for phrase in phrases:
+        for segment in speech_segments(phrase):
+            try:
+                await tts_cache.fetch(segment, lang, tld, synthesize)
+            except Exception as e:
+                logger.error(f"Failed to prewarm speech for {segment!r}: {e}")
+    logger.info(f"Prewarmed speech for {len(phrases)} phrases")
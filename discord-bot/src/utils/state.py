@@ -0,0 +1,204 @@
+# Description: This file contains the StateStore class, which persists chat history, summaries and flags to a local SQLite file.
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# SQLite file holding the bot state, mount a persistent volume here to keep it across restarts
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'data/state.db')
+# Seconds between flushes of queued writes
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', 2.0))
+# Seconds between compactions
+STATE_COMPACT_INTERVAL = float(os.getenv('STATE_COMPACT_INTERVAL', 6 * 3600))
+# Messages older than this many days are dropped by compaction
+STATE_RETENTION_DAYS = float(os.getenv('STATE_RETENTION_DAYS', 30))
+
+DISCORD_EPOCH_MS = 1420070400000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    author TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (guild_id, channel_id, message_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS memories (
+    guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    slot INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    line TEXT NOT NULL,
+    PRIMARY KEY (guild_id, channel_id, slot)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS state (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (scope, key)
+) WITHOUT ROWID;
+"""
+
+
+def snowflake_for(timestamp):
+    """Smallest Discord id that could have been created at the given unix time."""
+    return max(0, int(timestamp * 1000) - DISCORD_EPOCH_MS) << 22
+
+
+class StateStore:
+    """Write-behind persistence in a SQLite file in WAL mode.
+
+    Writes are queued and flushed in batches by a background task, one transaction per batch.
+    Reads only happen when a channel or flag is first used, so startup does no work per guild.
+    All SQLite calls run on a single dedicated thread, off the event loop.
+    """
+
+    def __init__(self, path=STATE_DB_PATH, flush_interval=STATE_FLUSH_INTERVAL,
+                 compact_interval=STATE_COMPACT_INTERVAL, retention_days=STATE_RETENTION_DAYS):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        self.retention_days = retention_days
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='state')
+        self._db = None
+        self._pending = []  # (sql, params) in the order they were queued
+        self._writer = None
+        self._last_compaction = time.monotonic()
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(SCHEMA)
+            logger.info(f"Opened state database: {self.path}")
+        return self._db
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _queue(self, sql, params):
+        self._pending.append((sql, params))
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.get_running_loop().create_task(self._write_loop())
+
+    async def _write_loop(self):
+        """Background writer that flushes queued writes and compacts the database on a schedule."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - self._last_compaction >= self.compact_interval:
+                    self._last_compaction = time.monotonic()
+                    await self._run(self._compact)
+            except Exception as e:
+                logger.error(f"State store write failed: {e}")
+
+    async def flush(self):
+        """Write every queued change in one transaction."""
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        # Shielded so a batch already taken off the queue is written even if the flush is cancelled
+        await asyncio.shield(self._run(self._write, batch))
+
+    async def close(self):
+        """Write every queued change and close the database, it is opened again on next use."""
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        await self.flush()
+        await self._run(self._close)
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            logger.info(f"Closed state database: {self.path}")
+
+    def _write(self, batch):
+        db = self._connect()
+        with db:
+            for sql, params in batch:
+                db.execute(sql, params)
+
+    def _compact(self):
+        db = self._connect()
+        cutoff = snowflake_for(time.time() - self.retention_days * 86400)
+        with db:
+            deleted = db.execute("DELETE FROM messages WHERE message_id < ?", (cutoff,)).rowcount
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        db.execute("PRAGMA optimize")
+        logger.info(f"Compacted state database, removed {deleted} expired messages")
+
+    # Channel history
+
+    def append_message(self, key, entry):
+        self._queue("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)",
+                    (key[0], key[1], entry.message_id, entry.author, entry.content))
+
+    def edit_message(self, key, message_id, content):
+        self._queue("UPDATE messages SET content = ? WHERE guild_id = ? AND channel_id = ? AND message_id = ?",
+                    (content, key[0], key[1], message_id))
+
+    def delete_message(self, key, message_id):
+        self._queue("DELETE FROM messages WHERE guild_id = ? AND channel_id = ? AND message_id = ?",
+                    (key[0], key[1], message_id))
+
+    def clear_messages(self, key):
+        self._queue("DELETE FROM messages WHERE guild_id = ? AND channel_id = ?", key)
+
+    async def load_messages(self, key, limit):
+        """Return the newest stored messages of a channel as (message_id, author, content), oldest first."""
+        await self.flush()
+        rows = await self._run(self._select, "SELECT message_id, author, content FROM messages "
+                                             "WHERE guild_id = ? AND channel_id = ? ORDER BY message_id DESC LIMIT ?",
+                               (key[0], key[1], limit))
+        rows.reverse()
+        return rows
+
+    def _select(self, sql, params):
+        return self._connect().execute(sql, params).fetchall()
+
+    # Long-term memory, the vectors themselves live in a memory-mapped file per channel
+
+    def put_memory(self, key, slot, message_id, line):
+        self._queue("INSERT OR REPLACE INTO memories VALUES (?, ?, ?, ?, ?)", (key[0], key[1], slot, message_id, line))
+
+    def delete_memory(self, key, message_id):
+        self._queue("DELETE FROM memories WHERE guild_id = ? AND channel_id = ? AND message_id = ?",
+                    (key[0], key[1], message_id))
+
+    def clear_memories(self, key):
+        self._queue("DELETE FROM memories WHERE guild_id = ? AND channel_id = ?", key)
+
+    async def load_memories(self, key):
+        """Return the stored memories of a channel as (slot, message_id, line)."""
+        await self.flush()
+        return await self._run(self._select, "SELECT slot, message_id, line FROM memories WHERE guild_id = ? AND channel_id = ?", key)
+
+    # Flags and other small values, stored as JSON
+
+    def set(self, scope, key, value):
+        self._queue("INSERT OR REPLACE INTO state VALUES (?, ?, ?)", (scope, key, json.dumps(value)))
+
+    def delete(self, scope, key):
+        self._queue("DELETE FROM state WHERE scope = ? AND key = ?", (scope, key))
+
+    async def get(self, scope, key, default=None):
+        await self.flush()
+        rows = await self._run(self._select, "SELECT value FROM state WHERE scope = ? AND key = ?", (scope, key))
+        return json.loads(rows[0][0]) if rows else default
+
+
+# Shared by every cog so all writes go through one connection
+state_store = StateStore()
@@ -0,0 +1,92 @@
+# Description: This file contains the StreamingReply class, which progressively edits a Discord reply while a response is generated.
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+DISCORD_MESSAGE_LIMIT = 2000
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', 'True').lower() == 'true'
+# Minimum seconds between edits of the same message; Discord allows about 5 edits per 5 seconds per channel
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.2))
+
+
+def split_point(text, limit=DISCORD_MESSAGE_LIMIT):
+    """Return where to cut text so the first part fits in one message, preferring line and word breaks."""
+    if len(text) <= limit:
+        return len(text)
+    for separator in ('\n', ' '):
+        index = text.rfind(separator, 0, limit)
+        if index >= limit // 2:
+            return index + 1
+    return limit
+
+
+class StreamingReply:
+    """Posts a reply as soon as text arrives and keeps editing it as more is generated.
+
+    Chunks received between edits are coalesced into a single edit, and the reply rolls
+    over to a new message once the current one reaches the 2000 character limit.
+    """
+
+    def __init__(self, channel, edit_interval=STREAM_EDIT_INTERVAL, strip_prefix=None):
+        self.channel = channel
+        self.edit_interval = edit_interval
+        self.strip_prefix = strip_prefix
+        self.text = ''
+        self.messages = []
+        self._start = 0  # Offset in the visible text where the current message begins
+        self._shown = ''  # Content of the current message as last sent
+        self._last_flush = 0.0
+
+    @property
+    def started(self):
+        return bool(self.messages)
+
+    def visible_text(self):
+        text = self.text
+        if self.strip_prefix:
+            while text.startswith(self.strip_prefix):
+                text = text[len(self.strip_prefix):]
+        return text
+
+    async def feed(self, chunk):
+        """Add generated text, editing the reply if the edit interval has passed."""
+        self.text += chunk
+        if self.strip_prefix and len(self.text) <= len(self.strip_prefix):
+            return  # Wait until we know whether the response starts with the prefix
+        if time.monotonic() - self._last_flush >= self.edit_interval:
+            await self.flush()
+
+    async def flush(self):
+        text = self.visible_text()
+        # Finalize full messages and roll over to a new one at the character limit
+        while len(text) - self._start > DISCORD_MESSAGE_LIMIT:
+            end = self._start + split_point(text[self._start:])
+            await self._show(text[self._start:end])
+            self._start = end
+            self._shown = ''
+        await self._show(text[self._start:])
+        self._last_flush = time.monotonic()
+
+    async def _show(self, content):
+        if not content.strip() or content == self._shown:
+            return
+        if self._shown:
+            await self.messages[-1].edit(content=content)
+        else:
+            self.messages.append(await self.channel.send(content))
+        self._shown = content
+
+    async def finish(self):
+        """Send whatever is left and return the full reply text."""
+        await self.flush()
+        return self.visible_text()
+
+
+async def send_streaming_reply(channel, chunks, strip_prefix=None):
+    """Stream an async iterable of text chunks into the channel and return the full text."""
+    reply = StreamingReply(channel, strip_prefix=strip_prefix)
+    async for chunk in chunks:
+        await reply.feed(chunk)
+    return await reply.finish()
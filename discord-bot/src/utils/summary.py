@@ -0,0 +1,132 @@
+# Description: This file contains the RollingSummary class, which folds old chat history into a running per-channel summary.
+import asyncio
+import logging
+import os
+from utils.context import token_estimator, truncate_to_tokens
+from utils.resilience import resilience
+from utils.router import model_router
+from utils.scheduler import PRIORITY_BACKGROUND, model_scheduler
+from utils.state import state_store
+
+logger = logging.getLogger(__name__)
+
+# Model used to fold history into the summary, can be cheaper than the chat model
+SUMMARY_MODEL = os.getenv('SUMMARY_MODEL', 'gemini-1.5-flash-002')
+# Unsummarized messages a channel may have before the oldest ones are folded into the summary
+SUMMARY_TRIGGER_MESSAGES = int(os.getenv('SUMMARY_TRIGGER_MESSAGES', 40))
+# Messages folded into the summary at a time
+SUMMARY_FOLD_MESSAGES = int(os.getenv('SUMMARY_FOLD_MESSAGES', 20))
+# Upper bound on the summary size, so the prompt stays the same size however long the chat runs
+SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', 400))
+
+FOLD_PROMPT = ("TASK: You maintain the running summary of a Discord conversation. "
+               "Update the summary with the new messages below. Keep who is involved, open questions, running jokes "
+               "and the exact state of any game being played (players, bets, hands, scores, bans). "
+               "Drop details that no longer matter. Reply with the updated summary only, in at most {words} words.\n"
+               "SUMMARY: {summary}\n"
+               "NEW MESSAGES:\n{messages}")
+
+
+class ChannelSummary:
+    """Running summary of a channel and the newest message folded into it."""
+    __slots__ = ('text', 'folded_through', 'task')
+
+    def __init__(self):
+        self.text = ""
+        self.folded_through = 0  # Message id, Discord ids increase over time
+        self.task = None
+
+
+class RollingSummary:
+    """Keeps a per-channel summary of everything older than the recent tail of the history.
+
+    Once a channel has more than trigger unsummarized messages, the oldest fold_size of them are
+    folded into the existing summary in the background. The summary is only ever updated with new
+    messages, never rebuilt from the whole history. Summaries are kept in the state store.
+    """
+
+    def __init__(self, history, model_name=SUMMARY_MODEL, trigger=SUMMARY_TRIGGER_MESSAGES,
+                 fold_size=SUMMARY_FOLD_MESSAGES, max_tokens=SUMMARY_MAX_TOKENS, store=state_store):
+        self.history = history
+        self.store = store
+        self.model_name = model_name
+        self.trigger = trigger
+        self.fold_size = fold_size
+        self.max_tokens = max_tokens
+        self._summaries = {}  # (guild_id, channel_id) -> ChannelSummary
+
+    @property
+    def model(self):
+        # Looked up lazily so vertexai.init has run by the time it is used
+        return model_router.model(self.model_name)
+
+    def _summary(self, channel):
+        return self._summaries.setdefault(self.history.key_for(channel), ChannelSummary())
+
+    @staticmethod
+    def _store_key(key):
+        return f"{key[0]}:{key[1]}"
+
+    async def ensure_loaded(self, channel):
+        """Load the stored summary of the channel the first time it is seen."""
+        key = self.history.key_for(channel)
+        if key in self._summaries:
+            return
+        stored = await self.store.get('summary', self._store_key(key))
+        if key in self._summaries:
+            return
+        summary = self._summaries[key] = ChannelSummary()
+        if stored:
+            summary.text, summary.folded_through = stored
+
+    def summary(self, channel):
+        """Return the summary text for the channel, empty if nothing was folded yet."""
+        summary = self._summaries.get(self.history.key_for(channel))
+        return summary.text if summary else ""
+
+    def tail(self, channel):
+        """Return the history entries not yet folded into the summary, oldest first."""
+        summary = self._summaries.get(self.history.key_for(channel))
+        entries = self.history.entries(channel)
+        if summary is None or not summary.folded_through:
+            return entries
+        return [entry for entry in entries if entry.message_id > summary.folded_through]
+
+    def maybe_fold(self, channel):
+        """Start folding in the background if the channel has outgrown its tail."""
+        summary = self._summary(channel)
+        if summary.task is not None and not summary.task.done():
+            return  # The running fold keeps going until the tail is short enough
+        if len(self.tail(channel)) > self.trigger:
+            summary.task = asyncio.create_task(self._fold(channel, summary))
+
+    def reset(self, channel):
+        key = self.history.key_for(channel)
+        summary = self._summaries.pop(key, None)
+        if summary is not None and summary.task is not None:
+            summary.task.cancel()
+        self.store.delete('summary', self._store_key(key))
+
+    async def _generate(self, channel, prompt):
+        async with model_router.timed(self.model):
+            return await self.model.generate_content_async(prompt)
+
+    async def _fold(self, channel, summary):
+        while len(self.tail(channel)) > self.trigger:
+            window = self.tail(channel)[:self.fold_size]
+            prompt = FOLD_PROMPT.format(words=int(self.max_tokens * 0.75),
+                                        summary=summary.text or "(nothing yet)",
+                                        messages="\n".join(entry.line for entry in window))
+            try:
+                response = await resilience.call(self.model_name, lambda: self._generate(channel, prompt),
+                                                 admit=lambda: model_scheduler.slot(PRIORITY_BACKGROUND, channel.guild.id))
+                text = response.text.strip()
+            except Exception as e:
+                logger.error(f"Failed to fold history into the summary for channel {channel.name}: {e}")
+                return
+            if token_estimator.estimate(text) > self.max_tokens:
+                text = truncate_to_tokens(text, self.max_tokens)
+            summary.text = text
+            summary.folded_through = window[-1].message_id
+            self.store.set('summary', self._store_key(self.history.key_for(channel)), [summary.text, summary.folded_through])
+            logger.info(f"Folded {len(window)} messages into the summary for channel {channel.name}: ~{token_estimator.estimate(text)} tokens")
@@ -0,0 +1,165 @@
+# Description: This file contains the TTSCache class, which reuses synthesized speech for repeated phrases from memory and an optional directory on disk.
+import asyncio
+import hashlib
+import logging
+import os
+import re
+from collections import OrderedDict
+from utils.cache import LRUCache
+from utils.workers import run_blocking
+
+logger = logging.getLogger(__name__)
+
+# Bytes of speech kept in memory
+TTS_CACHE_MAX_BYTES = int(os.getenv('TTS_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+# Directory of the on-disk tier, empty keeps speech in memory only
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR', 'data/tts')
+# Bytes of speech kept on disk, the least recently used files are deleted first
+TTS_CACHE_DISK_BYTES = int(os.getenv('TTS_CACHE_DISK_BYTES', 256 * 1024 * 1024))
+# Entries kept in memory whatever their size
+TTS_CACHE_MAX_ENTRIES = 4096
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    return WHITESPACE.sub(' ', text).strip()
+
+
+class TTSCache:
+    """Encoded speech keyed by (normalized text, lang, tld).
+
+    An LRU in memory capped in bytes sits in front of a directory of MP3 files capped in total
+    size, where the least recently used files are deleted first. Concurrent requests for the same
+    phrase share one synthesis.
+    """
+
+    def __init__(self, max_bytes=TTS_CACHE_MAX_BYTES, directory=TTS_CACHE_DIR, disk_bytes=TTS_CACHE_DISK_BYTES):
+        self._memory = LRUCache(TTS_CACHE_MAX_ENTRIES, maxbytes=max_bytes)
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self._files = None  # File name -> size, least recently used first, loaded on first use
+        self._index_lock = None  # Created on first use, inside the running event loop
+        self._inflight = {}  # key -> future of the audio being synthesized
+        self.disk_hits = 0
+        self.synthesized = 0
+
+    @staticmethod
+    def key(text, lang, tld):
+        return (normalize_text(text), lang, tld)
+
+    @staticmethod
+    def _file_name(key):
+        return hashlib.sha1('\0'.join(key).encode()).hexdigest() + '.mp3'
+
+    def _load_index(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.mp3'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+        return OrderedDict((name, size) for _, name, size in sorted(entries))
+
+    async def _index(self):
+        if self._files is None:
+            if self._index_lock is None:
+                self._index_lock = asyncio.Lock()
+            async with self._index_lock:
+                if self._files is None:
+                    self._files = await run_blocking(self._load_index)
+                    logger.info(f"Loaded {len(self._files)} cached speech files from {self.directory}")
+        return self._files
+
+    def _read_file(self, name):
+        path = os.path.join(self.directory, name)
+        with open(path, 'rb') as f:
+            audio = f.read()
+        os.utime(path)  # Mark as recently used for eviction after a restart
+        return audio
+
+    def _write_file(self, name, audio, evicted):
+        tmp_path = os.path.join(self.directory, name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(audio)
+        os.replace(tmp_path, os.path.join(self.directory, name))
+        for old in evicted:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except FileNotFoundError:
+                pass
+
+    async def _from_disk(self, key):
+        files = await self._index()
+        name = self._file_name(key)
+        if name not in files:
+            return None
+        try:
+            audio = await run_blocking(self._read_file, name)
+        except OSError as e:
+            logger.error(f"Failed to read cached speech {name}: {e}")
+            files.pop(name, None)
+            return None
+        files.move_to_end(name)
+        return audio
+
+    async def _to_disk(self, key, audio):
+        files = await self._index()
+        name = self._file_name(key)
+        files.pop(name, None)
+        files[name] = len(audio)
+        evicted = []
+        total = sum(files.values())
+        while total > self.disk_bytes and len(files) > 1:
+            old, size = files.popitem(last=False)
+            evicted.append(old)
+            total -= size
+        try:
+            await run_blocking(self._write_file, name, audio, evicted)
+        except OSError as e:
+            logger.error(f"Failed to write cached speech {name}: {e}")
+            files.pop(name, None)
+
+    def _remember(self, key, audio):
+        if len(audio) <= self._memory.maxbytes:
+            self._memory.set(key, audio)
+
+    async def fetch(self, text, lang, tld, synthesize):
+        """Return the speech of the text, synthesizing it with the blocking synthesize(text, lang, tld) on a miss."""
+        key = self.key(text, lang, tld)
+        audio = self._memory.get(key)
+        if audio is not None:
+            return audio
+        if key in self._inflight:
+            return await asyncio.shield(self._inflight[key])
+        future = self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            audio = await self._from_disk(key) if self.directory else None
+            if audio is not None:
+                self.disk_hits += 1
+            else:
+                audio = await run_blocking(synthesize, key[0], lang, tld)
+                self.synthesized += 1
+                if self.directory:
+                    asyncio.ensure_future(self._to_disk(key, audio))
+            self._remember(key, audio)
+            future.set_result(audio)
+            return audio
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Retrieved here so a phrase nobody else waited for isn't reported
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            del self._inflight[key]
+
+    def stats(self):
+        stats = dict(self._memory.stats(), disk_hits=self.disk_hits, synthesized=self.synthesized)
+        if self._files is not None:
+            stats.update(disk_files=len(self._files), disk_bytes=sum(self._files.values()))
+        return stats
+
+
+# Shared by every cog so each phrase is synthesized once
+tts_cache = TTSCache()
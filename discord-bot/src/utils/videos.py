@@ -0,0 +1,110 @@
+# Description: This file contains the ffmpeg video preprocessing stage that shrinks long clips before they are sent to Gemini.
+# The functions here run in worker processes, so they must stay picklable and free of event loop state.
+# ffmpeg reads the attachment from the temporary file it was downloaded to, or from any URL it is given. Transcodes are
+# written to a temporary file that is streamed to GCS,
+# the small keyframe strips and audio tracks come back through a pipe.
+import logging
+import os
+import subprocess
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+VIDEO_PREPROCESS = os.getenv('VIDEO_PREPROCESS', 'True').lower() == 'true'
+VIDEO_MAX_HEIGHT = int(os.getenv('VIDEO_MAX_HEIGHT', 480))
+VIDEO_FPS = int(os.getenv('VIDEO_FPS', 10))
+VIDEO_STRIP_COLUMNS = 4
+VIDEO_STRIP_ROWS = 3
+FFMPEG_TIMEOUT = int(os.getenv('FFMPEG_TIMEOUT', 300))
+
+# How each preset treats a video: clips shorter than 'full_under' seconds are sent untouched,
+# longer ones are either 'transcode'd to a small mp4 or turned into 'frames' (a keyframe strip plus a mono audio track).
+VIDEO_POLICIES = {
+    'coach': {'full_under': 30, 'long': 'transcode'},
+    'narrate': {'full_under': 30, 'long': 'frames'},
+    'roast': {'full_under': 15, 'long': 'frames'},
+    'default': {'full_under': 60, 'long': 'transcode'},
+}
+
+
+def run_ffmpeg(args):
+    """Run ffmpeg/ffprobe and return its stdout."""
+    result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=FFMPEG_TIMEOUT, check=False)
+    if result.returncode != 0:
+        raise RuntimeError(f"{args[0]} failed: {result.stderr.decode(errors='replace')[-500:]}")
+    return result.stdout
+
+
+def probe_duration(url):
+    output = run_ffmpeg(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', url])
+    return float(output.strip() or 0)
+
+
+def transcode(url):
+    """Re-encode to a low resolution, low frame rate mp4 with mono audio.
+
+    Returns the path of a temporary file, which the caller deletes.
+    """
+    fd, path = tempfile.mkstemp(prefix='transcode-', suffix='.mp4')
+    os.close(fd)
+    try:
+        run_ffmpeg([
+            'ffmpeg', '-v', 'error', '-y', '-i', url,
+            '-vf', f"scale=-2:'min({VIDEO_MAX_HEIGHT},ih)',fps={VIDEO_FPS}",
+            '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '30',
+            '-c:a', 'aac', '-ac', '1', '-b:a', '48k',
+            '-movflags', '+faststart', '-f', 'mp4', path,
+        ])
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
+def keyframe_strip(url, duration):
+    """Sample keyframes evenly across the clip and tile them into a single jpeg."""
+    frames = VIDEO_STRIP_COLUMNS * VIDEO_STRIP_ROWS
+    return run_ffmpeg([
+        # Only decoding keyframes keeps this fast even for long clips
+        'ffmpeg', '-v', 'error', '-skip_frame', 'nokey', '-i', url,
+        '-vf', f"fps={frames}/{max(duration, 1):.3f},scale=-2:{VIDEO_MAX_HEIGHT // 2},tile={VIDEO_STRIP_COLUMNS}x{VIDEO_STRIP_ROWS}",
+        '-frames:v', '1', '-f', 'image2pipe', '-c:v', 'mjpeg', 'pipe:1',
+    ])
+
+
+def downmixed_audio(url):
+    return run_ffmpeg([
+        'ffmpeg', '-v', 'error', '-i', url,
+        '-vn', '-ac', '1', '-ar', '16000', '-b:a', '32k', '-f', 'mp3', 'pipe:1',
+    ])
+
+
+def video_policy(preset):
+    """Return the name of the policy the preset uses."""
+    return preset if preset in VIDEO_POLICIES else 'default'
+
+
+def video_mode(duration, preset):
+    policy = VIDEO_POLICIES[video_policy(preset)]
+    return 'full' if duration < policy['full_under'] else policy['long']
+
+
+def preprocess_video(url, preset=None):
+    """Prepare a video for Gemini according to the preset's policy.
+
+    Returns a list of (content, mime type), where content is bytes or the path of a temporary file,
+    or None when the original video should be sent.
+    """
+    duration = probe_duration(url)
+    mode = video_mode(duration, preset)
+    logger.info(f"Video of {duration:.1f}s with preset {preset}: {mode}")
+    if mode == 'transcode':
+        return [(transcode(url), 'video/mp4')]
+    if mode == 'frames':
+        outputs = [(keyframe_strip(url, duration), 'image/jpeg')]
+        try:
+            outputs.append((downmixed_audio(url), 'audio/mpeg'))
+        except RuntimeError:
+            logger.info("Video has no audio track, sending the keyframe strip only")
+        return outputs
+    return None
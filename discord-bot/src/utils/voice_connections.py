@@ -0,0 +1,113 @@
+# Description: This file contains the VoiceConnections class, which keeps a warm voice connection per guild and closes it after a period of silence.
+import asyncio
+import logging
+import os
+from utils.playback import playback
+
+logger = logging.getLogger(__name__)
+
+# Seconds without playback before the bot leaves a voice channel
+VOICE_IDLE_TIMEOUT = float(os.getenv('VOICE_IDLE_TIMEOUT', 300))
+
+
+class VoiceConnections:
+    """Voice connections kept open per guild between replies.
+
+    connect() reuses the guild's connection when it is still up, moves it when the speaker is in
+    another channel and only reconnects when it has dropped. A connection is closed once the
+    guild's playback queue has been idle for idle_timeout seconds.
+    """
+
+    def __init__(self, idle_timeout=VOICE_IDLE_TIMEOUT, queue=playback):
+        self.idle_timeout = idle_timeout
+        self.queue = queue
+        self.queue.add_idle_listener(self._on_idle)
+        self._clients = {}  # guild id -> VoiceClient
+        self._timers = {}  # guild id -> TimerHandle of the idle disconnect
+        self._locks = {}
+        self.connects = 0
+        self.reconnects = 0
+        self.reuses = 0
+        self.moves = 0
+        self.idle_disconnects = 0
+
+    async def connect(self, channel):
+        """Return a connected voice client in the channel, reusing the guild's connection when possible."""
+        guild = channel.guild
+        lock = self._locks.setdefault(guild.id, asyncio.Lock())
+        async with lock:
+            self._cancel_timer(guild.id)
+            voice_client = guild.voice_client
+            if voice_client is not None and voice_client.is_connected():
+                if voice_client.channel != channel:
+                    await voice_client.move_to(channel)
+                    self.moves += 1
+                else:
+                    self.reuses += 1
+            else:
+                if voice_client is not None:
+                    # Dropped connection, throw it away and reconnect
+                    await voice_client.disconnect(force=True)
+                    self.reconnects += 1
+                else:
+                    self.connects += 1
+                voice_client = await channel.connect()
+                logger.info(f"Connected to voice channel {channel.name} in {guild.name}")
+            self._clients[guild.id] = voice_client
+            # Covers connections that never get anything to play
+            if self.queue.is_idle(guild):
+                self._schedule_timer(guild.id)
+        return voice_client
+
+    async def disconnect(self, guild):
+        """Leave the guild's voice channel now."""
+        self._cancel_timer(guild.id)
+        self._clients.pop(guild.id, None)
+        if guild.voice_client is not None:
+            self.queue.clear(guild)
+            await guild.voice_client.disconnect()
+
+    def _on_idle(self, guild_id):
+        if guild_id in self._clients:
+            self._schedule_timer(guild_id)
+
+    def _schedule_timer(self, guild_id):
+        self._cancel_timer(guild_id)
+        loop = asyncio.get_running_loop()
+        self._timers[guild_id] = loop.call_later(self.idle_timeout, lambda: asyncio.ensure_future(self._idle_timeout(guild_id)))
+
+    def _cancel_timer(self, guild_id):
+        timer = self._timers.pop(guild_id, None)
+        if timer is not None:
+            timer.cancel()
+
+    async def _idle_timeout(self, guild_id):
+        self._timers.pop(guild_id, None)
+        voice_client = self._clients.get(guild_id)
+        if voice_client is None or not self.queue.is_idle(voice_client.guild):
+            return
+        lock = self._locks.setdefault(guild_id, asyncio.Lock())
+        if lock.locked():
+            return  # Being reused right now
+        self._clients.pop(guild_id, None)
+        if voice_client.is_connected():
+            logger.info(f"Leaving voice in {voice_client.guild.name} after {self.idle_timeout:.0f}s without playback")
+            self.idle_disconnects += 1
+            await voice_client.disconnect()
+
+    def stats(self):
+        opened = self.connects + self.reconnects
+        requests = opened + self.reuses + self.moves
+        return {
+            'connected': sum(client.is_connected() for client in self._clients.values()),
+            'connects': self.connects,
+            'reconnects': self.reconnects,
+            'reuses': self.reuses,
+            'moves': self.moves,
+            'idle_disconnects': self.idle_disconnects,
+            'reuse_rate': round((self.reuses + self.moves) / requests, 3) if requests else 0.0,
+        }
+
+
+# Shared by every cog so each guild has one connection
+voice_connections = VoiceConnections()
@@ -0,0 +1,42 @@
+# Description: This file contains helpers for running blocking and CPU heavy work without stalling the event loop.
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of model generations in flight across all guilds, enforced by the scheduler
+MODEL_CONCURRENCY = int(os.getenv('MODEL_CONCURRENCY', 8))
+# Threads available for blocking SDK calls (image generation, storage, tts)
+BLOCKING_WORKERS = int(os.getenv('BLOCKING_WORKERS', MODEL_CONCURRENCY))
+# Processes available for CPU heavy media preprocessing
+PROCESS_WORKERS = int(os.getenv('PROCESS_WORKERS', min(4, os.cpu_count() or 1)))
+
+_thread_pool = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix='blocking')
+_process_pool = None
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking callable in the shared thread pool and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_thread_pool, functools.partial(func, *args, **kwargs))
+
+
+def get_process_pool():
+    """Return the process pool for CPU bound work, created on first use.
+
+    Workers are spawned rather than forked so they don't inherit the gRPC and event loop threads.
+    """
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=PROCESS_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _process_pool
+
+
+async def run_in_process(func, *args):
+    """Run a picklable module level function in the process pool and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), func, *args)
@@ -0,0 +1,5 @@
+# Description: Shared pytest setup, which puts the bot sources on the import path the way bot.py runs them.
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
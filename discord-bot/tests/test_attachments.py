@@ -0,0 +1,149 @@
+# Description: Tests of the attachment pipeline with a fake Discord CDN and fake uploads: every byte is downloaded once.
+import asyncio
+import hashlib
+import os
+from types import SimpleNamespace
+import pytest
+import utils.attachments as attachments
+import utils.helpers as helpers
+
+LARGE = attachments.ATTACHMENT_INLINE_MAX_BYTES + 1
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.status = 200 if body is not None else 404
+        self.body = body
+        self.content = self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def read(self):
+        return self.body
+
+    async def iter_chunked(self, size):
+        for start in range(0, len(self.body), size):
+            yield self.body[start:start + size]
+
+
+class FakeCDN:
+    """Serves attachment bodies by URL and counts the downloads of each."""
+
+    def __init__(self):
+        self.files = {}
+        self.downloads = {}
+
+    def add(self, attachment_id, content_type, body):
+        url = f"https://cdn.example/{attachment_id}"
+        self.files[url] = body
+        return SimpleNamespace(id=attachment_id, url=url, filename=f"file{attachment_id}", content_type=content_type, size=len(body))
+
+    def get(self, url):
+        self.downloads[url] = self.downloads.get(url, 0) + 1
+        return FakeResponse(self.files[url])
+
+
+@pytest.fixture
+def cdn(monkeypatch):
+    cdn = FakeCDN()
+    monkeypatch.setattr(attachments, 'get_http_session', lambda: cdn)
+    return cdn
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    """Uploads land in a dict of blob name -> bytes read from the uploaded file."""
+    uploaded = {}
+
+    async def upload_file(path, bucket_name, blob_name, content_type):
+        with open(path, 'rb') as f:
+            uploaded[blob_name] = f.read()
+        return SimpleNamespace(name=blob_name, bucket=SimpleNamespace(name=bucket_name))
+
+    monkeypatch.setattr(attachments, 'upload_file', upload_file)
+    monkeypatch.setattr(attachments, 'VIDEO_PREPROCESS', False)
+    monkeypatch.setattr(helpers, 'attachment_uploads', helpers.LRUCache(16))
+    return uploaded
+
+
+MESSAGE = SimpleNamespace(id=7)
+
+
+async def prepare(items, preset=None):
+    fingerprints = await helpers.fingerprint_attachments(items)
+    try:
+        return fingerprints, await helpers.prepare_attachments(MESSAGE, items, fingerprints, 'bucket', preset)
+    finally:
+        await helpers.discard_fingerprints(fingerprints)
+
+
+def test_large_files_are_downloaded_once_and_uploaded_from_disk(cdn, uploads):
+    body = os.urandom(LARGE)
+    attachment = cdn.add(1, 'video/mp4', body)
+
+    async def scenario():
+        fingerprints, _ = await prepare([attachment])
+        (digest, path, _), = fingerprints
+        assert digest == hashlib.sha256(body).hexdigest()
+        assert not os.path.exists(path)
+
+    asyncio.run(scenario())
+    assert cdn.downloads == {attachment.url: 1}
+    assert list(uploads.values()) == [body]
+
+
+def test_reposts_reuse_the_upload(cdn, uploads):
+    body = os.urandom(LARGE)
+    first = cdn.add(1, 'video/mp4', body)
+    repost = cdn.add(2, 'video/mp4', body)
+
+    async def scenario():
+        _, (first_parts,) = await prepare([first])
+        _, (repost_parts,) = await prepare([repost])
+        assert repost_parts is first_parts
+
+    asyncio.run(scenario())
+    assert len(uploads) == 1
+    assert cdn.downloads == {first.url: 1, repost.url: 1}
+
+
+def test_videos_are_preprocessed_from_the_downloaded_file(cdn, uploads, monkeypatch):
+    body = os.urandom(1024)
+    attachment = cdn.add(1, 'video/mp4', body)
+    sources = []
+
+    def preprocess_video(source, preset=None):
+        with open(source, 'rb') as f:
+            sources.append(f.read())
+        return None  # Short enough to send as is
+
+    async def run_in_process(func, *args):
+        return func(*args)
+
+    monkeypatch.setattr(attachments, 'VIDEO_PREPROCESS', True)
+    monkeypatch.setattr(attachments, 'preprocess_video', preprocess_video)
+    monkeypatch.setattr(attachments, 'run_in_process', run_in_process)
+
+    async def scenario():
+        _, (parts,) = await prepare([attachment], preset='coach')
+        assert len(parts) == 1
+
+    asyncio.run(scenario())
+    assert sources == [body]
+    assert cdn.downloads == {attachment.url: 1}
+    assert uploads == {}
+
+
+def test_a_failed_download_leaves_no_temporary_files(cdn, monkeypatch, tmp_path):
+    monkeypatch.setattr(attachments.tempfile, 'tempdir', str(tmp_path))
+    good = cdn.add(1, 'video/mp4', os.urandom(LARGE))
+    bad = cdn.add(2, 'video/mp4', os.urandom(LARGE))
+    cdn.files[bad.url] = None
+
+    with pytest.raises(attachments.DownloadError):
+        asyncio.run(helpers.fingerprint_attachments([good, bad]))
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,141 @@
+# Description: Tests of the blackjack engine, played on a stacked shoe so every round is deterministic.
+import random
+import pytest
+from utils.blackjack import RANKS, BlackjackTable, parse_action
+
+# Cards dealt before the shoe is reshuffled, kept under the stacked cards
+FILLER = [0] * (13 * 6)
+
+
+def card(rank):
+    return RANKS.index(rank)
+
+
+def table_with(*ranks, players=('alice',), bet='10'):
+    """A table where everyone has bet and the shoe deals the ranks in order, players first then the dealer."""
+    table = BlackjackTable(rng=random.Random(0))
+    table.shoe.cards = FILLER + [card(rank) for rank in reversed(ranks)]
+    for name in players:
+        table.act(name, 'join')
+        table.act(name, 'bet', bet)
+    return table
+
+
+def chips(table, name='alice'):
+    return table.players[name].chips
+
+
+@pytest.mark.parametrize('content, expected', [
+    ("hit", ('hit', "")),
+    ("hit me", ('hit', "")),
+    ("Stand.", ('stand', "")),
+    ("stay", ('stand', "")),
+    ("!split up", ('split', "up")),
+    ("bet 20", ('bet', "20")),
+    ("bet 20 chips", ('bet', "20")),
+    ("bet my watch", ('bet', "my watch")),
+    ("!bet a round of drinks", ('bet', "a round of drinks")),
+])
+def test_parse_action_commands(content, expected):
+    assert parse_action(content) == expected
+
+
+@pytest.mark.parametrize('content', [
+    "bet you can't", "leave me alone", "deal with it", "stay here", "double it", "split up", "bet", "hello",
+])
+def test_parse_action_ignores_chat(content):
+    assert parse_action(content) is None
+
+
+def test_win_pays_even_money():
+    table = table_with('10', '9', '10', '8')
+    table.act('alice', 'deal')
+    lines = table.act('alice', 'stand')
+    assert chips(table) == 110
+    assert lines[-1] == "alice: wins 10, 110 chips."
+    assert table.settled == 1
+
+
+def test_natural_blackjack_pays_three_to_two_and_settles_at_the_deal():
+    table = table_with('A', 'K', '10', '7')
+    table.act('alice', 'deal')
+    assert table.phase == 'betting'
+    assert table.settled == 1
+    assert chips(table) == 115
+
+
+def test_dealer_blackjack_settles_at_the_deal():
+    table = table_with('10', '9', 'A', 'K')
+    lines = table.act('alice', 'deal')
+    assert "Dealer has blackjack." in lines
+    assert table.settled == 1
+    assert chips(table) == 90
+
+
+def test_blackjack_against_dealer_blackjack_pushes():
+    table = table_with('A', 'Q', 'A', 'K')
+    table.act('alice', 'deal')
+    assert chips(table) == 100
+
+
+def test_bust_loses_and_dealer_does_not_draw():
+    table = table_with('10', '6', '10', '6', 'K')
+    table.act('alice', 'deal')
+    lines = table.act('alice', 'hit')
+    assert "Bust!" in lines[0]
+    assert chips(table) == 90
+    # The dealer keeps 16 since no hand is left to beat
+    assert table.shoe.cards == FILLER
+
+
+def test_push_returns_the_bet():
+    table = table_with('10', '8', '10', '8')
+    table.act('alice', 'deal')
+    table.act('alice', 'stand')
+    assert chips(table) == 100
+
+
+def test_double_pays_twice_the_bet():
+    table = table_with('6', '5', '10', '7', '10')
+    table.act('alice', 'deal')
+    lines = table.act('alice', 'double')
+    assert lines[0].startswith("alice doubles down")
+    assert chips(table) == 120
+
+
+def test_double_needs_the_chips():
+    table = table_with('6', '5', '10', '7', '10', bet='60')
+    table.act('alice', 'deal')
+    assert table.act('alice', 'double') == ["alice, you don't have the chips to double."]
+    assert table.phase == 'playing'
+
+
+def test_split_plays_each_hand_for_its_own_stake():
+    # alice splits eights, draws 10 and 3 to them, then hits the 11 to 21; the dealer stands on 18
+    table = table_with('8', '8', '10', '8', '10', '3', '10')
+    table.act('alice', 'deal')
+    table.act('alice', 'split')
+    assert chips(table) == 80
+    table.act('alice', 'stand')
+    table.act('alice', 'hit')
+    # 18 pushes, 21 wins
+    assert chips(table) == 80 + 10 + 20
+    assert table.settled == 1
+
+
+def test_split_ace_and_ten_is_not_a_blackjack():
+    # Split aces get one card each; A+K after a split is 21, not a blackjack, so it pushes a dealer 21
+    table = table_with('A', 'A', '10', '6', 'K', '9', '5')
+    table.act('alice', 'deal')
+    lines = table.act('alice', 'split')
+    assert "blackjack" not in lines[0]
+    hands = table.players['alice'].hands
+    assert hands == []  # Both hands were done, so the round settled
+    # A+K pushes the dealer's 21 instead of being paid 3:2, A+9 loses
+    assert chips(table) == 80 + 10
+
+
+def test_item_bets_are_told_in_the_third_person():
+    table = BlackjackTable(rng=random.Random(0))
+    table.act('alice', 'join')
+    assert table.act('alice', 'bet', "my watch") == ["alice bets their watch."]
@@ -0,0 +1,109 @@
+# Description: Tests of the reply debouncer's quiet window, max_wait, cancellation and follow-up turns.
+import asyncio
+from types import SimpleNamespace
+from utils.debounce import ReplyDebouncer
+
+CHANNEL = SimpleNamespace(id=1, name='chat')
+
+
+def message(message_id):
+    return SimpleNamespace(id=message_id, channel=CHANNEL)
+
+
+class Handler:
+    """Records the messages it is started and finishes with, taking seconds per reply."""
+
+    def __init__(self, debouncer, seconds=0.0, posting_after=None, fail=False):
+        self.debouncer = debouncer
+        self.seconds = seconds
+        self.posting_after = posting_after
+        self.fail = fail
+        self.started = []
+        self.finished = []
+
+    async def __call__(self, message):
+        self.started.append(message.id)
+        if self.posting_after is not None:
+            await asyncio.sleep(self.posting_after)
+            self.debouncer.mark_posting(message.channel)
+        await asyncio.sleep(self.seconds)
+        if self.fail:
+            self.fail = False
+            raise RuntimeError("reply failed")
+        self.finished.append(message.id)
+
+
+async def settle(debouncer):
+    turn = debouncer._turns[CHANNEL.id]
+    while turn.task is not None and not turn.task.done():
+        await turn.task
+
+
+def test_a_burst_gets_one_reply_to_its_latest_message():
+    async def scenario():
+        debouncer = ReplyDebouncer(quiet=0.05, max_wait=1.0)
+        handler = Handler(debouncer)
+        for message_id in range(3):
+            debouncer.submit(message(message_id), handler)
+            await asyncio.sleep(0.01)
+        await settle(debouncer)
+        assert (handler.started, handler.finished) == ([2], [2])
+    asyncio.run(scenario())
+
+
+def test_steady_chatter_is_answered_after_max_wait():
+    async def scenario():
+        debouncer = ReplyDebouncer(quiet=0.05, max_wait=0.1)
+        handler = Handler(debouncer)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for message_id in range(6):
+            debouncer.submit(message(message_id), handler)
+            await asyncio.sleep(0.03)
+        assert handler.finished and handler.finished[0] < 5
+        assert loop.time() - started < 0.3
+        await settle(debouncer)
+    asyncio.run(scenario())
+
+
+def test_a_reply_is_restarted_until_it_posts():
+    async def scenario():
+        debouncer = ReplyDebouncer(quiet=0.01, max_wait=1.0)
+        handler = Handler(debouncer, seconds=0.05, posting_after=0.05)
+        debouncer.submit(message(1), handler)
+        await asyncio.sleep(0.03)
+        # Still generating, the reply starts over with the new message
+        debouncer.submit(message(2), handler)
+        await asyncio.sleep(0.08)
+        # Posting by now, the reply is kept and the message answered afterwards
+        debouncer.submit(message(3), handler)
+        await settle(debouncer)
+        assert handler.started == [1, 2, 3]
+        assert handler.finished == [2, 3]
+    asyncio.run(scenario())
+
+
+def test_messages_after_max_wait_get_a_followup_turn():
+    async def scenario():
+        debouncer = ReplyDebouncer(quiet=0.01, max_wait=0.05)
+        handler = Handler(debouncer, seconds=0.1)
+        debouncer.submit(message(1), handler)
+        await asyncio.sleep(0.06)
+        debouncer.submit(message(2), handler)
+        debouncer.submit(message(3), handler)
+        await settle(debouncer)
+        assert handler.finished == [1, 3]
+    asyncio.run(scenario())
+
+
+def test_a_failed_reply_still_runs_the_followup():
+    async def scenario():
+        debouncer = ReplyDebouncer(quiet=0.01, max_wait=1.0)
+        handler = Handler(debouncer, seconds=0.05, posting_after=0.0, fail=True)
+        debouncer.submit(message(1), handler)
+        await asyncio.sleep(0.03)
+        debouncer.submit(message(2), handler)
+        await settle(debouncer)
+        assert handler.started == [1, 2]
+        assert handler.finished == [2]
+    asyncio.run(scenario())
@@ -0,0 +1,187 @@
+# Description: Tests of the long-term memory index, run offline with the hashing embedder.
+import asyncio
+from types import SimpleNamespace
+import numpy as np
+from utils.history import ChannelHistoryStore
+from utils.memory import HashingEmbedder, MemoryIndex
+from utils.state import StateStore
+
+GUILD_ID = 1
+CHANNEL_ID = 2
+KEY = (GUILD_ID, CHANNEL_ID)
+
+
+async def _no_history(**kwargs):
+    return
+    yield
+
+
+CHANNEL = SimpleNamespace(id=CHANNEL_ID, name='chat', guild=SimpleNamespace(id=GUILD_ID), history=_no_history)
+
+
+def message(message_id, content, author='alice'):
+    return SimpleNamespace(id=message_id, content=content, author=SimpleNamespace(name=author), channel=CHANNEL)
+
+
+class Room:
+    """A channel whose history keeps one message, so every older message goes to long-term memory."""
+
+    def __init__(self, tmp_path, capacity=16):
+        self.store = StateStore(path=str(tmp_path / 'state.db'))
+        self.history = ChannelHistoryStore(max_messages=1, store=self.store)
+        self.index = self.open_index(tmp_path, capacity)
+
+    def open_index(self, tmp_path, capacity=16):
+        index = MemoryIndex(embedder=HashingEmbedder(), capacity=capacity, directory=str(tmp_path / 'memory'), store=self.store)
+        index.attach(self.history)
+        return index
+
+    async def start(self):
+        await self.history.ensure_seeded(CHANNEL)
+        await self.index.ensure_loaded(CHANNEL)
+
+    async def post(self, *contents):
+        for content in contents:
+            self.history.append(message(self.next_id(), content))
+        await self.embedded()
+
+    def next_id(self):
+        self.last_id = getattr(self, 'last_id', 100) + 1
+        return self.last_id
+
+    async def embedded(self):
+        while self.index._worker is not None and not self.index._worker.done():
+            await self.index._worker
+
+    async def recall(self, query):
+        return await self.index.recall(CHANNEL, query, min_score=0.3)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_recalls_similar_old_messages(tmp_path):
+    async def scenario():
+        room = Room(tmp_path)
+        await room.start()
+        await room.post("pineapple belongs on pizza", "the football match ended two to one", "anyway")
+        assert await room.recall("is pineapple pizza good") == ["alice: pineapple belongs on pizza"]
+        assert await room.recall("who won the football match") == ["alice: the football match ended two to one"]
+    run(scenario())
+
+
+def test_deleted_messages_are_forgotten(tmp_path):
+    async def scenario():
+        room = Room(tmp_path)
+        await room.start()
+        await room.post("my secret is the blue door code", "anyway")
+        secret_id = room.last_id - 1
+        room.history.delete(KEY, secret_id)
+        assert await room.recall("what is the blue door code") == []
+        memory = room.index._channels[KEY]
+        assert memory.count == 0
+        assert not np.any(memory.vectors)
+        # Nothing comes back after a restart either
+        await room.store.flush()
+        assert await room.store.load_memories(KEY) == []
+    run(scenario())
+
+
+def test_edited_messages_are_embedded_again(tmp_path):
+    async def scenario():
+        room = Room(tmp_path)
+        await room.start()
+        await room.post("meet me at the old harbour", "anyway")
+        edited_id = room.last_id - 1
+        room.history.edit(KEY, edited_id, "meet me at the train station")
+        await room.embedded()
+        assert await room.recall("old harbour") == []
+        assert await room.recall("train station") == ["alice: meet me at the train station"]
+    run(scenario())
+
+
+class GatedEmbedder(HashingEmbedder):
+    """Holds document embeddings until released, to act while a batch is in flight."""
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.started = asyncio.Event()
+
+    async def embed(self, texts, query=False):
+        if not query:
+            self.started.set()
+            await self.release.wait()
+        return await super().embed(texts, query)
+
+
+def test_messages_deleted_while_embedding_are_dropped(tmp_path):
+    async def scenario():
+        room = Room(tmp_path)
+        room.index.embedder = embedder = GatedEmbedder()
+        await room.start()
+        room.history.append(message(room.next_id(), "the vault code is hidden under the mat"))
+        room.history.append(message(room.next_id(), "anyway"))
+        await embedder.started.wait()
+        room.history.delete(KEY, room.last_id - 1)
+        embedder.release.set()
+        await room.embedded()
+        assert room.index._channels[KEY].count == 0
+    run(scenario())
+
+
+def test_oldest_messages_are_evicted_first(tmp_path):
+    async def scenario():
+        room = Room(tmp_path, capacity=2)
+        await room.start()
+        await room.post("volcanoes erupt lava", "glaciers carve valleys", "deserts have dunes", "anyway")
+        memory = room.index._channels[KEY]
+        assert memory.count == 2
+        assert await room.recall("volcanoes lava") == []
+        assert await room.recall("deserts dunes") == ["alice: deserts have dunes"]
+    run(scenario())
+
+
+def test_forgotten_rows_are_reused_and_restored(tmp_path):
+    async def scenario():
+        room = Room(tmp_path, capacity=2)
+        await room.start()
+        await room.post("volcanoes erupt lava", "glaciers carve valleys", "anyway")
+        room.history.delete(KEY, room.last_id - 2)
+        await room.post("deserts have dunes")
+        await room.store.flush()
+        # A fresh index over the same files remembers exactly what is left
+        room.index = room.open_index(tmp_path, capacity=2)
+        await room.index.ensure_loaded(CHANNEL)
+        assert room.index._channels[KEY].count == 2
+        assert await room.recall("volcanoes lava") == []
+        assert await room.recall("glaciers valleys") == ["alice: glaciers carve valleys"]
+    run(scenario())
+
+
+def test_changes_in_channels_without_memories_write_nothing(tmp_path):
+    async def scenario():
+        room = Room(tmp_path)
+        await room.start()
+        await room.store.flush()
+        room.history.delete((GUILD_ID, 99), 555)
+        room.history.edit((GUILD_ID, 99), 556, "edited elsewhere")
+        assert room.store._pending == []
+    run(scenario())
+
+
+def test_messages_deleted_before_their_channel_is_loaded_are_not_restored(tmp_path):
+    async def scenario():
+        room = Room(tmp_path)
+        await room.start()
+        await room.post("my secret is the blue door code", "anyway")
+        await room.store.flush()
+        # After a restart the channel isn't loaded until it is next used
+        room.history = ChannelHistoryStore(max_messages=1, store=room.store)
+        room.index = room.open_index(tmp_path)
+        room.history.delete(KEY, room.last_id - 1)
+        assert [sql for sql, _ in room.store._pending if 'memories' in sql] == ["DELETE FROM memories WHERE guild_id = ? AND channel_id = ? AND message_id = ?"]
+        await room.index.ensure_loaded(CHANNEL)
+        assert room.index._channels[KEY].count == 0
+        assert await room.recall("what is the blue door code") == []
+    run(scenario())
@@ -0,0 +1,131 @@
+# Description: Tests of the prompt prefix cache and its fallback to plain prompts, with fake cache backends.
+import asyncio
+from google.api_core import exceptions as google_exceptions
+import pytest
+import utils.helpers as helpers
+from utils.prompt_cache import ContextCache, is_cache_expired
+
+SHORT_PREFIX = "You are the dealer. "
+LONG_PREFIX = "word " * 40000
+
+
+class FakeBackend:
+    """Records what it was asked to cache, the models it returns are plain strings."""
+
+    def __init__(self, name, min_tokens, saves_tokens):
+        self.name = name
+        self.min_tokens = min_tokens
+        self.saves_tokens = saves_tokens
+        self.created = []
+        self.extended = 0
+
+    async def create(self, model_name, prefix, ttl):
+        self.created.append(model_name)
+        return f"{self.name}:{model_name}", object()
+
+    async def extend(self, handle, ttl):
+        self.extended += 1
+
+    async def delete(self, handle):
+        pass
+
+
+def make_cache(mode='auto', ttl=3600):
+    backends = {'vertex': FakeBackend('vertex', 32768, True), 'local': FakeBackend('local', 0, False)}
+    return ContextCache(mode=mode, ttl=ttl, backends=backends), backends
+
+
+async def lookup(cache, prefix, model_name='gemini'):
+    """Look the prefix up, let its background registration finish, and look it up again."""
+    first = await cache.model_for(model_name, prefix)
+    await asyncio.sleep(0)
+    return first, await cache.model_for(model_name, prefix)
+
+
+def test_long_prefixes_are_cached_on_vertex():
+    async def scenario():
+        cache, backends = make_cache()
+        assert await lookup(cache, LONG_PREFIX) == (None, 'vertex:gemini')
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['passthrough'], stats['prefixes']) == (1, 1, 0, 1)
+        assert backends['local'].created == []
+    asyncio.run(scenario())
+
+
+def test_short_prefixes_are_reported_as_passthrough():
+    async def scenario():
+        cache, backends = make_cache()
+        assert await lookup(cache, SHORT_PREFIX) == (None, 'local:gemini')
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['passthrough']) == (0, 0, 2)
+        assert (stats['prefixes'], stats['passthrough_prefixes'], stats['hit_rate']) == (0, 1, 0.0)
+        assert backends['vertex'].created == []
+    asyncio.run(scenario())
+
+
+def test_off_sends_plain_prompts():
+    async def scenario():
+        cache, backends = make_cache(mode='off')
+        assert await lookup(cache, LONG_PREFIX) == (None, None)
+        assert backends['vertex'].created == backends['local'].created == []
+    asyncio.run(scenario())
+
+
+def test_expired_prefixes_are_registered_again():
+    async def scenario():
+        cache, backends = make_cache(ttl=0)
+        assert await lookup(cache, LONG_PREFIX) == (None, None)
+        await asyncio.sleep(0)
+        assert cache.expired == 1
+        assert len(backends['vertex'].created) == 2
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize('error, expired', [
+    (google_exceptions.NotFound("CachedContent not found"), True),
+    (google_exceptions.InvalidArgument("Cached content projects/p/cachedContents/1 has expired"), True),
+    (google_exceptions.InvalidArgument("Request contains an invalid argument."), False),
+    (google_exceptions.FailedPrecondition("Project is not allowed to use this model"), False),
+])
+def test_is_cache_expired(error, expired):
+    assert is_cache_expired(error) is expired
+
+
+class Route:
+    name = 'gemini'
+    model = 'plain-model'
+
+
+def fake_stream(error, calls):
+    async def generate_content_stream(model, contents, message=None, priority=None):
+        calls.append((model, contents))
+        if model != 'plain-model':
+            raise error
+        yield "reply"
+    return generate_content_stream
+
+
+@pytest.mark.parametrize('error, falls_back', [
+    (google_exceptions.NotFound("CachedContent not found"), True),
+    (google_exceptions.InvalidArgument("Request contains an invalid argument."), False),
+])
+def test_only_expired_caches_fall_back_to_the_plain_prompt(monkeypatch, error, falls_back):
+    async def scenario():
+        cache, _ = make_cache()
+        monkeypatch.setattr(helpers, 'context_cache', cache)
+        calls = []
+        monkeypatch.setattr(helpers, 'generate_content_stream', fake_stream(error, calls))
+        await lookup(cache, LONG_PREFIX)
+
+        async def reply():
+            return [chunk async for chunk in helpers.generate_content_stream_with_prefix(Route(), LONG_PREFIX, "tail")]
+
+        if falls_back:
+            assert await reply() == ["reply"]
+            assert calls[-1] == ('plain-model', f"{LONG_PREFIX}\ntail")
+            assert cache.stats()['prefixes'] == 0  # Registered again on next use
+        else:
+            with pytest.raises(type(error)):
+                await reply()
+            assert len(calls) == 1
+    asyncio.run(scenario())
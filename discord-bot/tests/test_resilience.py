@@ -0,0 +1,180 @@
+# Description: Tests of deadlines, hedging, retries and the circuit breaker around model calls, with fake async models.
+import asyncio
+import pytest
+import utils.resilience as resilience_module
+from utils.resilience import Resilience
+from utils.scheduler import ModelScheduler
+
+
+def test_time_queued_for_a_slot_is_not_hedged_or_timed_out(monkeypatch):
+    monkeypatch.setattr(resilience_module, 'MODEL_HEDGE_DELAY', 0.05)
+
+    async def scenario():
+        resilience = Resilience(hedge=True, retries=0, timeout=0.2)
+        scheduler = ModelScheduler(concurrency=1)
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'answer'
+
+        async def busy():
+            async with scheduler.slot():
+                await asyncio.sleep(0.3)
+
+        holder = asyncio.ensure_future(busy())
+        await asyncio.sleep(0)
+        result = await resilience.call('gemini', call, hedge=True, admit=scheduler.slot)
+        await holder
+        assert result == 'answer'
+        assert calls == [1]
+        assert resilience.hedges == 0
+        assert resilience.breaker('gemini').failures == 0
+        assert resilience.stats()['first_answer']['gemini']['p95'] < 0.1
+    asyncio.run(scenario())
+
+
+def test_streams_are_timed_from_admission(monkeypatch):
+    monkeypatch.setattr(resilience_module, 'MODEL_HEDGE_DELAY', 0.05)
+
+    async def scenario():
+        resilience = Resilience(hedge=True, retries=0, first_chunk_timeout=0.2)
+        scheduler = ModelScheduler(concurrency=1)
+
+        async def open_stream():
+            yield 'a'
+            yield 'b'
+
+        async def busy():
+            async with scheduler.slot():
+                await asyncio.sleep(0.3)
+
+        holder = asyncio.ensure_future(busy())
+        await asyncio.sleep(0)
+        chunks = [chunk async for chunk in resilience.stream('gemini', open_stream, admit=scheduler.slot)]
+        await holder
+        assert chunks == ['a', 'b']
+        assert resilience.hedges == 0
+        assert scheduler.active == 0
+    asyncio.run(scenario())
+
+
+def test_a_slow_request_is_hedged_and_the_loser_cancelled(monkeypatch):
+    monkeypatch.setattr(resilience_module, 'MODEL_HEDGE_DELAY', 0.05)
+
+    async def scenario():
+        resilience = Resilience(hedge=True, retries=0, timeout=1)
+        attempts = []
+        cancelled = []
+
+        async def call():
+            attempt = len(attempts)
+            attempts.append(asyncio.get_running_loop().time())
+            try:
+                await asyncio.sleep(10 if attempt == 0 else 0.01)
+            except asyncio.CancelledError:
+                cancelled.append(attempt)
+                raise
+            return attempt
+
+        assert await resilience.call('gemini', call, hedge=True) == 1
+        await asyncio.sleep(0)
+        assert len(attempts) == 2
+        assert attempts[1] - attempts[0] >= 0.05
+        assert cancelled == [0]
+        assert resilience.hedges == 1
+    asyncio.run(scenario())
+
+
+def test_fast_requests_are_not_hedged(monkeypatch):
+    monkeypatch.setattr(resilience_module, 'MODEL_HEDGE_DELAY', 0.05)
+
+    async def scenario():
+        resilience = Resilience(hedge=True, retries=0, timeout=1)
+
+        async def call():
+            return 'answer'
+
+        assert await resilience.call('gemini', call, hedge=True) == 'answer'
+        assert resilience.hedges == 0
+    asyncio.run(scenario())
+
+
+def test_retryable_errors_are_retried(monkeypatch):
+    monkeypatch.setattr(resilience_module, 'MODEL_RETRY_BASE', 0.001)
+
+    async def scenario():
+        resilience = Resilience(hedge=False, retries=2, timeout=1)
+        attempts = []
+
+        async def call():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise ConnectionError("reset")
+            return 'answer'
+
+        assert await resilience.call('gemini', call) == 'answer'
+        assert (len(attempts), resilience.retried) == (3, 2)
+        assert resilience.breaker('gemini').state == 'closed'
+    asyncio.run(scenario())
+
+
+def test_streams_are_not_retried_once_text_was_passed_on(monkeypatch):
+    monkeypatch.setattr(resilience_module, 'MODEL_RETRY_BASE', 0.001)
+
+    async def scenario():
+        resilience = Resilience(hedge=False, retries=2)
+        opened = []
+
+        async def open_stream():
+            opened.append(1)
+            yield 'partial'
+            raise ConnectionError("reset")
+
+        chunks = []
+        with pytest.raises(ConnectionError):
+            async for chunk in resilience.stream('gemini', open_stream):
+                chunks.append(chunk)
+        assert (chunks, len(opened)) == (['partial'], 1)
+    asyncio.run(scenario())
+
+
+def test_breaker_opens_after_threshold_failures_and_half_opens_after_cooldown():
+    breaker = resilience_module.CircuitBreaker(threshold=3, reset_after=30)
+    for _ in range(2):
+        breaker.failure()
+    assert (breaker.state, breaker.allow()) == ('closed', True)
+    breaker.failure()
+    assert (breaker.state, breaker.allow()) == ('open', False)
+
+    breaker.opened_at -= 30
+    assert (breaker.allow(), breaker.state) == (True, 'half-open')
+    breaker.failure()
+    assert (breaker.state, breaker.allow()) == ('open', False)
+
+    breaker.opened_at -= 30
+    assert breaker.allow()
+    breaker.success()
+    assert (breaker.state, breaker.failures) == ('closed', 0)
+
+
+def test_open_circuits_fail_fast(monkeypatch):
+    monkeypatch.setattr(resilience_module, 'MODEL_RETRY_BASE', 0.001)
+
+    async def scenario():
+        resilience = Resilience(hedge=False, retries=0, timeout=1)
+        resilience._breakers['gemini'] = resilience_module.CircuitBreaker(threshold=2, reset_after=30)
+        calls = []
+
+        async def call():
+            calls.append(1)
+            raise ConnectionError("reset")
+
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                await resilience.call('gemini', call)
+        with pytest.raises(resilience_module.CircuitOpenError):
+            await resilience.call('gemini', call)
+        assert len(calls) == 2
+    asyncio.run(scenario())
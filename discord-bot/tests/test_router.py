@@ -0,0 +1,52 @@
+# Description: Tests of the model router's tier choice and its step down when a tier misses its latency target.
+import pytest
+import utils.router as router_module
+from utils.router import MIN_LATENCY_SAMPLES, ModelRouter
+from utils.scheduler import PRIORITY_AMBIENT, PRIORITY_COMMAND
+
+
+@pytest.fixture
+def router(monkeypatch):
+    monkeypatch.setattr(router_module, 'GenerativeModel', lambda name: f"model:{name}")
+    return ModelRouter(tiers={'light': 'light-model', 'standard': 'standard-model', 'heavy': 'heavy-model'},
+                       slo={PRIORITY_COMMAND: 10.0, PRIORITY_AMBIENT: 5.0})
+
+
+def record(router, name, seconds, count=MIN_LATENCY_SAMPLES):
+    for _ in range(count):
+        router.record(name, seconds)
+
+
+def test_requests_get_the_tier_they_need(router):
+    assert router.route(PRIORITY_AMBIENT, 'text', 100).tier == 'light'
+    assert router.route(PRIORITY_COMMAND, 'text', 100).tier == 'standard'
+    assert router.route(PRIORITY_COMMAND, 'video', 100, preset='coach').tier == 'heavy'
+    assert router.route(PRIORITY_COMMAND, 'text', 50000).tier == 'heavy'
+
+
+def test_a_tier_over_its_latency_target_steps_down(router):
+    record(router, 'heavy-model', 30.0)
+    route = router.route(PRIORITY_COMMAND, 'text', 50000)
+    assert (route.tier, route.model) == ('standard', 'model:standard-model')
+    assert "over latency target" in route.reason
+
+    record(router, 'standard-model', 12.0)
+    assert router.route(PRIORITY_COMMAND, 'text', 50000).tier == 'light'
+
+
+def test_latency_targets_depend_on_the_request(router):
+    record(router, 'standard-model', 8.0)
+    assert router.route(PRIORITY_COMMAND, 'image').tier == 'standard'
+    assert router.route(PRIORITY_AMBIENT, 'image').tier == 'light'
+
+
+def test_too_few_samples_are_not_trusted(router):
+    record(router, 'standard-model', 30.0, count=MIN_LATENCY_SAMPLES - 1)
+    assert router.route(PRIORITY_COMMAND, 'text').tier == 'standard'
+
+
+def test_a_slow_tier_still_gets_an_occasional_request(router):
+    record(router, 'standard-model', 30.0)
+    tiers = [router.route(PRIORITY_COMMAND, 'text').tier for _ in range(MIN_LATENCY_SAMPLES)]
+    assert tiers.count('standard') == 1
+    assert tiers[-1] == 'standard'
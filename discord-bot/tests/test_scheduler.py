@@ -0,0 +1,89 @@
+# Description: Tests of the model scheduler's concurrency bound, fair ordering across guilds and cancelled waiters.
+import asyncio
+from utils.scheduler import PRIORITY_AMBIENT, PRIORITY_COMMAND, ModelScheduler
+
+
+async def hold(scheduler, seconds=0.01, **flow):
+    async with scheduler.slot(**flow):
+        await asyncio.sleep(seconds)
+
+
+async def admitted_in_order(scheduler, requests):
+    """Queue requests (name, slot arguments) behind a busy slot and return the names in admission order."""
+    order = []
+
+    async def request(name, flow):
+        async with scheduler.slot(**flow):
+            order.append(name)
+            await asyncio.sleep(0)
+
+    busy = asyncio.ensure_future(hold(scheduler, 0.05))
+    await asyncio.sleep(0)
+    tasks = []
+    for name, flow in requests:
+        tasks.append(asyncio.ensure_future(request(name, flow)))
+        await asyncio.sleep(0)
+    await asyncio.gather(busy, *tasks)
+    return order
+
+
+def test_guilds_share_slots_fairly():
+    async def scenario():
+        scheduler = ModelScheduler(concurrency=1)
+        requests = [(f"busy{i}", {'guild_id': 1, 'user_id': 10}) for i in range(3)] + [("quiet", {'guild_id': 2, 'user_id': 20})]
+        assert await admitted_in_order(scheduler, requests) == ["busy0", "quiet", "busy1", "busy2"]
+        assert scheduler.active == 0
+    asyncio.run(scenario())
+
+
+def test_commands_go_before_ambient_replies():
+    async def scenario():
+        scheduler = ModelScheduler(concurrency=1)
+        requests = [("ambient", {'priority': PRIORITY_AMBIENT, 'guild_id': 1}), ("command", {'priority': PRIORITY_COMMAND, 'guild_id': 2})]
+        assert await admitted_in_order(scheduler, requests) == ["command", "ambient"]
+    asyncio.run(scenario())
+
+
+def test_concurrency_is_bounded():
+    async def scenario():
+        scheduler = ModelScheduler(concurrency=2)
+        peak = []
+
+        async def request():
+            async with scheduler.slot():
+                peak.append(scheduler.active)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(request() for _ in range(6)))
+        assert max(peak) == 2
+        assert scheduler.active == 0
+    asyncio.run(scenario())
+
+
+def test_a_cancelled_waiter_does_not_leak_its_slot():
+    async def scenario():
+        scheduler = ModelScheduler(concurrency=1)
+        busy = asyncio.ensure_future(hold(scheduler, 0.02))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(hold(scheduler))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth()['command'] == 1
+        waiter.cancel()
+        await asyncio.gather(busy, waiter, return_exceptions=True)
+        assert scheduler.active == 0
+        await asyncio.wait_for(hold(scheduler), 1)
+    asyncio.run(scenario())
+
+
+def test_a_waiter_cancelled_as_the_slot_is_handed_over_releases_it():
+    async def scenario():
+        scheduler = ModelScheduler(concurrency=1)
+        await scheduler.acquire()
+        waiter = asyncio.ensure_future(hold(scheduler))
+        await asyncio.sleep(0)
+        scheduler.release()  # Hands the slot to the waiter, which hasn't resumed yet
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert waiter.cancelled()
+        assert scheduler.active == 0
+    asyncio.run(scenario())
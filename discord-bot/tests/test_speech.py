@@ -0,0 +1,110 @@
+# Description: Tests of the speech pipeline and speech cache, with fake synthesis and voice connections.
+import asyncio
+import utils.speech as speech
+from utils.tts_cache import TTSCache
+
+
+def use_cache(monkeypatch):
+    """Route synthesis through a fresh in-memory cache, counting the phrases actually synthesized."""
+    synthesized = []
+
+    def synthesize(text, lang, tld):
+        synthesized.append(text)
+        return b'mp3:' + text.encode()
+
+    cache = TTSCache(directory='')
+    monkeypatch.setattr(speech, 'tts_cache', cache)
+    monkeypatch.setattr(speech, 'synthesize', synthesize)
+    return cache, synthesized
+
+
+def test_nothing_is_synthesized_without_a_voice_connection(monkeypatch):
+    async def scenario():
+        _, synthesized = use_cache(monkeypatch)
+
+        async def connect():
+            return None
+
+        pipeline = speech.speak(connect, "The first sentence is long enough to be spoken on its own. And a second one.")
+        await pipeline.wait()
+        assert synthesized == []
+    asyncio.run(scenario())
+
+
+class FakeVoiceClient:
+    def __init__(self):
+        self.guild = type('Guild', (), {'id': 1})()
+
+    def is_connected(self):
+        return True
+
+
+class FakeSegment:
+    """An audio source that plays its bytes as a single frame."""
+
+    def __init__(self, audio, opus=True):
+        self.frames = [audio]
+        self.cleaned_up = False
+
+    def read(self):
+        return self.frames.pop() if self.frames else b''
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+
+class FakePlayback:
+    """Plays each enqueued source to its end on the event loop, as the voice client's player thread would."""
+
+    def __init__(self):
+        self.played = []
+
+    def enqueue(self, voice_client, source, after=None):
+        asyncio.ensure_future(self._play(source, after))
+
+    async def _play(self, source, after):
+        while True:
+            frame = source.read()
+            if not frame:
+                break
+            if frame != speech.OPUS_SILENCE:
+                self.played.append(frame)
+            await asyncio.sleep(0)
+        source.cleanup()
+        after(None)
+
+
+def test_prewarmed_replies_are_served_from_the_cache(monkeypatch):
+    reply = "Nobody has bet yet. Say `bet <amount>` first."
+
+    async def scenario():
+        cache, synthesized = use_cache(monkeypatch)
+        playback = FakePlayback()
+        segments = []
+
+        def audio_source(audio, opus):
+            segments.append(FakeSegment(audio, opus))
+            return segments[-1]
+
+        monkeypatch.setattr(speech, 'playback', playback)
+        monkeypatch.setattr(speech, 'audio_source', audio_source)
+        await speech.prewarm([reply])
+        assert synthesized == ["Nobody has bet yet. Say bet <amount> first."]
+
+        voice_client = FakeVoiceClient()
+
+        async def connect():
+            return voice_client
+
+        pipeline = speech.speak(connect, reply)
+        await pipeline.wait()
+        assert len(synthesized) == 1
+        assert cache.stats()['hits'] == 1
+        assert playback.played == [b'mp3:' + synthesized[0].encode()]
+        assert [segment.cleaned_up for segment in segments] == [True]
+    asyncio.run(scenario())
+
+
+def test_markdown_is_not_read_out():
+    assert speech.speakable("**Bold** move, `hit` or [stand](https://example.com)?") == "Bold move, hit or stand?"
+    assert speech.speakable("> quoted\n# Title") == "quoted\nTitle"
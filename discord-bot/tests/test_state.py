@@ -0,0 +1,57 @@
+# Description: Tests of the SQLite state store: write-behind persistence, reloading after a restart and retention compaction.
+import asyncio
+import time
+from utils.history import HistoryEntry
+from utils.state import StateStore, snowflake_for
+
+KEY = (1, 2)
+
+
+def open_store(tmp_path, **kwargs):
+    return StateStore(path=str(tmp_path / 'state.db'), flush_interval=60, **kwargs)
+
+
+def test_queued_writes_survive_a_restart(tmp_path):
+    async def scenario():
+        store = open_store(tmp_path)
+        now = snowflake_for(time.time())
+        store.append_message(KEY, HistoryEntry(now + 1, 'alice', "hello"))
+        store.append_message(KEY, HistoryEntry(now + 2, 'bob', "hi there"))
+        store.edit_message(KEY, now + 2, "hi there, alice")
+        store.put_memory(KEY, 0, now, "carol: an old message")
+        store.set('gemini_conv', 'chat_session_active', True)
+        # Nothing has been flushed yet, closing writes it all out
+        await store.close()
+
+        store = open_store(tmp_path)
+        assert await store.load_messages(KEY, 10) == [(now + 1, 'alice', "hello"), (now + 2, 'bob', "hi there, alice")]
+        assert await store.load_memories(KEY) == [(0, now, "carol: an old message")]
+        assert await store.get('gemini_conv', 'chat_session_active') is True
+        assert await store.get('gemini_conv', 'missing', 'default') == 'default'
+        await store.close()
+    asyncio.run(scenario())
+
+
+def test_a_closed_store_opens_again_on_next_use(tmp_path):
+    async def scenario():
+        store = open_store(tmp_path)
+        store.set('scope', 'key', 1)
+        await store.close()
+        store.set('scope', 'key', 2)
+        assert await store.get('scope', 'key') == 2
+        await store.close()
+    asyncio.run(scenario())
+
+
+def test_compaction_drops_messages_past_retention(tmp_path):
+    async def scenario():
+        store = open_store(tmp_path, retention_days=30)
+        old = snowflake_for(time.time() - 31 * 86400)
+        recent = snowflake_for(time.time() - 29 * 86400)
+        store.append_message(KEY, HistoryEntry(old, 'alice', "last month"))
+        store.append_message(KEY, HistoryEntry(recent, 'bob', "this month"))
+        await store.flush()
+        await store._run(store._compact)
+        assert await store.load_messages(KEY, 10) == [(recent, 'bob', "this month")]
+        await store.close()
+    asyncio.run(scenario())
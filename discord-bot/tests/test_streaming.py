@@ -0,0 +1,111 @@
+# Description: Tests of streamed replies: coalesced edits, rollover at the message limit and the final flush.
+import asyncio
+from types import SimpleNamespace
+import pytest
+import utils.streaming as streaming
+from utils.streaming import DISCORD_MESSAGE_LIMIT, StreamingReply, send_streaming_reply, split_point
+
+
+class FakeMessage:
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+        self.edits = []
+
+    async def edit(self, content):
+        self.content = content
+        self.edits.append(content)
+        self.channel.calls.append(('edit', content))
+
+
+class FakeChannel:
+    def __init__(self):
+        self.messages = []
+        self.calls = []
+
+    async def send(self, content):
+        self.messages.append(FakeMessage(self, content))
+        self.calls.append(('send', content))
+        return self.messages[-1]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A monotonic clock that only moves when the test advances it."""
+    now = [1000.0]
+    monkeypatch.setattr(streaming, 'time', SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def stream(reply, *chunks):
+    async def scenario():
+        for chunk in chunks:
+            await reply.feed(chunk)
+        return await reply.finish()
+    return asyncio.run(scenario())
+
+
+def test_chunks_between_edits_are_coalesced(clock):
+    channel = FakeChannel()
+
+    async def scenario():
+        reply = StreamingReply(channel, edit_interval=1.0)
+        await reply.feed("Hello")
+        await reply.feed(", there")
+        await reply.feed(" friend")
+        assert channel.calls == [('send', "Hello")]
+        clock[0] += 1.0
+        await reply.feed("!")
+        assert channel.calls == [('send', "Hello"), ('edit', "Hello, there friend!")]
+    asyncio.run(scenario())
+
+
+def test_finish_sends_what_is_left(clock):
+    channel = FakeChannel()
+    reply = StreamingReply(channel, edit_interval=1.0)
+    assert stream(reply, "One", " two", " three") == "One two three"
+    assert channel.calls == [('send', "One"), ('edit', "One two three")]
+
+
+def test_finish_skips_an_edit_that_changes_nothing(clock):
+    channel = FakeChannel()
+    reply = StreamingReply(channel, edit_interval=0.0)
+    stream(reply, "Done.")
+    assert channel.calls == [('send', "Done.")]
+
+
+def test_long_replies_roll_over_to_new_messages(clock):
+    channel = FakeChannel()
+    reply = StreamingReply(channel, edit_interval=1.0)
+    words = ["word"] * 1000
+    text = stream(reply, *(word + " " for word in words))
+    assert len(channel.messages) == 3
+    assert all(len(message.content) <= DISCORD_MESSAGE_LIMIT for message in channel.messages)
+    # Split on word breaks, nothing lost or repeated
+    assert "".join(message.content for message in channel.messages) == text
+    assert all(message.content.endswith(" ") for message in channel.messages[:-1])
+
+
+def test_the_prefix_is_stripped_before_anything_is_posted(clock):
+    channel = FakeChannel()
+    reply = StreamingReply(channel, edit_interval=0.0, strip_prefix="Bot: ")
+    assert stream(reply, "Bo", "t: ", "Bot: Hi!") == "Hi!"
+    assert channel.calls == [('send', "Hi!")]
+
+
+def test_send_streaming_reply_returns_the_full_text(clock):
+    channel = FakeChannel()
+
+    async def chunks():
+        for chunk in ("a", "b", "c"):
+            yield chunk
+
+    assert asyncio.run(send_streaming_reply(channel, chunks())) == "abc"
+    assert channel.messages[-1].content == "abc"
+
+
+def test_split_point_prefers_line_then_word_breaks():
+    assert split_point("short") == 5
+    assert split_point("a" * 1500 + "\n" + "b" * 1000) == 1501
+    assert split_point("a" * 1500 + " " + "b" * 1000) == 1501
+    assert split_point("a" * 2500) == DISCORD_MESSAGE_LIMIT